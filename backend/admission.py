@@ -0,0 +1,130 @@
+"""Admission control and request deadlines for the matching pipeline.
+
+Without a bound, a traffic spike queues every upload in the worker and runs
+each one to completion, long after its client has given up, so latency
+collapses for everyone. An `AdmissionController` lets at most
+`max_concurrent` requests run the pipeline at once and up to `max_queue` wait
+for a slot, receiving their uploads meanwhile. A request is shed at once, answered with 503 and Retry-After,
+when the queue is full or the estimated wait for a slot is too long.
+
+Every request also carries a `Deadline`. It is checked while waiting and
+between pipeline stages, and once it passes the remaining stages are skipped.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from metrics import MATCH_DEADLINE_MISSES, MATCH_IN_FLIGHT, MATCH_QUEUE_DEPTH, MATCH_SHED, MATCH_STAGE_SECONDS
+
+# Weight of the latest request in the moving average of service time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class Overloaded(Exception):
+    """The request was shed; `retry_after` is the suggested wait in whole seconds."""
+    
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f'Server overloaded ({reason})')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before `stage`."""
+    
+    def __init__(self, stage: str):
+        super().__init__(f'Deadline exceeded before {stage}')
+        self.stage = stage
+
+
+class Deadline:
+    """Point in time by which a request must be answered."""
+    
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+    
+    def check(self, stage: str) -> None:
+        """Raise DeadlineExceeded, counting the miss, if the deadline has passed before `stage`."""
+        if self.remaining() <= 0:
+            MATCH_DEADLINE_MISSES.inc(stage=stage)
+            raise DeadlineExceeded(stage)
+
+
+class AdmissionController:
+    """Bounded queue in front of the matching pipeline of one worker.
+    
+    `max_wait` caps the estimated wait for a slot, from the queue ahead and a
+    moving average of recent service times. `max_concurrent` of 0 admits
+    every request at once.
+    """
+    
+    def __init__(self, max_concurrent: int, max_queue: int, max_wait: float, service_time: float = 0.1):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.service_time = service_time
+        self._running = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+    
+    def estimated_wait(self) -> float:
+        """Seconds a request arriving now would wait for a slot."""
+        ahead = self._running + self._waiting - self.max_concurrent + 1
+        return max(ahead, 0) * self.service_time / max(self.max_concurrent, 1)
+    
+    def _shed(self, reason: str, wait: float) -> Overloaded:
+        MATCH_SHED.inc(reason=reason)
+        return Overloaded(reason, max(1, math.ceil(wait)))
+    
+    @contextmanager
+    def admit(self, deadline: Deadline, receive: Callable[[], Any] = None):
+        """Run the body once a slot is free; raises Overloaded or DeadlineExceeded instead.
+        
+        `receive`, if given, reads the request body after a queue place is
+        taken and before waiting for a slot, so a slow upload holds a place in
+        the queue but never a pipeline slot; its result is yielded.
+        """
+        if self.max_concurrent <= 0:
+            yield receive() if receive is not None else None
+            return
+        with self._condition:
+            if self._running + self._waiting >= self.max_concurrent:
+                wait = self.estimated_wait()
+                if self._running + self._waiting >= self.max_concurrent + self.max_queue:
+                    raise self._shed('queue_full', wait)
+                if wait > self.max_wait:
+                    raise self._shed('wait', wait)
+            self._waiting += 1
+            MATCH_QUEUE_DEPTH.set(self._waiting)
+        try:
+            body = receive() if receive is not None else None
+            queued_at = time.monotonic()
+            with self._condition:
+                while self._running >= self.max_concurrent:
+                    remaining = deadline.remaining()
+                    if remaining <= 0:
+                        # Pass on a wake-up this request can no longer use
+                        self._condition.notify()
+                        deadline.check('queue')
+                    self._condition.wait(remaining)
+                self._running += 1
+                MATCH_IN_FLIGHT.set(self._running)
+        finally:
+            with self._condition:
+                self._waiting -= 1
+                MATCH_QUEUE_DEPTH.set(self._waiting)
+        started = time.monotonic()
+        MATCH_STAGE_SECONDS.observe(started - queued_at, stage='queue')
+        try:
+            yield body
+        finally:
+            with self._condition:
+                self._running -= 1
+                MATCH_IN_FLIGHT.set(self._running)
+                self.service_time += SERVICE_TIME_SMOOTHING * (time.monotonic() - started - self.service_time)
+                self._condition.notify()
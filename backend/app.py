@@ -1,68 +1,210 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import hashlib
+import hmac
 import os
-import sqlite3
-from datetime import datetime
-from werkzeug.utils import secure_filename
-import tempfile
-import soundfile as sf
+import threading
+import time
 import numpy as np
-from scipy import signal
-from shazam_fingerprint import (
-    create_spectrogram, 
-    extract_peaks, 
-    generate_fingerprints
+from shazam_fingerprint import StreamingFingerprinter, fingerprint_blocks, DSP_RATIO, FINGERPRINT_VERSION
+from fingerprint_pool import fingerprint
+from database import (
+    ConnectionPool, connect, init_db, insert_fingerprints, catalog_generation, bump_generation, catalog_epoch,
+    bump_epoch, fingerprint_version, set_fingerprint_version, update_hash_stats
+)
+from matching import lookup_fingerprints, rank_candidates, StreamingMatcher, DEFAULT_TOP_K
+from memory_index import catch_up, last_rowid, load_or_build
+from shards import ShardedIndex
+from snapshot import LiveSnapshot, SnapshotError, snapshot_summary
+from hash_stats import StopList, STOP_MODES
+from audio_io import AudioDecodeError, InMemoryUploadRequest, decode_audio, read_audio_blocks
+from match_cache import MatchCache, pcm_digest
+from admission import AdmissionController, Deadline, DeadlineExceeded, Overloaded
+from batching import LookupBatcher
+from fingerprint_codec import decode_fingerprints
+from scan import scan_blocks, SCAN_BLOCK_FRAMES, SCAN_HOP_SECONDS, SCAN_WINDOW_SECONDS
+import metrics
+from metrics import (
+    MATCH_STAGE_SECONDS, MATCH_FINGERPRINTS, MATCH_POSTING_HITS, MATCH_CANDIDATE_SONGS, MATCH_REQUESTS,
+    MATCH_HASHES_REQUESTS,
+    MATCH_STOPPED_FINGERPRINTS
 )
 
 app = Flask(__name__)
+app.request_class = InMemoryUploadRequest
 CORS(app)
 
-# Configure upload folder
-UPLOAD_FOLDER = 'temp_uploads'
 ALLOWED_EXTENSIONS = {'wav', 'mp3', 'm4a', 'ogg'}
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# Database setup; each worker keeps up to DB_POOL_SIZE idle read-only
+# connections open and writes through a single connection
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'songs.db')
+db_pool = ConnectionPool(DATABASE_PATH, int(os.environ.get('DB_POOL_SIZE', '8')))
+
+# Fingerprint lookup engine: 'sqlite' queries songs.db directly, 'memory' serves
+# postings from an in-memory index persisted under INDEX_DIR, 'sharded' stores
+# and looks up fingerprints in the hash-range shards under SHARD_DIR (create
+# them with `python shards.py init`). Song metadata lives in songs.db, except
+# with 'snapshot', which serves a read-only replica from the immutable index
+# snapshot at SNAPSHOT_PATH (build it with `python snapshot.py build`) and
+# swaps in a replaced file within SNAPSHOT_CHECK_SECONDS or on SIGHUP
+FINGERPRINT_ENGINE = os.environ.get('FINGERPRINT_ENGINE', 'sqlite')
+INDEX_DIR = os.environ.get('INDEX_DIR', 'fingerprint_index')
+SHARD_DIR = os.environ.get('SHARD_DIR', 'fingerprint_shards')
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', 'snapshots/current.snap')
+SNAPSHOT_CHECK_SECONDS = float(os.environ.get('SNAPSHOT_CHECK_SECONDS', '1'))
+SNAPSHOT_VERIFY = os.environ.get('SNAPSHOT_VERIFY', '1') == '1'
+# POST /admin/snapshot requires `Authorization: Bearer $ADMIN_TOKEN`; without a
+# token it is only accepted from the local host
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+memory_index = None
+# Catalog generation, last fingerprints rowid and catalog epoch this worker's memory index reflects
+memory_generation = None
+memory_rowid = 0
+memory_epoch = 0
+memory_lock = threading.Lock()
+shard_index = None
+snapshots = None
+
+# Streaming match: bytes read per step and the bar for answering before the upload ends
+STREAM_READ_BYTES = 16384
+STREAM_MIN_SCORE = 20  # fingerprints at the same time offset
+STREAM_MIN_MARGIN = 3.0  # best score over the runner-up's
+STREAM_OFFSET_BIN_MS = 50
+
+# Samples per block when /add decodes an upload incrementally
+INGEST_BLOCK_FRAMES = 65536
+
+# /match scores only the MATCH_TOP_K songs with the most hash hits and returns
+# up to MAX_TOP_N ranked candidates; both can be set per request
+MATCH_TOP_K = int(os.environ.get('MATCH_TOP_K', DEFAULT_TOP_K))
+MATCH_TOP_N = 5
+MAX_TOP_N = 50
+
+# Hashes found in more than HASH_STOP_SHARE of all songs (and more than
+# HASH_STOP_MIN_SONGS songs) are dropped from queries ('drop'), scored with
+# HASH_STOP_WEIGHT ('weight') or used like any other ('off');
+# HASH_STOP_AT_INDEX=1 also leaves them out of newly added songs
+HASH_STOP_MODE = os.environ.get('HASH_STOP_MODE', 'drop')
+HASH_STOP_WEIGHT = float(os.environ.get('HASH_STOP_WEIGHT', '0.1'))
+HASH_STOP_AT_INDEX = os.environ.get('HASH_STOP_AT_INDEX', '0') == '1'
+stop_list = StopList(float(os.environ.get('HASH_STOP_SHARE', '0.05')),
+                     int(os.environ.get('HASH_STOP_MIN_SONGS', '50')))
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# Largest /match_hashes query accepted, in fingerprints
+MATCH_HASHES_MAX = int(os.environ.get('MATCH_HASHES_MAX', '1000000'))
 
-# Database setup
-DATABASE_PATH = 'songs.db'
+# Admission control: per worker, at most MATCH_CONCURRENCY /match and
+# /match_hashes requests run the pipeline at once and up to MATCH_QUEUE_SIZE
+# wait for a slot; beyond that, or when the estimated wait passes
+# MATCH_MAX_WAIT_SECONDS, requests get 503 with Retry-After. A request is
+# cancelled between stages once MATCH_DEADLINE_SECONDS (or the client's shorter
+# X-Request-Timeout, in seconds) have passed. MATCH_CONCURRENCY=0 disables it
+MATCH_CONCURRENCY = int(os.environ.get('MATCH_CONCURRENCY', '8'))
+MATCH_QUEUE_SIZE = int(os.environ.get('MATCH_QUEUE_SIZE', '8'))
+MATCH_MAX_WAIT_SECONDS = float(os.environ.get('MATCH_MAX_WAIT_SECONDS', '2'))
+MATCH_DEADLINE_SECONDS = float(os.environ.get('MATCH_DEADLINE_SECONDS', '10'))
+admission = AdmissionController(MATCH_CONCURRENCY, MATCH_QUEUE_SIZE, MATCH_MAX_WAIT_SECONDS)
+
+# Recent /match results, keyed by the decoded audio; 0 entries disables caching
+MATCH_CACHE_SIZE = int(os.environ.get('MATCH_CACHE_SIZE', '1024'))
+MATCH_CACHE_TTL = float(os.environ.get('MATCH_CACHE_TTL', '60'))
+match_cache = MatchCache(MATCH_CACHE_SIZE, MATCH_CACHE_TTL)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)
+def lookup_hits(conn, hashes, offsets):
+    """Look up query fingerprints in the configured engine."""
+    if snapshots is not None:
+        return snapshots.current().lookup(hashes, offsets)
+    if memory_index is not None:
+        return memory_index.lookup(hashes, offsets)
+    if shard_index is not None:
+        return shard_index.lookup(hashes, offsets)
+    return lookup_fingerprints(conn, hashes, offsets)
+
+def refresh_catalog(conn) -> int:
+    """Generation of the catalog being served, with the stop-list brought up to date."""
+    if snapshots is not None:
+        snapshot = snapshots.current()
+        if HASH_STOP_MODE != 'off':
+            stop_list.refresh_counts(snapshot.generation, snapshot.stats_hashes, snapshot.stats_songs,
+                                     snapshot.num_songs)
+        return snapshot.generation
+    generation = catalog_generation(conn)
+    if memory_index is not None and generation != memory_generation:
+        sync_memory_index(conn, generation)
+    if HASH_STOP_MODE != 'off':
+        stop_list.refresh(conn, generation)
+    return generation
+
+def sync_memory_index(conn, generation: int) -> None:
+    """Catch this worker's memory index up with catalog writes made by any worker."""
+    global memory_index, memory_generation, memory_rowid, memory_epoch
+    with memory_lock:
+        if generation != memory_generation:
+            memory_index, memory_rowid, memory_epoch = catch_up(memory_index, conn, memory_rowid, memory_epoch)
+            memory_generation = generation
+
+def song_names(conn, song_ids) -> dict:
+    """Names of the given songs in the catalog being served."""
+    song_ids = list(song_ids)
+    if snapshots is not None:
+        return snapshots.current().song_names(song_ids)
+    if not song_ids:
+        return {}
     c = conn.cursor()
-    
-    # Drop existing tables if they exist
-    c.execute('DROP TABLE IF EXISTS fingerprints')
-    c.execute('DROP TABLE IF EXISTS songs')
-    
-    # Create tables with new schema
-    c.execute('''
-        CREATE TABLE songs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE fingerprints (
-            hash INTEGER NOT NULL,
-            song_id INTEGER NOT NULL,
-            offset INTEGER NOT NULL,
-            FOREIGN KEY(song_id) REFERENCES songs(id)
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    c.execute(f"SELECT id, name FROM songs WHERE id IN ({','.join('?' * len(song_ids))})", song_ids)
+    return dict(c.fetchall())
+
+def song_durations(conn, song_ids) -> dict:
+    """Lengths in seconds of the given songs, where the catalog records them."""
+    song_ids = list(song_ids)
+    if snapshots is not None:
+        return snapshots.current().song_durations(song_ids)
+    if not song_ids:
+        return {}
+    c = conn.cursor()
+    c.execute(f"SELECT id, duration FROM songs WHERE id IN ({','.join('?' * len(song_ids))}) "
+              'AND duration IS NOT NULL', song_ids)
+    return dict(c.fetchall())
+
+def request_deadline() -> Deadline:
+    """Deadline of the current request: MATCH_DEADLINE_SECONDS or the client's shorter X-Request-Timeout."""
+    timeout = request.headers.get('X-Request-Timeout', type=float)
+    if timeout is None or not 0 < timeout < MATCH_DEADLINE_SECONDS:
+        timeout = MATCH_DEADLINE_SECONDS
+    return Deadline(timeout)
+
+def overloaded_response(e: Overloaded):
+    return jsonify({'error': 'Server overloaded, retry later'}), 503, {'Retry-After': str(e.retry_after)}
+
+def deadline_response(e: DeadlineExceeded):
+    return jsonify({'error': str(e)}), 504
+
+def admin_allowed() -> bool:
+    """Whether the current request may use the admin endpoints."""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {ADMIN_TOKEN}')
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+def read_only_replica():
+    """Error response for catalog writes while serving an immutable snapshot."""
+    return jsonify({'error': 'This server serves a read-only index snapshot; build and publish a new one '
+                             'with snapshot.py instead'}), 409
+
+# Concurrent /match lookups arriving within MATCH_BATCH_WAIT_MS of each other
+# share one lookup of up to MATCH_BATCH_SIZE requests; 0 disables batching
+MATCH_BATCH_SIZE = int(os.environ.get('MATCH_BATCH_SIZE', '32'))
+MATCH_BATCH_WAIT_MS = float(os.environ.get('MATCH_BATCH_WAIT_MS', '2'))
+lookup_batcher = (LookupBatcher(lookup_hits, lambda: connect(DATABASE_PATH, read_only=True),
+                                MATCH_BATCH_SIZE, MATCH_BATCH_WAIT_MS / 1000) if MATCH_BATCH_SIZE > 0 else None)
 
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging; LOG_LEVEL=DEBUG adds per-request detail to the match logs
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 @app.route('/add', methods=['POST'])
@@ -79,552 +221,506 @@ def add_song():
     if file.filename == '' or song_name == '':
         logger.error('Missing file or song name')
         return jsonify({'error': 'Missing file or song name'}), 400
+    if snapshots is not None:
+        return read_only_replica()
         
     if file and allowed_file(file.filename):
-        # Create temporary file
-        temp_dir = tempfile.mkdtemp()
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(temp_dir, filename)
-        file.save(filepath)
-        
         try:
-            # Load audio file using soundfile
-            samples, sample_rate = sf.read(filepath)
-            
-            # Convert to mono if stereo
-            if len(samples.shape) > 1:
-                samples = samples.mean(axis=1)
-            
-            # Ensure float64
-            samples = samples.astype(np.float64)
-            
-            # Generate spectrogram
-            spectrogram = create_spectrogram(samples, sample_rate)
-            
-            # Extract peaks
-            duration = len(samples) / sample_rate
-            peaks = extract_peaks(spectrogram, duration)
-            
-            # Store song in database
-            conn = sqlite3.connect(DATABASE_PATH)
-            c = conn.cursor()
-            
-            c.execute('INSERT INTO songs (name) VALUES (?)', (song_name,))
-            song_id = c.lastrowid
+            # Decode, filter and fingerprint block by block where the length is
+            # known up front; other formats are decoded whole in memory
             logger.info('Generating fingerprints')
-            fingerprints = generate_fingerprints(peaks, song_id)
-            logger.info(f'Number of fingerprints generated: {len(fingerprints)}')
+            blocks, sample_rate, num_samples = read_audio_blocks(file.stream, INGEST_BLOCK_FRAMES)
+            if num_samples is not None:
+                hashes, offsets = fingerprint_blocks(blocks, sample_rate, num_samples)
+            else:
+                samples, sample_rate = decode_audio(file.read())
+                num_samples = len(samples)
+                hashes, offsets = fingerprint(samples, sample_rate)
+            logger.info(f'Number of fingerprints generated: {len(hashes)}')
             
-            # Store fingerprints
+            # Store song and fingerprints in one transaction
             logger.info('Storing fingerprints in database')
-            for hash_value, (offset, _) in fingerprints.items():
-                c.execute(
-                    'INSERT INTO fingerprints (hash, song_id, offset) VALUES (?, ?, ?)',
-                    (hash_value, song_id, offset)
-                )
+            insert_start = time.perf_counter()
+            with db_pool.writer() as conn:
+                # Statistics count every fingerprint, stored or not
+                stats_hashes = hashes
+                if HASH_STOP_AT_INDEX:
+                    stop_list.refresh(conn)
+                    keep = ~stop_list.contains(hashes)
+                    hashes, offsets = hashes[keep], offsets[keep]
+                with conn:
+                    c = conn.cursor()
+                    c.execute('INSERT INTO songs (name, duration) VALUES (?, ?)',
+                              (song_name, num_samples / sample_rate))
+                    song_id = c.lastrowid
+                    if shard_index is None:
+                        insert_fingerprints(conn, song_id, hashes, offsets)
+                        update_hash_stats(conn, stats_hashes)
+                        bump_generation(conn)
+                if shard_index is not None:
+                    # Shards commit on their own, so they are written once the song is committed;
+                    # if they or the statistics fail, the song is taken out again
+                    try:
+                        shard_index.add(song_id, hashes, offsets)
+                        with conn:
+                            update_hash_stats(conn, stats_hashes)
+                            bump_generation(conn)
+                    except Exception:
+                        shard_index.remove_song(song_id)
+                        with conn:
+                            conn.execute('DELETE FROM songs WHERE id = ?', (song_id,))
+                        raise
+            insert_seconds = time.perf_counter() - insert_start
             logger.info('Fingerprints stored successfully')
             
-            conn.commit()
-            conn.close()
-            
             return jsonify({
                 'success': True,
                 'message': f'Added song: {song_name}',
                 'song_id': song_id,
                 'stats': {
-                    'duration': len(samples) / sample_rate,
-                    'num_fingerprints': len(fingerprints)
+                    'duration': num_samples / sample_rate,
+                    'num_fingerprints': len(hashes),
+                    'fingerprints_per_second': len(hashes) / insert_seconds if insert_seconds > 0 else 0
                 }
             })
-            
+        
+        except AudioDecodeError as e:
+            logger.error(f'Could not decode {file.filename}: {e}')
+            return jsonify({'error': f'Could not decode audio: {e}'}), 400
         except Exception as e:
-            print(f"Error adding song: {str(e)}")
+            logger.exception('Error adding song')
             return jsonify({'error': str(e)}), 500
-            
-        finally:
-            # Cleanup
-            try:
-                os.remove(filepath)
-                os.rmdir(temp_dir)
-            except Exception as e:
-                print(f"Error cleaning up: {str(e)}")
     
     return jsonify({'error': 'Invalid file type'}), 400
 
 @app.route('/clear_db', methods=['POST'])
 def clear_database():
+    if snapshots is not None:
+        return read_only_replica()
     try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM fingerprints')
-        c.execute('DELETE FROM songs')
-        conn.commit()
-        conn.close()
+        with db_pool.writer() as conn:
+            with conn:
+                c = conn.cursor()
+                c.execute('DELETE FROM fingerprints')
+                c.execute('DELETE FROM songs')
+                c.execute('DELETE FROM hash_stats')
+                bump_generation(conn)
+                bump_epoch(conn)
+                set_fingerprint_version(conn, FINGERPRINT_VERSION)
+        if shard_index is not None:
+            shard_index.clear()
         return jsonify({'message': 'Database cleared successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+def match_fingerprints(sample_hashes: np.ndarray, sample_offsets: np.ndarray, top_k: int, top_n: int,
+                       timings: dict = None, endpoint: str = 'match', deadline: Deadline = None) -> dict:
+    """Look up and score query fingerprints; returns the /match response body.
+    
+    The stop-list must be fresh; `timings` holds the fingerprinting stage
+    timings to log, if any. Raises DeadlineExceeded if `deadline` passes
+    before the lookup or the scoring.
+    """
+    # Leave out or down-weight hashes that are common to many songs
+    weights = None
+    query_weight = len(sample_hashes)
+    if HASH_STOP_MODE != 'off':
+        stopped = stop_list.contains(sample_hashes)
+        MATCH_STOPPED_FINGERPRINTS.observe(int(stopped.sum()))
+        if HASH_STOP_MODE == 'drop':
+            sample_hashes, sample_offsets = sample_hashes[~stopped], sample_offsets[~stopped]
+            query_weight = len(sample_hashes)
+        else:
+            weights = np.where(stopped, HASH_STOP_WEIGHT, 1.0)
+            query_weight = weights.sum()
+    
+    best_match = None
+    highest_score = 0
+    candidates = []
+    
+    with db_pool.reader() as conn:
+        # Look up all sample hashes at once
+        if deadline is not None:
+            deadline.check('lookup')
+        with MATCH_STAGE_SECONDS.time(stage='lookup'):
+            if lookup_batcher is not None:
+                song_ids, db_offsets, hit_offsets, query_idx = lookup_batcher.submit(
+                    sample_hashes, sample_offsets
+                )
+            else:
+                song_ids, db_offsets, hit_offsets, query_idx = lookup_hits(
+                    conn, sample_hashes.tolist(), sample_offsets.tolist()
+                )
+        MATCH_POSTING_HITS.observe(len(song_ids))
+        MATCH_CANDIDATE_SONGS.observe(len(np.unique(song_ids)))
+        
+        # Rank songs by hash hits, then align offsets for the top K only
+        if deadline is not None:
+            deadline.check('scoring')
+        with MATCH_STAGE_SECONDS.time(stage='scoring'):
+            candidates = rank_candidates(song_ids, db_offsets, hit_offsets, query_idx, top_k, top_n,
+                                         weights[query_idx] if weights is not None else None)
+        if candidates:
+            names = song_names(conn, [candidate['song_id'] for candidate in candidates])
+            for candidate in candidates:
+                candidate['name'] = names.get(candidate['song_id'])
+            highest_score = candidates[0]['score']
+            best_match = {
+                'id': candidates[0]['song_id'],
+                'name': candidates[0]['name'],
+                'score': highest_score
+            }
+    
+    confidence = (highest_score / query_weight) * 100 if query_weight else 0
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            '%s: %d sample fingerprints, %d catalog hits, stage seconds %s',
+            endpoint, len(sample_hashes), len(song_ids),
+            {stage: round(seconds, 4) for stage, seconds in (timings or {}).items()}
+        )
+    
+    response = {
+        'matched': False,
+        'confidence': confidence,
+        'song': None,
+        'songName': None,
+        'song_id': None,
+        'candidates': candidates
+    }
+    
+    if best_match and confidence > 15 and highest_score > 1:
+        response.update({
+            'matched': True,
+            'song': best_match['name'],
+            'songName': best_match['name'],
+            'song_id': best_match['id']
+        })
+    else:
+        if best_match:
+            response.update({
+                'song': best_match['name'],
+                'songName': best_match['name'],
+                'song_id': best_match['id']
+            })
+    
+    logger.info(
+        f"{endpoint}: {'MATCH' if response['matched'] else 'no confident match'} "
+        f"{best_match['name'] if best_match else None} "
+        f"(score {highest_score}, confidence {confidence:.2f}%)"
+    )
+    return response
+
+
 @app.route('/match', methods=['POST'])
 def match_audio():
+    deadline = request_deadline()
     try:
-        if 'file' not in request.files:
-            print('Error: No file in request')
-            return jsonify({'error': 'No file part'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-            
-        if file and allowed_file(file.filename):
-            # Create temporary file
-            temp_dir = tempfile.mkdtemp()
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(temp_dir, filename)
-            file.save(filepath)
+        # Shed load before the upload is parsed; a slow upload holds a queue place, not a pipeline slot
+        with admission.admit(deadline, receive=lambda: request.files) as files:
+            if 'file' not in files:
+                logger.error('No file in match request')
+                return jsonify({'error': 'No file part'}), 400
+            
+            file = files['file']
+            
+            if file.filename == '':
+                return jsonify({'error': 'No selected file'}), 400
+            
+            top_k = request.values.get('top_k', MATCH_TOP_K, type=int)
+            top_n = request.values.get('top_n', MATCH_TOP_N, type=int)
+            if top_k < 1 or not 1 <= top_n <= MAX_TOP_N:
+                return jsonify({'error': f'top_k must be at least 1 and top_n between 1 and {MAX_TOP_N}'}), 400
+            
+            if file and allowed_file(file.filename):
+                # Decode the upload in memory to mono float32
+                with MATCH_STAGE_SECONDS.time(stage='decode'):
+                    samples, sample_rate = decode_audio(file.read())
+                
+                # Answer repeated clips from the cache while the catalog is unchanged
+                cache_key = f'{pcm_digest(samples, sample_rate)}:{top_k}:{top_n}'
+                with db_pool.reader() as conn:
+                    generation = refresh_catalog(conn)
+                cached = match_cache.get(cache_key, generation)
+                if cached is not None:
+                    logger.info(f"match: cache hit ({cached['songName']})")
+                    MATCH_REQUESTS.inc(result='cached')
+                    return jsonify(cached)
+                
+                # Spectrogram, peaks and fingerprints
+                deadline.check('fingerprint')
+                timings = {}
+                sample_hashes, sample_offsets = fingerprint(samples, sample_rate, timings)
+                for stage, seconds in timings.items():
+                    MATCH_STAGE_SECONDS.observe(seconds, stage=stage)
+                MATCH_FINGERPRINTS.observe(len(sample_hashes))
+                
+                response = match_fingerprints(sample_hashes, sample_offsets, top_k, top_n, timings, deadline=deadline)
+                MATCH_REQUESTS.inc(result='matched' if response['matched'] else 'unmatched')
+                match_cache.put(cache_key, generation, response)
+                return jsonify(response)
             
+            return jsonify({'error': 'Invalid file type'}), 400
+    
+    except Overloaded as e:
+        logger.warning(f'match: shed, {e}')
+        MATCH_REQUESTS.inc(result='shed')
+        return overloaded_response(e)
+    except DeadlineExceeded as e:
+        logger.warning(f'match: {e}')
+        MATCH_REQUESTS.inc(result='deadline')
+        return deadline_response(e)
+    except AudioDecodeError as e:
+        logger.warning(f'Could not decode match upload: {e}')
+        MATCH_REQUESTS.inc(result='error')
+        return jsonify({'error': f'Could not decode audio: {e}'}), 400
+    except Exception as e:
+        logger.exception('Error in match_audio')
+        MATCH_REQUESTS.inc(result='error')
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/match_hashes', methods=['POST'])
+def match_hashes():
+    """Match fingerprints computed by the client instead of uploaded audio.
+    
+    The body is a packed array of little-endian (uint32 hash, uint32
+    offset_ms) pairs as produced by `fingerprint_codec.encode_fingerprints`.
+    The ``version`` query parameter names the fingerprint algorithm and must
+    be the server's FINGERPRINT_VERSION; ``top_k`` and ``top_n`` work as for
+    /match, whose response this returns.
+    """
+    version = request.args.get('version', type=int)
+    if version != FINGERPRINT_VERSION:
+        MATCH_HASHES_REQUESTS.inc(result='error')
+        return jsonify({
+            'error': f'Fingerprints must be computed with algorithm version {FINGERPRINT_VERSION}',
+            'fingerprint_version': FINGERPRINT_VERSION
+        }), 409
+    top_k = request.args.get('top_k', MATCH_TOP_K, type=int)
+    top_n = request.args.get('top_n', MATCH_TOP_N, type=int)
+    if top_k < 1 or not 1 <= top_n <= MAX_TOP_N:
+        MATCH_HASHES_REQUESTS.inc(result='error')
+        return jsonify({'error': f'top_k must be at least 1 and top_n between 1 and {MAX_TOP_N}'}), 400
+    if (request.content_length or 0) > MATCH_HASHES_MAX * 8:
+        MATCH_HASHES_REQUESTS.inc(result='error')
+        return jsonify({'error': f'At most {MATCH_HASHES_MAX} fingerprints per query'}), 413
+    
+    deadline = request_deadline()
+    try:
+        with admission.admit(deadline, receive=lambda: request.get_data(cache=False)) as payload:
             try:
-                # Load audio file using soundfile
-                samples, sample_rate = sf.read(filepath)
-                
-                # Convert to mono if stereo
-                if len(samples.shape) > 1:
-                    samples = samples.mean(axis=1)
-                
-                # Ensure float64
-                samples = samples.astype(np.float64)
-                
-                # Generate spectrogram
-                spectrogram = create_spectrogram(samples, sample_rate)
-                
-                # Extract peaks
-                duration = len(samples) / sample_rate
-                peaks = extract_peaks(spectrogram, duration)
-                
-                # Generate fingerprints (use 0 as temporary song_id)
-                sample_fingerprints = generate_fingerprints(peaks, 0)
-                
-                print('\n' + '='*50)
-                print('MATCHING PROCESS STARTED')
-                print('='*50)
-                print(f'Sample has {len(sample_fingerprints)} fingerprints')
-                
-                conn = sqlite3.connect(DATABASE_PATH)
-                c = conn.cursor()
-                
-                matches = {}
-                total_hash_matches = 0
-                
-                print('\nFINGERPRINT MATCHES:')
-                print('-'*30)
-                
-                for hash_value, (sample_offset, _) in sample_fingerprints.items():
-                    c.execute('''
-                        SELECT f.song_id, f.offset, s.name 
-                        FROM fingerprints f 
-                        JOIN songs s ON f.song_id = s.id 
-                        WHERE f.hash = ?
-                    ''', (hash_value,))
-                    results = c.fetchall()
-                    if results:
-                        total_hash_matches += len(results)
-                        print(f'\nHash {hash_value}:')
-                        print(f'  Sample offset: {sample_offset:.2f}s')
-                        for song_id, db_offset, song_name in results:
-                            print(f'  → Matched in "{song_name}" at {db_offset:.2f}s (time diff: {(sample_offset - db_offset):.2f}s)')
-                            if song_id not in matches:
-                                matches[song_id] = {
-                                    'name': song_name,
-                                    'offsets': []
-                                }
-                            matches[song_id]['offsets'].append(sample_offset - db_offset)
-                
-                print('\n' + '='*50)
-                print('ANALYZING MATCHES')
-                print('='*50)
-                print(f'Total fingerprint matches across all songs: {total_hash_matches}')
-                
-                best_match = None
-                highest_score = 0
-                
-                for song_id, data in matches.items():
-                    print(f'\nAnalyzing: "{data["name"]}"')
-                    print(f'Total matches: {len(data["offsets"])}')
-                    
-                    offset_histogram = {}
-                    for offset in data['offsets']:
-                        offset_histogram[offset] = offset_histogram.get(offset, 0) + 1
-                    
-                    print('Time difference histogram:')
-                    for offset, count in sorted(offset_histogram.items()):
-                        print(f'  {offset:.2f}s: {"*" * count} ({count} matches)')
-                    
-                    score = max(offset_histogram.values()) if offset_histogram else 0
-                    
-                    if score > highest_score:
-                        highest_score = score
-                        best_match = {
-                            'id': song_id,
-                            'name': data['name'],
-                            'score': score
-                        }
-                
-                confidence = (highest_score / len(sample_fingerprints)) * 100 if sample_fingerprints else 0
-                
-                print('\n' + '='*50)
-                print('FINAL RESULTS')
-                print('='*50)
-                print(f'Sample fingerprints: {len(sample_fingerprints)}')
-                print(f'Best matching song: {best_match["name"] if best_match else "None"}')
-                print(f'Highest matching score: {highest_score} fingerprints at same time offset')
-                print(f'Confidence: {confidence:.2f}%')
-                
-                response = {
-                    'matched': False,
-                    'confidence': confidence,
-                    'song': None,
-                    'songName': None,
-                    'song_id': None
-                }
-                
-                if best_match and confidence > 15 and highest_score > 1:
-                    print('\n✅ MATCH FOUND!')
-                    response.update({
-                        'matched': True,
-                        'song': best_match['name'],
-                        'songName': best_match['name'],
-                        'song_id': best_match['id']
-                    })
-                else:
-                    print('\n❌ NO CONFIDENT MATCH')
-                    if best_match:
-                        response.update({
-                            'song': best_match['name'],
-                            'songName': best_match['name'],
-                            'song_id': best_match['id']
-                        })
-                
-                return jsonify(response)
-                
-            finally:
-                # Cleanup
-                try:
-                    os.remove(filepath)
-                    os.rmdir(temp_dir)
-                except Exception as e:
-                    print(f'Error cleaning up: {str(e)}')
-        
-        return jsonify({'error': 'Invalid file type'}), 400
-        
+                sample_hashes, sample_offsets = decode_fingerprints(payload)
+            except ValueError as e:
+                MATCH_HASHES_REQUESTS.inc(result='error')
+                return jsonify({'error': str(e)}), 400
+            
+            cache_key = f'hashes:{hashlib.blake2b(payload, digest_size=16).hexdigest()}:{top_k}:{top_n}'
+            with db_pool.reader() as conn:
+                generation = refresh_catalog(conn)
+            cached = match_cache.get(cache_key, generation)
+            if cached is not None:
+                MATCH_HASHES_REQUESTS.inc(result='cached')
+                return jsonify(cached)
+            
+            response = match_fingerprints(sample_hashes, sample_offsets, top_k, top_n, endpoint='match_hashes',
+                                          deadline=deadline)
+    except Overloaded as e:
+        MATCH_HASHES_REQUESTS.inc(result='shed')
+        return overloaded_response(e)
+    except DeadlineExceeded as e:
+        MATCH_HASHES_REQUESTS.inc(result='deadline')
+        return deadline_response(e)
     except Exception as e:
-        print(f'Error in match_audio: {str(e)}')
+        logger.exception('Error in match_hashes')
+        MATCH_HASHES_REQUESTS.inc(result='error')
         return jsonify({'error': str(e)}), 500
+    MATCH_HASHES_REQUESTS.inc(result='matched' if response['matched'] else 'unmatched')
+    match_cache.put(cache_key, generation, response)
+    return jsonify(response)
+
+
+@app.route('/admin/snapshot', methods=['GET', 'POST'])
+def admin_snapshot():
+    """Show or swap the index snapshot this worker serves.
     
-    file = request.files['file']
+    POST reloads SNAPSHOT_PATH now, or with a JSON ``path`` inside the
+    snapshot directory verifies that snapshot, serves it and points
+    SNAPSHOT_PATH at it so the other workers follow. In-flight requests finish
+    on the previous snapshot. POST needs ADMIN_TOKEN, or a local client.
+    """
+    if snapshots is None:
+        return jsonify({'error': 'FINGERPRINT_ENGINE is not snapshot'}), 404
+    if request.method == 'POST':
+        if not admin_allowed():
+            return jsonify({'error': 'Forbidden'}), 403
+        path = (request.get_json(silent=True) or {}).get('path')
+        try:
+            snapshot = snapshots.publish(path) if path else snapshots.reload()
+        except (OSError, SnapshotError) as e:
+            logger.error(f'Snapshot swap failed: {e}')
+            return jsonify({'error': str(e), 'serving': snapshot_summary(snapshots.current())}), 400
+        return jsonify(snapshot_summary(snapshot))
+    return jsonify(snapshot_summary(snapshots.current()))
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus scrape endpoint for this worker."""
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss counters of this worker's /match cache."""
+    return jsonify(match_cache.stats())
+
+
+@app.route('/match_stream', methods=['POST'])
+def match_stream():
+    """Match raw PCM while it is still being uploaded.
     
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
-        
-    if file and allowed_file(file.filename):
-        # Create temporary file
-        temp_dir = tempfile.mkdtemp()
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(temp_dir, filename)
-        file.save(filepath)
-        
+    The body is little-endian 16-bit PCM, sent with chunked transfer encoding
+    as it is recorded; query parameters ``sample_rate`` (default 44100) and
+    ``channels`` (default 1) describe it. Fingerprints are looked up as soon
+    as each block is processed and the response is sent as soon as the best
+    song is confident enough, without waiting for the rest of the upload.
+    """
+    sample_rate = request.args.get('sample_rate', 44100, type=int)
+    channels = request.args.get('channels', 1, type=int)
+    if sample_rate < DSP_RATIO or channels < 1:
+        return jsonify({'error': 'Invalid sample_rate or channels'}), 400
+    
+    fingerprinter = StreamingFingerprinter(sample_rate)
+    matcher = StreamingMatcher(STREAM_OFFSET_BIN_MS)
+    frame_bytes = 2 * channels
+    pending = b''
+    answered_early = False
+    
+    with db_pool.reader() as conn:
         try:
-            # Load audio file using soundfile
-            samples, sample_rate = sf.read(filepath)
-            
-            # Convert to mono if stereo
-            if len(samples.shape) > 1:
-                samples = samples.mean(axis=1)
-            
-            # Ensure float64
-            samples = samples.astype(np.float64)
-            
-            # Generate spectrogram
-            spectrogram = create_spectrogram(samples, sample_rate)
-            
-            # Extract peaks
-            duration = len(samples) / sample_rate
-            peaks = extract_peaks(spectrogram, duration)
-            
-            # Generate fingerprints (use 0 as temporary song_id)
-            sample_fingerprints = generate_fingerprints(peaks, 0)
-            
-            # Match against database
-            print('\n' + '='*50)
-            print('MATCHING PROCESS STARTED')
-            print('='*50)
-            print(f'Sample has {len(sample_fingerprints)} fingerprints')
-            
-            conn = sqlite3.connect(DATABASE_PATH)
-            c = conn.cursor()
-            
-            matches = {}
-            total_hash_matches = 0
-            
-            # Track all fingerprint matches
-            print('\nFINGERPRINT MATCHES:')
-            print('-'*30)
-            
-            for hash_value, (sample_offset, _) in sample_fingerprints.items():
-                # Find matching fingerprints
-                c.execute('''
-                    SELECT f.song_id, f.offset, s.name 
-                    FROM fingerprints f 
-                    JOIN songs s ON f.song_id = s.id 
-                    WHERE f.hash = ?
-                ''', (hash_value,))
-                results = c.fetchall()
-                if results:
-                    total_hash_matches += len(results)
-                    print(f'\nHash {hash_value}:')
-                    print(f'  Sample offset: {sample_offset:.2f}s')
-                    for song_id, db_offset, song_name in results:
-                        print(f'  → Matched in "{song_name}" at {db_offset:.2f}s (time diff: {(sample_offset - db_offset):.2f}s)')
-                
-                for song_id, db_offset, song_name in c.fetchall():
-                    if song_id not in matches:
-                        matches[song_id] = {
-                            'name': song_name,
-                            'offsets': []
-                        }
-                    matches[song_id]['offsets'].append(sample_offset - db_offset)
-            
-            # Find best match
-            print('\n' + '='*50)
-            print('ANALYZING MATCHES')
-            print('='*50)
-            print(f'Total fingerprint matches across all songs: {total_hash_matches}')
-            
-            best_match = None
-            highest_score = 0
-            
-            for song_id, data in matches.items():
-                print(f'\nAnalyzing: "{data["name"]}"')
-                print(f'Total matches: {len(data["offsets"])}')
-                
-                # Enhanced offset grouping with weighted scoring
-                offset_histogram = {}
-                for offset in data['offsets']:
-                    # Use smaller intervals (0.05s) for more precise grouping
-                    rounded_offset = round(offset * 20) / 20
-                    # Add weighted score based on how close offsets are
-                    for nearby_offset in np.arange(rounded_offset - 0.3, rounded_offset + 0.3, 0.05):
-                        weight = 1.0 - (abs(nearby_offset - rounded_offset) / 0.3)  # Linear weight decay
-                        if weight > 0:
-                            offset_histogram[round(nearby_offset * 20) / 20] = \
-                                offset_histogram.get(round(nearby_offset * 20) / 20, 0) + weight
-                
-                print('Time difference histogram (grouped by 0.1s intervals):')
-                for offset, count in sorted(offset_histogram.items()):
-                    print(f'  {offset:.1f}s: {"*" * count} ({count} matches)')
-                
-                # Filter out matches with unreasonable time offsets
-                # We expect offsets to be within the song duration (plus some margin)
-                valid_offsets = []
-                for offset in data['offsets']:
-                    # Typical song is under 10 minutes (600 seconds)
-                    # Allow for some margin of error (±1000 seconds)
-                    if abs(offset) < 1000:
-                        valid_offsets.append(offset)
-                
-                # Update offsets with only valid ones
-                data['offsets'] = valid_offsets
-                total_matches = len(valid_offsets)
-                
-                if total_matches < 3:  # Require at least 3 valid matches
-                    continue
-                
-                # Calculate match density for valid matches
-                match_density = total_matches / (sample_duration / 1000) if sample_duration > 0 else 0
-                
-                # Calculate temporal consistency
-                sorted_offsets = sorted(valid_offsets)
-                if len(sorted_offsets) > 1:
-                    # Calculate gaps between consecutive matches
-                    gaps = np.diff(sorted_offsets)
-                    mean_gap = np.mean(gaps)
-                    std_gap = np.std(gaps)
-                    
-                    # Consistency score (0-1) - lower std deviation means better consistency
-                    consistency = 1.0 / (1.0 + std_gap/mean_gap) if mean_gap != 0 else 0
-                else:
-                    consistency = 0
-                
-                # Calculate cluster score - how many matches are close together
-                clusters = {}
-                for offset in valid_offsets:
-                    # Round to nearest 0.1 second
-                    rounded = round(offset * 10) / 10
-                    clusters[rounded] = clusters.get(rounded, 0) + 1
-                
-                # Get the size of the largest cluster
-                largest_cluster = max(clusters.values()) if clusters else 0
-                
-                # Calculate cluster density (what percentage of matches are in the largest cluster)
-                cluster_density = largest_cluster / total_matches if total_matches > 0 else 0
-                
-                
-                # Calculate final score with adjusted weights
-                score = (
-                    largest_cluster * 0.4 +  # Weight for matches in best cluster
-                    (match_density * 10) * 0.3 +  # Weight for overall match density
-                    (consistency * total_matches) * 0.2 +  # Weight for temporal consistency
-                    (cluster_density * total_matches) * 0.1  # Weight for cluster quality
-                )
-                
-                # Only consider as potential match if we have good cluster density
-                if cluster_density < 0.3:  # At least 30% of matches should be in the main cluster
+            refresh_catalog(conn)
+            while True:
+                block = request.stream.read(STREAM_READ_BYTES)
+                if not block:
+                    break
+                
+                # Decode whole sample frames only; a split frame waits for the next block
+                pending += block
+                usable = len(pending) - len(pending) % frame_bytes
+                pcm = np.frombuffer(pending[:usable], dtype='<i2').reshape(-1, channels)
+                pending = pending[usable:]
+                
+                hashes, offsets = fingerprinter.feed(pcm.mean(axis=1) / 32768.0)
+                if HASH_STOP_MODE == 'drop':
+                    keep = ~stop_list.contains(hashes)
+                    hashes, offsets = hashes[keep], offsets[keep]
+                if len(hashes) == 0:
                     continue
-                
-                if score > highest_score:
-                    highest_score = score
-                    best_match = {
-                        'id': song_id,
-                        'name': data['name'],
-                        'score': score
-                    }
-            
-            # Calculate expected fingerprints dynamically based on audio characteristics
-            sample_duration = max([offset for offset, _ in sample_fingerprints.values()]) if sample_fingerprints else 0
-            # Base expectation on actual fingerprints generated for full songs
-            c.execute('''
-                SELECT AVG(fingerprint_count) / AVG(duration) as fps 
-                FROM (
-                    SELECT song_id, COUNT(*) as fingerprint_count, MAX(offset)/1000.0 as duration
-                    FROM fingerprints 
-                    GROUP BY song_id
-                )
-            ''')
-            avg_fingerprints_per_second = c.fetchone()[0] or 10  # fallback to 10 if no data
-            expected_fingerprints = (sample_duration / 1000) * avg_fingerprints_per_second
-            
-            # Enhanced confidence calculation with relative metrics
-            if expected_fingerprints > 0 and sample_fingerprints:
-                # Get match statistics for best match
-                if best_match:
-                    match_data = matches[best_match['id']]
-                    total_matches = len(match_data['offsets'])
-                    
-                    # Calculate relative match ratio (compared to sample length)
-                    relative_match_ratio = total_matches / len(sample_fingerprints)
-                    
-                    # Calculate time alignment consistency
-                    sorted_offsets = sorted(match_data['offsets'])
-                    if len(sorted_offsets) > 1:
-                        time_diff_std = np.std(sorted_offsets)
-                        time_consistency = 1.0 / (1.0 + time_diff_std)  # Closer to 1 if offsets are consistent
-                    else:
-                        time_consistency = 0
-                
-                # Calculate coverage score (0-1)
-                # How well the matches are distributed across the sample duration
-                match_times = sorted([offset for offset, _ in sample_fingerprints.values()])
-                if len(match_times) > 1:
-                    avg_gap = sample_duration / (len(match_times) - 1)
-                    actual_gaps = [match_times[i+1] - match_times[i] for i in range(len(match_times)-1)]
-                    gap_consistency = 1.0 - (np.std(actual_gaps) / avg_gap if avg_gap > 0 else 1.0)
-                else:
-                    gap_consistency = 0.0
-                
-                # Combine scores with weights
-                raw_confidence = highest_score / expected_fingerprints
-                weighted_confidence = (
-                    raw_confidence * 0.6 +  # Base confidence from number of matches
-                    time_consistency * 0.25 +  # Time alignment quality
-                    gap_consistency * 0.15  # Distribution of matches
-                ) * 100
-                
-                confidence = min(100, weighted_confidence)  # Cap at 100%
-            else:
-                confidence = 0
-            
-            print('\n' + '='*50)
-            print('FINAL RESULTS')
-            print('='*50)
-            print(f'Sample duration: {sample_duration/1000:.2f} seconds')
-            print(f'Sample fingerprints: {len(sample_fingerprints)}')
-            print(f'Expected fingerprints: {expected_fingerprints:.0f}')
-            print(f'Best matching song: {best_match["name"] if best_match else "None"}')
-            print(f'Highest matching score: {highest_score} fingerprints at same time offset')
-            print(f'Confidence: {confidence:.2f}%')
-            
-            # Prepare response
-            response = {
-                'matched': False,
-                'confidence': confidence,
-                'song': None,
-                'songName': None,
-                'song_id': None
-            }
-            
-            # Stricter adaptive thresholds
-            sample_length_factor = max(0.3, min(1.0, sample_duration / 10000))
-            min_matches = max(10, int(sample_duration/1000))  # At least 10 matches or 1 match per second
-            min_cluster_size = max(5, min_matches * 0.3)  # At least 30% of min_matches in largest cluster
-            
-            # Calculate match quality metrics
-            if best_match:
-                match_data = matches[best_match['id']]
-                valid_matches = len([x for x in match_data['offsets'] if abs(x) < 1000])
-                largest_match_cluster = max(clusters.values()) if 'clusters' in locals() and clusters else 0
-            
-            is_match = (
-                best_match and 
-                confidence > (15 * (1/sample_length_factor)) and  # Increased confidence threshold
-                valid_matches >= min_matches and  # Must have enough valid matches
-                largest_match_cluster >= min_cluster_size and  # Must have a good cluster
-                ('cluster_density' in locals() and cluster_density >= 0.3)  # Must have concentrated matches
-            )
-            
-            if is_match:
-                print('\n✅ MATCH FOUND!')
-                response.update({
-                    'matched': True,
-                    'song': best_match['name'],
-                    'songName': best_match['name'],
-                    'song_id': best_match['id']
-                })
-            else:
-                print('\n❌ NO CONFIDENT MATCH')
-                if best_match:
-                    response.update({
-                        'song': best_match['name'],
-                        'songName': best_match['name'],
-                        'song_id': best_match['id']
-                    })
-            
-            return jsonify(response)
-            
-            # Prepare response
-            response = {
-                'matched': False,
-                'confidence': confidence,
-                'song': None,
-                'songName': None,
-                'song_id': None
-            }
-            
+                song_ids, db_offsets, sample_offsets, _ = lookup_hits(conn, hashes.tolist(), offsets.tolist())
+                matcher.update(song_ids, db_offsets, sample_offsets, len(hashes))
+                
+                best = matcher.best()
+                if best and best[1] >= STREAM_MIN_SCORE and best[1] >= STREAM_MIN_MARGIN * matcher.runner_up_score():
+                    answered_early = True
+                    break
+            
+            best = matcher.best()
+            song_name = None
+            if best:
+                song_name = song_names(conn, [best[0]]).get(best[0])
         except Exception as e:
-            print(f"Error matching audio: {str(e)}")
+            logger.exception('Error in match_stream')
             return jsonify({'error': str(e)}), 500
-            
-        finally:
-            # Cleanup
-            try:
-                os.remove(filepath)
-                os.rmdir(temp_dir)
-            except Exception as e:
-                print(f"Error cleaning up: {str(e)}")
     
-    return jsonify({'error': 'Invalid file type'}), 400
+    confidence = matcher.confidence
+    response = {
+        'matched': answered_early or bool(best and confidence > 15 and best[1] > 1),
+        'confidence': confidence,
+        'song': song_name,
+        'songName': song_name,
+        'song_id': best[0] if best else None,
+        'audio_seconds': fingerprinter.samples_seen / sample_rate,
+        'early': answered_early
+    }
+    logger.info(f"match_stream: {response['song']} ({confidence:.1f}%) after {response['audio_seconds']:.1f}s of audio")
+    return jsonify(response)
 
-# Initialize database
-init_db()
+
+@app.route('/scan', methods=['POST'])
+def scan_recording():
+    """Find every catalog song played in a long recording.
+    
+    The uploaded file is read in blocks and fingerprinted in one streaming
+    pass, so memory use does not grow with its length. Optional ``window``
+    and ``hop`` parameters set the matching window and its step in seconds.
+    Returns the timeline of detected songs.
+    """
+    if 'file' not in request.files or request.files['file'].filename == '':
+        return jsonify({'error': 'No file part'}), 400
+    window = request.values.get('window', SCAN_WINDOW_SECONDS, type=float)
+    hop = request.values.get('hop', SCAN_HOP_SECONDS, type=float)
+    if not 0 < hop <= window:
+        return jsonify({'error': 'hop must be positive and no longer than window'}), 400
+    
+    def lookup(hashes, offsets):
+        if HASH_STOP_MODE == 'drop':
+            keep = ~stop_list.contains(hashes)
+            hashes, offsets = hashes[keep], offsets[keep]
+        return lookup_hits(conn, hashes.tolist(), offsets.tolist())
+    
+    start = time.perf_counter()
+    with db_pool.reader() as conn:
+        try:
+            refresh_catalog(conn)
+            blocks, sample_rate, _ = read_audio_blocks(request.files['file'].stream, SCAN_BLOCK_FRAMES)
+            segments = list(scan_blocks(blocks, sample_rate, lookup, window=window, hop=hop,
+                                        duration=lambda song_id: song_durations(conn, [song_id]).get(song_id)))
+            names = song_names(conn, sorted({segment['song_id'] for segment in segments}))
+            for segment in segments:
+                segment['name'] = names.get(segment['song_id'])
+        except AudioDecodeError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            logger.exception('Error in scan')
+            return jsonify({'error': str(e)}), 500
+    
+    logger.info(f'scan: {len(segments)} segments in {time.perf_counter() - start:.1f}s')
+    return jsonify({'segments': segments})
+
+# Create or migrate the database schema, keeping existing data
+init_db(DATABASE_PATH)
+
+if HASH_STOP_MODE not in STOP_MODES:
+    raise ValueError(f'Unknown HASH_STOP_MODE: {HASH_STOP_MODE}')
+
+_conn = connect(DATABASE_PATH)
+try:
+    if fingerprint_version(_conn) != FINGERPRINT_VERSION:
+        logger.warning(
+            f'{DATABASE_PATH} holds fingerprints from algorithm version {fingerprint_version(_conn)}, '
+            f'but this server computes version {FINGERPRINT_VERSION}; clear the database and add '
+            f'the songs again, or they will not match'
+        )
+finally:
+    _conn.close()
+
+if FINGERPRINT_ENGINE == 'memory':
+    _conn = connect(DATABASE_PATH)
+    try:
+        memory_index = load_or_build(_conn, INDEX_DIR)
+        memory_generation, memory_rowid, memory_epoch = (catalog_generation(_conn), last_rowid(_conn),
+                                                         catalog_epoch(_conn))
+    finally:
+        _conn.close()
+elif FINGERPRINT_ENGINE == 'sharded':
+    shard_index = ShardedIndex(SHARD_DIR)
+elif FINGERPRINT_ENGINE == 'snapshot':
+    snapshots = LiveSnapshot(SNAPSHOT_PATH, FINGERPRINT_VERSION, SNAPSHOT_VERIFY, SNAPSHOT_CHECK_SECONDS)
+    snapshots.install_signal_handler()
+elif FINGERPRINT_ENGINE != 'sqlite':
+    raise ValueError(f'Unknown FINGERPRINT_ENGINE: {FINGERPRINT_ENGINE}')
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
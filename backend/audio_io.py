@@ -0,0 +1,160 @@
+"""Decoding of uploaded audio straight from memory.
+
+Formats libsndfile understands (wav, flac, ogg, and mp3 with libsndfile 1.1+)
+are read from an in-memory buffer. Anything else, such as the m4a files the
+mobile recorder produces, is piped through an external decoder (ffmpeg by
+default) that writes raw mono float32 PCM to stdout, so uploads never touch
+the disk.
+"""
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+from flask import Request
+
+DECODER = os.environ.get('AUDIO_DECODER', 'ffmpeg')
+DECODER_SAMPLE_RATE = 44100  # Output rate of the external decoder
+DECODER_TIMEOUT = 120  # seconds
+
+# Uploads up to this size stay in memory while the form is parsed
+UPLOAD_SPOOL_BYTES = 64 * 1024 * 1024
+
+
+class AudioDecodeError(Exception):
+    """Raised when uploaded data cannot be decoded as audio."""
+
+
+class InMemoryUploadRequest(Request):
+    """Request that buffers file uploads in memory instead of spooling them to disk."""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='rb+')
+
+
+def decode_audio(data: bytes, sample_rate: int = DECODER_SAMPLE_RATE) -> Tuple[np.ndarray, int]:
+    """Decode an audio file held in memory to mono float32 samples.
+    
+    Returns ``(samples, sample_rate)``. Files libsndfile can read keep their
+    native rate; files handed to the external decoder are converted to
+    `sample_rate` in the same pass.
+    """
+    try:
+        samples, native_rate = sf.read(io.BytesIO(data), dtype='float32', always_2d=True)
+    except (sf.LibsndfileError, RuntimeError, TypeError):
+        return _decode_with_subprocess(data, sample_rate), sample_rate
+    
+    # Convert to mono
+    if samples.shape[1] == 1:
+        return samples[:, 0], native_rate
+    return samples.mean(axis=1, dtype=np.float32), native_rate
+
+
+def _decode_with_subprocess(data: bytes, sample_rate: int) -> np.ndarray:
+    """Decode with the external decoder to mono float32 at `sample_rate`."""
+    output_args = ['-f', 'f32le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+    command = [DECODER, '-hide_banner', '-loglevel', 'error']
+    
+    # MP4/M4A files often keep their index at the end, which a pipe cannot seek
+    # to, so hand the decoder an in-memory file where the platform has one
+    memfd = _memory_file(data)
+    try:
+        if memfd is not None:
+            command += ['-i', f'/proc/self/fd/{memfd}'] + output_args
+            result = subprocess.run(command, capture_output=True, pass_fds=(memfd,), timeout=DECODER_TIMEOUT)
+        else:
+            command += ['-i', 'pipe:0'] + output_args
+            result = subprocess.run(command, input=data, capture_output=True, timeout=DECODER_TIMEOUT)
+    except FileNotFoundError:
+        raise AudioDecodeError(f'Unsupported audio format and decoder {DECODER!r} is not installed')
+    except subprocess.TimeoutExpired:
+        raise AudioDecodeError('Timed out decoding audio')
+    finally:
+        if memfd is not None:
+            os.close(memfd)
+    
+    if result.returncode != 0:
+        message = result.stderr.decode(errors='replace').strip().splitlines()
+        raise AudioDecodeError(message[-1] if message else 'Could not decode audio')
+    return np.frombuffer(result.stdout, dtype='<f4')
+
+
+def read_audio_blocks(source, blocksize: int = 65536,
+                      sample_rate: int = DECODER_SAMPLE_RATE) -> Tuple[Iterator[np.ndarray], int, Optional[int]]:
+    """Read a long recording as consecutive blocks of mono float32 samples.
+    
+    `source` is a path or a seekable binary file object. Returns
+    ``(blocks, sample_rate, num_samples)``; only one block is held in memory
+    at a time. Formats libsndfile cannot read are streamed through the
+    external decoder at `sample_rate`, and their length is None.
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        info = sf.info(source)
+    except (sf.LibsndfileError, RuntimeError, TypeError):
+        if position is not None:
+            source.seek(position)
+        return _decoder_blocks(source, blocksize, sample_rate), sample_rate, None
+    if position is not None:
+        source.seek(position)
+    
+    def blocks():
+        for block in sf.blocks(source, blocksize=blocksize, dtype='float32', always_2d=True):
+            yield block[:, 0] if block.shape[1] == 1 else block.mean(axis=1, dtype=np.float32)
+    return blocks(), info.samplerate, info.frames
+
+
+def _decoder_blocks(source, blocksize: int, sample_rate: int) -> Iterator[np.ndarray]:
+    """Stream `source` through the external decoder, `blocksize` samples at a time."""
+    command = [DECODER, '-hide_banner', '-loglevel', 'error', '-i',
+               source if isinstance(source, (str, os.PathLike)) else 'pipe:0',
+               '-f', 'f32le', '-ac', '1', '-ar', str(sample_rate), 'pipe:1']
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL if isinstance(source, (str, os.PathLike))
+                                   else subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        raise AudioDecodeError(f'Unsupported audio format and decoder {DECODER!r} is not installed')
+    
+    # Feed file objects from a thread so the decoder's output is read as it comes
+    if process.stdin is not None:
+        def feed():
+            try:
+                shutil.copyfileobj(source, process.stdin)
+            except OSError:
+                pass
+            finally:
+                process.stdin.close()
+        threading.Thread(target=feed, daemon=True).start()
+    
+    try:
+        while True:
+            data = process.stdout.read(blocksize * 4)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype='<f4')
+        if process.wait() != 0:
+            message = process.stderr.read().decode(errors='replace').strip().splitlines()
+            raise AudioDecodeError(message[-1] if message else 'Could not decode audio')
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+def _memory_file(data: bytes):
+    """Anonymous in-memory file holding `data`, or None if unsupported."""
+    if not hasattr(os, 'memfd_create'):
+        return None
+    fd = os.memfd_create('upload')
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+    os.lseek(fd, 0, os.SEEK_SET)
+    return fd
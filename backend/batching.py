@@ -0,0 +1,106 @@
+"""Micro-batching of concurrent fingerprint lookups.
+
+Under load many /match requests arrive within a few milliseconds of each
+other, and each would run its own lookup. Request threads instead hand their
+query fingerprints to a `LookupBatcher`. Its thread collects everything that
+arrives within `max_wait` seconds (up to `max_batch` requests), looks up the
+distinct hashes of the whole batch once, and hands each request its own
+postings back. Scoring then runs in the request threads as before.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Tuple
+
+import numpy as np
+
+from matching import expand_postings
+from metrics import MATCH_BATCH_REQUESTS, MATCH_BATCH_FINGERPRINTS, MATCH_BATCH_QUEUE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class LookupBatcher:
+    """Batches `lookup(conn, hashes, offsets)` calls from many request threads.
+    
+    `connect` opens the connection used by the batching thread. The thread is
+    started on first use in each process, so a server that forks workers after
+    creating the batcher gets one thread per worker.
+    """
+    
+    def __init__(self, lookup: Callable, connect: Callable, max_batch: int = 32, max_wait: float = 0.002):
+        self.lookup = lookup
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+    
+    def _ensure_thread(self) -> queue.Queue:
+        with self._start_lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), name='lookup-batcher', daemon=True).start()
+            return self._queue
+    
+    def submit(self, hashes, sample_offsets) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Look up one query as part of the next batch; blocks until it is done.
+        
+        Same contract as `matching.lookup_fingerprints`.
+        """
+        future = Future()
+        item = (np.asarray(hashes, dtype=np.int64), np.asarray(sample_offsets, dtype=np.int64),
+                time.perf_counter(), future)
+        self._ensure_thread().put(item)
+        return future.result()
+    
+    def _run(self, requests: queue.Queue) -> None:
+        conn = self.connect()
+        last_size = 1
+        while True:
+            batch = [requests.get()]
+            # When idle, a lone request is looked up at once instead of waiting
+            wait = self.max_wait if last_size > 1 or not requests.empty() else 0
+            deadline = time.perf_counter() + wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(requests.get(timeout=remaining) if remaining > 0 else requests.get_nowait())
+                except queue.Empty:
+                    break
+            last_size = len(batch)
+            try:
+                self._lookup_batch(conn, batch)
+            except Exception as e:
+                logger.exception('Batched lookup failed')
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+    
+    def _lookup_batch(self, conn, batch) -> None:
+        started = time.perf_counter()
+        for _, _, submitted, _ in batch:
+            MATCH_BATCH_QUEUE_SECONDS.observe(started - submitted)
+        
+        # One lookup for the distinct hashes of every request in the batch
+        all_hashes = np.concatenate([hashes for hashes, *_ in batch])
+        unique, inverse = np.unique(all_hashes, return_inverse=True)
+        inverse = inverse.ravel()
+        MATCH_BATCH_REQUESTS.observe(len(batch))
+        MATCH_BATCH_FINGERPRINTS.observe(len(all_hashes), kind='fingerprints')
+        MATCH_BATCH_FINGERPRINTS.observe(len(unique), kind='distinct')
+        song_ids, db_offsets, _, unique_idx = self.lookup(conn, unique.tolist(), [0] * len(unique))
+        song_ids, db_offsets, entry_idx = expand_postings(inverse, song_ids, db_offsets, unique_idx, len(unique))
+        
+        # Split the postings back per request; entries are in request order
+        bounds = np.cumsum([0] + [len(hashes) for hashes, *_ in batch])
+        splits = np.searchsorted(entry_idx, bounds)
+        for i, (_, offsets, _, future) in enumerate(batch):
+            hits = slice(splits[i], splits[i + 1])
+            query_idx = entry_idx[hits] - bounds[i]
+            future.set_result((song_ids[hits], db_offsets[hits], offsets[query_idx], query_idx))
@@ -0,0 +1,4 @@
+"""Offline benchmarks for the fingerprinting backend.
+
+Run from the ``backend`` directory, e.g. ``python -m benchmarks.fingerprint_stages``.
+"""
@@ -0,0 +1,59 @@
+"""Scoring cost with and without top-K candidate pruning.
+
+Simulates the hits of one query against catalogs where popular hashes are
+shared by many songs: the true song has a run of aligned hits, every other
+song a scattering of unaligned ones. Times `rank_candidates` aligning every
+candidate (``top_k=None``) against pruning to the top K by hit count first,
+and checks that both pick the same song.
+
+Usage:
+    python -m benchmarks.candidate_pruning [--songs 1000 10000 100000] [--top-k 50]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from matching import rank_candidates
+
+
+def simulate_hits(rng, num_songs, hits_per_song=20, aligned_hits=60):
+    """Hits of a query whose true song is 1, against `num_songs` candidates."""
+    background = rng.integers(2, num_songs + 2, size=num_songs * hits_per_song)
+    song_ids = np.concatenate([np.ones(aligned_hits, dtype=np.int64), background])
+    sample_offsets = rng.integers(0, 10000, size=len(song_ids))
+    db_offsets = rng.integers(0, 240000, size=len(song_ids))
+    db_offsets[:aligned_hits] = sample_offsets[:aligned_hits] + 31337
+    order = rng.permutation(len(song_ids))
+    return song_ids[order], db_offsets[order], sample_offsets[order], np.arange(len(song_ids))
+
+
+def timed(runs, func, *args, **kwargs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return result, np.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Candidate songs sharing at least one hash with the query')
+    parser.add_argument('--top-k', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    
+    rng = np.random.default_rng(0)
+    print(f'{"candidates":>11}{"hits":>10}{"all":>12}{"top-" + str(args.top_k):>12}{"same best":>11}')
+    for num_songs in args.songs:
+        hits = simulate_hits(rng, num_songs)
+        full, full_ms = timed(args.runs, rank_candidates, *hits, top_k=None, top_n=1)
+        pruned, pruned_ms = timed(args.runs, rank_candidates, *hits, top_k=args.top_k, top_n=1)
+        same = full[0]['song_id'] == pruned[0]['song_id'] and full[0]['score'] == pruned[0]['score']
+        print(f'{num_songs:>11,}{len(hits[0]):>10,}{full_ms:>10.1f}ms{pruned_ms:>10.1f}ms{str(same):>11}')
+
+
+if __name__ == '__main__':
+    main()
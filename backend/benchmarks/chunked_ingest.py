@@ -0,0 +1,83 @@
+"""Peak memory of fingerprinting a long track whole versus block by block.
+
+Writes a long synthetic stereo WAV, then fingerprints it the way /add did
+before (decode the whole file, then run the batch pipeline) and with the
+chunked path (`read_audio_blocks` + `fingerprint_blocks`). Reports the time
+and the peak traced memory of each, and fails if the two paths produce
+different fingerprints.
+
+Usage:
+    python -m benchmarks.chunked_ingest [--minutes 10 20] [--sample-rate 48000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+from audio_io import decode_audio, read_audio_blocks
+from benchmarks.synthetic import synthetic_song
+from shazam_fingerprint import fingerprint_blocks, fingerprint_samples
+
+SEGMENT_SECONDS = 30
+
+
+def write_long_wav(path, minutes, sample_rate):
+    """Stereo 16-bit WAV of `minutes` of synthetic songs, written segment by segment."""
+    with sf.SoundFile(path, 'w', sample_rate, 2, 'PCM_16') as wav:
+        for i in range(int(np.ceil(minutes * 60 / SEGMENT_SECONDS))):
+            left = synthetic_song(i, SEGMENT_SECONDS, sample_rate)
+            wav.write(np.stack((left, np.roll(left, 7)), axis=1))
+
+
+def whole_file(path):
+    with open(path, 'rb') as audio_file:
+        samples, sample_rate = decode_audio(audio_file.read())
+    return fingerprint_samples(samples, sample_rate)
+
+
+def chunked(path):
+    blocks, sample_rate, num_samples = read_audio_blocks(path)
+    return fingerprint_blocks(blocks, sample_rate, num_samples)
+
+
+def measure(method, path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    hashes, offsets = method(path)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, np.sort(hashes.astype(np.uint64) << 32 | offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--minutes', type=float, nargs='+', default=[10, 20])
+    parser.add_argument('--sample-rate', type=int, default=48000)
+    args = parser.parse_args()
+    
+    failed = False
+    print(f'{"minutes":>8}{"method":>12}{"time":>10}{"peak memory":>14}{"fingerprints":>14}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in args.minutes:
+            path = os.path.join(tmp, f'long_{minutes}.wav')
+            write_long_wav(path, minutes, args.sample_rate)
+            results = {}
+            for name, method in (('whole-file', whole_file), ('chunked', chunked)):
+                seconds, peak, fingerprints = measure(method, path)
+                results[name] = fingerprints
+                print(f'{minutes:>8g}{name:>12}{seconds:>9.2f}s{peak / 2**20:>11.1f}MiB{len(fingerprints):>14}')
+            if not np.array_equal(results['whole-file'], results['chunked']):
+                print(f'{minutes:>8g}  MISMATCH between whole-file and chunked fingerprints')
+                failed = True
+            os.remove(path)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Latency of concurrent small /match lookups with per-request and pooled connections.
+
+Builds a synthetic fingerprint database, then runs small lookups plus the
+song-name query of /match from several client threads at once: first opening
+and closing a connection per request as /match used to, then borrowing warm
+read-only connections from a `ConnectionPool`.
+
+Usage:
+    python -m benchmarks.connection_pool [--songs 10000] [--clients 1 8 32]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+from benchmarks.match_lookup import build_catalog, make_query
+from database import ConnectionPool, connect, init_db
+from matching import find_best_match, lookup_fingerprints
+
+
+def match(conn, query_hashes, query_offsets):
+    result = find_best_match(*lookup_fingerprints(conn, query_hashes, query_offsets))
+    if result is None:
+        return None
+    conn.execute('SELECT id, name FROM songs WHERE id IN (?)', (result[0],)).fetchall()
+    return result[0]
+
+
+def per_request(path):
+    @contextmanager
+    def borrow():
+        conn = connect(path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    return borrow
+
+
+def run_clients(queries, borrow, clients):
+    latencies = [None] * len(queries)
+    found = [None] * len(queries)
+    
+    def client(first):
+        for i in range(first, len(queries), clients):
+            _, query_hashes, query_offsets = queries[i]
+            start = time.perf_counter()
+            with borrow() as conn:
+                found[i] = match(conn, query_hashes, query_offsets)
+            latencies[i] = time.perf_counter() - start
+    
+    threads = [threading.Thread(target=client, args=(first,)) for first in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.array(latencies) * 1000, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--fingerprints-per-song', type=int, default=100)
+    parser.add_argument('--query-size', type=int, default=20, help='Song hashes per query')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'catalog.db')
+        hashes, offsets = build_catalog(path, args.songs, args.fingerprints_per_song)
+        init_db(path)
+        rng = np.random.default_rng(1)
+        queries = [make_query(rng, hashes, offsets, args.query_size) for _ in range(args.queries)]
+        expected = [song for song, _, _ in queries]
+        
+        print(f'{"clients":>8}{"connections":>14}{"req/s":>10}{"p50":>12}{"p99":>12}{"correct":>10}')
+        for clients in args.clients:
+            pool = ConnectionPool(path, max_idle=clients)
+            for name, borrow in (('per-request', per_request(path)), ('pooled', pool.reader)):
+                elapsed, latencies, found = run_clients(queries, borrow, clients)
+                correct = sum(song == want for song, want in zip(found, expected))
+                print(f'{clients:>8}{name:>14}{len(queries) / elapsed:>10.0f}'
+                      f'{np.percentile(latencies, 50):>10.2f}ms{np.percentile(latencies, 99):>10.2f}ms'
+                      f'{correct:>6}/{len(queries)}')
+            pool.close()
+
+
+if __name__ == '__main__':
+    main()
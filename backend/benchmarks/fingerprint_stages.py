@@ -0,0 +1,170 @@
+"""Per-stage speed of the array-based fingerprinting pipeline.
+
+Runs the loop-based reference implementation next to the array-based one in
+``shazam_fingerprint``, checks that both produce exactly the same hashes and
+prints the speedup for every stage.
+
+Usage:
+    python -m benchmarks.fingerprint_stages [audio_file ...] [--seconds 240]
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy import signal
+import soundfile as sf
+
+import shazam_fingerprint as sfp
+from shazam_fingerprint import (
+    DSP_RATIO, FREQ_BIN_SIZE, HOP_SIZE, MAX_FREQ, TARGET_ZONE_SIZE
+)
+
+
+# Reference implementation (the original per-sample / per-bin loops)
+
+def reference_low_pass_filter(cutoff_frequency, sample_rate, input_signal):
+    rc = 1.0 / (2 * np.pi * cutoff_frequency)
+    dt = 1.0 / sample_rate
+    alpha = dt / (rc + dt)
+    filtered_signal = np.zeros_like(input_signal)
+    prev_output = 0.0
+    for i, x in enumerate(input_signal):
+        if i == 0:
+            filtered_signal[i] = x * alpha
+        else:
+            filtered_signal[i] = alpha * x + (1 - alpha) * prev_output
+        prev_output = filtered_signal[i]
+    return filtered_signal
+
+
+def reference_downsample(input_signal, original_sample_rate, target_sample_rate):
+    ratio = original_sample_rate // target_sample_rate
+    return np.array([np.mean(input_signal[i:i + ratio])
+                     for i in range(0, len(input_signal), ratio)])
+
+
+def reference_stft(downsampled_samples):
+    num_windows = len(downsampled_samples) // (FREQ_BIN_SIZE - HOP_SIZE)
+    window = np.hamming(FREQ_BIN_SIZE)
+    spectrogram = []
+    for i in range(num_windows):
+        start = i * HOP_SIZE
+        end = min(start + FREQ_BIN_SIZE, len(downsampled_samples))
+        bin_samples = np.zeros(FREQ_BIN_SIZE)
+        bin_samples[:end - start] = downsampled_samples[start:end]
+        spectrogram.append(np.fft.fft(bin_samples * window))
+    return np.array(spectrogram)
+
+
+def reference_extract_peaks(spectrogram, audio_duration):
+    if len(spectrogram) < 1:
+        return []
+    peaks = []  # (time, freq_bin, magnitude)
+    bin_duration = audio_duration / len(spectrogram)
+    for bin_idx, bin_data in enumerate(spectrogram):
+        bin_band_maxies = []
+        for band_min, band_max in sfp.BANDS:
+            max_mag = 0.0
+            max_freq = 0j
+            max_freq_idx = band_min
+            for idx, freq in enumerate(bin_data[band_min:band_max], start=band_min):
+                magnitude = abs(freq)
+                if magnitude > max_mag:
+                    max_mag = magnitude
+                    max_freq = freq
+                    max_freq_idx = idx
+            bin_band_maxies.append((max_mag, max_freq, max_freq_idx))
+        avg = np.mean([x[0] for x in bin_band_maxies])
+        for max_mag, max_freq, freq_idx in bin_band_maxies:
+            if max_mag > avg:
+                peak_time_in_bin = freq_idx * bin_duration / len(bin_data)
+                peaks.append((bin_idx * bin_duration + peak_time_in_bin, freq_idx, max_mag))
+    return peaks
+
+
+def reference_generate_fingerprints(peaks):
+    fingerprints = []  # (hash, anchor_time_ms), duplicates kept
+    for i, (anchor_time, anchor_bin, _) in enumerate(peaks):
+        anchor_ms = int(anchor_time * 1000)
+        for target_time, target_bin, _ in peaks[i + 1:i + TARGET_ZONE_SIZE + 1]:
+            delta_ms = int(target_time * 1000) - anchor_ms
+            fingerprints.append(((anchor_bin << 23) | (target_bin << 14) | (delta_ms & 0x3FFF), anchor_ms))
+    return fingerprints
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def synthetic_track(seconds, sample_rate=44100, seed=0):
+    """Tone/chirp/noise mix standing in for a real track."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * 440 * t)
+    audio += 0.2 * signal.chirp(t, 200, t[-1], 3000)
+    audio += 0.05 * rng.standard_normal(len(t))
+    return audio, sample_rate
+
+
+def benchmark(samples, sample_rate):
+    duration = len(samples) / sample_rate
+    target_rate = sample_rate // DSP_RATIO
+
+    ref_filtered, ref_filter_time = timed(reference_low_pass_filter, MAX_FREQ, sample_rate, samples)
+    new_filtered, new_filter_time = timed(sfp.low_pass_filter, MAX_FREQ, sample_rate, samples)
+
+    ref_down, ref_down_time = timed(reference_downsample, ref_filtered, sample_rate, target_rate)
+    new_down, new_down_time = timed(sfp.downsample, new_filtered, sample_rate, target_rate)
+
+    ref_spec, ref_stft_time = timed(reference_stft, ref_down)
+    new_spec, new_stft_time = timed(sfp.compute_stft, new_down)
+
+    ref_peaks, ref_peaks_time = timed(reference_extract_peaks, ref_spec, duration)
+    new_peaks, new_peaks_time = timed(sfp.extract_peaks, new_spec, duration)
+
+    ref_fps, ref_fps_time = timed(reference_generate_fingerprints, ref_peaks)
+    new_fps, new_fps_time = timed(sfp.generate_fingerprints, new_peaks)
+
+    if not np.array_equal(sfp.create_spectrogram(samples, sample_rate), new_spec):
+        raise AssertionError('create_spectrogram differs from its staged computation')
+    if [(int(t * 1000), b) for t, b, _ in ref_peaks] != list(zip(new_peaks['time_ms'].tolist(),
+                                                                   new_peaks['freq_bin'].tolist())):
+        raise AssertionError('Peak mismatch between reference and vectorized extract_peaks')
+    new_pairs = list(zip(*(column.tolist() for column in new_fps)))
+    if ref_fps != new_pairs:
+        raise AssertionError(
+            f'Hash mismatch: {len(ref_fps)} reference vs {len(new_pairs)} vectorized fingerprints'
+        )
+
+    print(f'{duration:.1f}s of audio at {sample_rate} Hz, {len(new_pairs)} fingerprints (identical)')
+    print(f'{"stage":<24}{"reference":>12}{"vectorized":>12}{"speedup":>10}')
+    for stage, ref, new in [
+        ('low_pass_filter', ref_filter_time, new_filter_time),
+        ('downsample', ref_down_time, new_down_time),
+        ('stft', ref_stft_time, new_stft_time),
+        ('extract_peaks', ref_peaks_time, new_peaks_time),
+        ('generate_fingerprints', ref_fps_time, new_fps_time),
+    ]:
+        print(f'{stage:<24}{ref * 1000:>10.1f}ms{new * 1000:>10.1f}ms{ref / new:>9.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='*', help='Audio files to benchmark (default: synthetic track)')
+    parser.add_argument('--seconds', type=float, default=240.0, help='Length of the synthetic track')
+    args = parser.parse_args()
+
+    if not args.files:
+        benchmark(*synthetic_track(args.seconds))
+    for path in args.files:
+        samples, sample_rate = sf.read(path)
+        if len(samples.shape) > 1:
+            samples = samples.mean(axis=1)
+        print(f'\n{path}')
+        benchmark(samples.astype(np.float64), sample_rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Fingerprint insert throughput of the /add storage path.
+
+Loads the same synthetic fingerprints into fresh, migrated databases with the
+original row-by-row inserts, with executemany in one transaction per song, and
+with executemany inside a bulk_load (index dropped and rebuilt once).
+
+Usage:
+    python -m benchmarks.ingest [--songs 200] [--fingerprints-per-song 5000]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from database import bulk_load, connect, init_db, insert_fingerprints
+
+
+def insert_row_by_row(conn, songs):
+    for song_id, (hashes, offsets) in enumerate(songs, start=1):
+        c = conn.cursor()
+        c.execute('INSERT INTO songs (name) VALUES (?)', (f'song {song_id}',))
+        for hash_value, offset in zip(hashes.tolist(), offsets.tolist()):
+            c.execute('INSERT INTO fingerprints (hash, song_id, offset) VALUES (?, ?, ?)',
+                      (hash_value, c.lastrowid, offset))
+        conn.commit()
+
+
+def insert_batched(conn, songs):
+    for song_id, (hashes, offsets) in enumerate(songs, start=1):
+        with conn:
+            c = conn.cursor()
+            c.execute('INSERT INTO songs (name) VALUES (?)', (f'song {song_id}',))
+            insert_fingerprints(conn, c.lastrowid, hashes, offsets)
+
+
+def insert_bulk(conn, songs):
+    with bulk_load(conn):
+        insert_batched(conn, songs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=200)
+    parser.add_argument('--fingerprints-per-song', type=int, default=5000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    songs = [(rng.integers(0, 1 << 32, size=args.fingerprints_per_song),
+              np.sort(rng.integers(0, 240000, size=args.fingerprints_per_song)))
+             for _ in range(args.songs)]
+    total = args.songs * args.fingerprints_per_song
+
+    print(f'{total} fingerprints from {args.songs} songs')
+    print(f'{"method":<14}{"seconds":>10}{"fingerprints/s":>18}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, insert in [('row-by-row', insert_row_by_row),
+                             ('executemany', insert_batched),
+                             ('bulk_load', insert_bulk)]:
+            path = os.path.join(tmp, f'{name}.db')
+            init_db(path)
+            conn = connect(path)
+            start = time.perf_counter()
+            insert(conn, songs)
+            elapsed = time.perf_counter() - start
+            conn.close()
+            print(f'{name:<14}{elapsed:>10.2f}{total / elapsed:>18,.0f}')
+
+
+if __name__ == '__main__':
+    main()
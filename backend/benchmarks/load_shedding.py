@@ -0,0 +1,169 @@
+"""/match under overload with and without admission control.
+
+Starts one gunicorn worker (see gunicorn.conf.py) on a scratch database, adds
+a few synthetic songs, measures how many /match requests per second it
+serves with back-to-back clients, then sends requests open-loop at a
+multiple of that rate: first with admission control and deadlines off, then
+with the configured MATCH_* settings and every request carrying an
+``X-Request-Timeout`` equal to the client's timeout. Reports how many
+requests were answered within the timeout (goodput), answered too late, shed
+with 503 or cancelled at their deadline with 504, and the latency of the
+successful ones. Requires gunicorn to be installed.
+
+Usage:
+    python -m benchmarks.load_shedding [--overload 3] [--seconds 10] [--timeout 2]
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.load_test import BACKEND_DIR, multipart, wait_until_up
+from benchmarks.synthetic import make_excerpt, synthetic_catalog, to_wav
+
+
+def post(port, path, body, content_type, headers=None):
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request('POST', path, body, {'Content-Type': content_type, **(headers or {})})
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def start_server(port, tmp, threads, extra_env):
+    env = dict(os.environ, DATABASE_PATH=os.path.join(tmp, 'songs.db'), WEB_CONCURRENCY='1',
+               WORKER_THREADS=str(threads), BIND=f'127.0.0.1:{port}', MATCH_CACHE_SIZE='0', **extra_env)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', os.devnull,
+         '--log-level', 'warning', 'wsgi:app'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(port, server)
+    except RuntimeError:
+        server.terminate()
+        raise
+    return server
+
+
+def measure_capacity(port, queries, clients, seconds=5.0):
+    """Matches per second served to `clients` back-to-back clients."""
+    completed = [0]
+    lock = threading.Lock()
+    stop = time.perf_counter() + seconds
+    
+    def saturate(first):
+        i = first
+        while time.perf_counter() < stop:
+            post(port, '/match', *queries[i % len(queries)])
+            with lock:
+                completed[0] += 1
+            i += clients
+    
+    workers = [threading.Thread(target=saturate, args=(first,)) for first in range(clients)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return completed[0] / seconds
+
+
+def run_open_loop(port, queries, rate, seconds, timeout, headers):
+    """Send requests at a fixed rate whether or not earlier ones were answered."""
+    results = []
+    lock = threading.Lock()
+    
+    def send(query):
+        outcome = post(port, '/match', *query, headers)
+        with lock:
+            results.append(outcome)
+    
+    threads = []
+    start = time.perf_counter()
+    for i in range(int(rate * seconds)):
+        time.sleep(max(0.0, start + i / rate - time.perf_counter()))
+        thread = threading.Thread(target=send, args=(queries[i % len(queries)],))
+        thread.start()
+        threads.append(thread)
+    offered = len(threads) / (time.perf_counter() - start)
+    for thread in threads:
+        thread.join()
+    
+    statuses = np.array([status for status, _ in results])
+    latencies = np.array([seconds for _, seconds in results])
+    served = latencies[statuses == 200]
+    shed = latencies[statuses == 503]
+    return {
+        'offered': offered,
+        'requests': len(results),
+        'goodput': int(np.count_nonzero((statuses == 200) & (latencies <= timeout))),
+        'late': int(np.count_nonzero((statuses == 200) & (latencies > timeout))),
+        'shed': len(shed),
+        'deadline': int(np.count_nonzero(statuses == 504)),
+        'p50_ms': float(np.percentile(served, 50) * 1000) if len(served) else 0.0,
+        'p99_ms': float(np.percentile(served, 99) * 1000) if len(served) else 0.0,
+        'shed_p99_ms': float(np.percentile(shed, 99) * 1000) if len(shed) else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=10)
+    parser.add_argument('--overload', type=float, default=3.0, help='Offered load as a multiple of capacity')
+    parser.add_argument('--seconds', type=float, default=10.0, help='Duration of each run')
+    parser.add_argument('--timeout', type=float, default=2.0, help='Client timeout in seconds')
+    parser.add_argument('--clients', type=int, default=16, help='Back-to-back clients when measuring capacity')
+    parser.add_argument('--threads', type=int, default=64, help='WORKER_THREADS of the gunicorn worker')
+    parser.add_argument('--port', type=int, default=5078)
+    args = parser.parse_args()
+    
+    songs = list(synthetic_catalog(args.songs, 20.0))
+    rng = np.random.default_rng(0)
+    queries = [multipart({}, to_wav(make_excerpt(samples, rng, 5.0)), 'query.wav') for _, samples in songs]
+    unbounded = {'MATCH_CONCURRENCY': '0', 'MATCH_DEADLINE_SECONDS': '3600'}
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        server = start_server(args.port, tmp, args.threads, unbounded)
+        try:
+            for name, samples in songs:
+                status, _ = post(args.port, '/add', *multipart({'name': name}, to_wav(samples), 'song.wav'))
+                if status != 200:
+                    raise RuntimeError(f'/add failed: {status}')
+            capacity = measure_capacity(args.port, queries, args.clients)
+            rate = capacity * args.overload
+            print(f'Capacity {capacity:.1f} req/s; offering {rate:.1f} req/s for {args.seconds:.0f}s, '
+                  f'client timeout {args.timeout:.1f}s')
+            before = run_open_loop(args.port, queries, rate, args.seconds, args.timeout, {})
+        finally:
+            server.terminate()
+            server.wait()
+        
+        server = start_server(args.port, tmp, args.threads, {})
+        try:
+            after = run_open_loop(args.port, queries, rate, args.seconds, args.timeout,
+                                  {'X-Request-Timeout': str(args.timeout)})
+        finally:
+            server.terminate()
+            server.wait()
+    
+    print(f'{"":<12}{"req/s":>8}{"requests":>10}{"goodput":>10}{"late":>8}{"shed":>8}{"deadline":>10}'
+          f'{"p50 ms":>10}{"p99 ms":>10}{"503 p99 ms":>12}')
+    for name, result in (('unbounded', before), ('admission', after)):
+        print(f"{name:<12}{result['offered']:>8.1f}{result['requests']:>10}{result['goodput']:>10}"
+              f"{result['late']:>8}{result['shed']:>8}{result['deadline']:>10}{result['p50_ms']:>10.1f}"
+              f"{result['p99_ms']:>10.1f}{result['shed_p99_ms']:>12.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
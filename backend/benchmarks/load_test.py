@@ -0,0 +1,137 @@
+"""Matches per second and tail latency of the production server.
+
+Starts gunicorn (see gunicorn.conf.py) on a scratch copy of the database for
+each worker count, adds a test clip through /add, then sends concurrent /match
+requests for that clip and reports throughput and latency percentiles.
+Requires gunicorn to be installed.
+
+Usage:
+    python -m benchmarks.load_test [--workers 1 2 4 8] [--clip file.wav]
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_clip(seconds=10.0, sample_rate=44100):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    audio = 0.3 * np.sin(2 * np.pi * (300 + 200 * np.sin(t)) * t) + 0.05 * rng.standard_normal(len(t))
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def multipart(fields, file_data, filename):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode() + file_data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def post(port, path, body, content_type):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=300)
+    try:
+        conn.request('POST', path, body, {'Content-Type': content_type})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def wait_until_up(port, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def run_load(port, body, content_type, requests, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        status, _ = post(port, '/match', body, content_type)
+        return status, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies = np.array([latency for status, latency in results if status == 200]) * 1000
+    errors = sum(status != 200 for status, _ in results)
+    return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clip', help='Audio file to add and match (default: synthetic 10s clip)')
+    parser.add_argument('--database', default=os.path.join(BACKEND_DIR, 'songs.db'),
+                        help='Database to copy as the starting catalog')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--port', type=int, default=5077)
+    args = parser.parse_args()
+
+    if args.clip:
+        with open(args.clip, 'rb') as clip:
+            clip_data, filename = clip.read(), os.path.basename(args.clip)
+    else:
+        clip_data, filename = synthetic_clip(), 'clip.wav'
+    match_body, match_type = multipart({}, clip_data, filename)
+    add_body, add_type = multipart({'name': 'load test clip'}, clip_data, filename)
+
+    print(f'{"workers":>8}{"matches/s":>12}{"p50":>10}{"p99":>10}{"errors":>8}')
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            database = os.path.join(tmp, 'songs.db')
+            if os.path.exists(args.database):
+                shutil.copy(args.database, database)
+            env = dict(os.environ, DATABASE_PATH=database, WEB_CONCURRENCY=str(workers),
+                       BIND=f'127.0.0.1:{args.port}', INDEX_DIR=os.path.join(tmp, 'index'))
+            server = subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', os.devnull,
+                 '--log-level', 'warning', 'wsgi:app'],
+                cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                wait_until_up(args.port, server)
+                status, body = post(args.port, '/add', add_body, add_type)
+                if status != 200:
+                    raise RuntimeError(f'/add failed: {status} {body[:200]!r}')
+                throughput, p50, p99, errors = run_load(args.port, match_body, match_type,
+                                                        args.requests, args.concurrency)
+                print(f'{workers:>8}{throughput:>12.1f}{p50:>8.0f}ms{p99:>8.0f}ms{errors:>8}')
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == '__main__':
+    main()
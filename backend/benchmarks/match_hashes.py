@@ -0,0 +1,77 @@
+"""Payload size and latency of /match_hashes against /match.
+
+Adds a synthetic catalog to a scratch database and sends every query both as
+a WAV upload to /match and as encoded fingerprints to /match_hashes, then
+reports how much smaller the fingerprint payload is and the latency of both.
+tests/test_match_hashes.py checks that the two return the same candidates.
+
+Usage:
+    python -m benchmarks.match_hashes [--songs 20] [--queries 50]
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import make_excerpt, synthetic_catalog, to_wav
+from fingerprint_codec import CONTENT_TYPE, fingerprint_payload
+from shazam_fingerprint import FINGERPRINT_VERSION
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=20)
+    parser.add_argument('--song-seconds', type=float, default=30.0)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--query-seconds', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    
+    songs = list(synthetic_catalog(args.songs, args.song_seconds, args.seed))
+    from audio_io import decode_audio
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app reads its configuration when imported
+        os.environ.update(DATABASE_PATH=os.path.join(tmp, 'songs.db'), INDEX_DIR=os.path.join(tmp, 'index'),
+                          MATCH_CACHE_SIZE='0')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        from app import app
+        client = app.test_client()
+        for name, samples in songs:
+            response = client.post('/add', data={'name': name, 'file': (io.BytesIO(to_wav(samples)), 'song.wav')},
+                                   content_type='multipart/form-data')
+            if response.status_code != 200:
+                raise RuntimeError(f'/add failed for {name}: {response.get_data(as_text=True)}')
+        
+        rng = np.random.default_rng(args.seed)
+        wav_bytes = payload_bytes = 0
+        wav_seconds = hashes_seconds = 0.0
+        for i in range(args.queries):
+            excerpt = make_excerpt(songs[i % len(songs)][1], rng, args.query_seconds)
+            wav = to_wav(excerpt)
+            start = time.perf_counter()
+            client.post('/match', data={'file': (io.BytesIO(wav), 'query.wav')},
+                        content_type='multipart/form-data')
+            wav_seconds += time.perf_counter() - start
+            
+            payload = fingerprint_payload(*decode_audio(wav))
+            start = time.perf_counter()
+            client.post(f'/match_hashes?version={FINGERPRINT_VERSION}', data=payload, content_type=CONTENT_TYPE)
+            hashes_seconds += time.perf_counter() - start
+            
+            wav_bytes += len(wav)
+            payload_bytes += len(payload)
+    
+    print(f'Upload per query: {wav_bytes / args.queries:>12,.0f} bytes WAV '
+          f'{payload_bytes / args.queries:>10,.0f} bytes fingerprints ({wav_bytes / max(payload_bytes, 1):,.0f}x)')
+    print(f'Server time per query: {wav_seconds / args.queries * 1000:>8.2f} ms /match '
+          f'{hashes_seconds / args.queries * 1000:>8.2f} ms /match_hashes')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Latency of the /match lookup and scoring stage against catalog size.
+
+Builds synthetic fingerprint databases with the original, unindexed schema and
+times the original one-query-per-hash lookup with dict-based voting next to the
+batched join with NumPy scoring. The database is then migrated to the current
+schema (hash index, WAL) and the batched lookup is timed again, along with
+the in-memory index engine built from it.
+
+Usage:
+    python -m benchmarks.match_lookup [--sizes 1000 10000 100000]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from database import connect, init_db
+from matching import find_best_match, lookup_fingerprints
+from memory_index import MemoryIndex
+
+HASH_SPACE = 1 << 24
+
+
+def build_catalog(path, num_songs, fingerprints_per_song, seed=0):
+    """Fill a fresh database with random fingerprints; returns them per song."""
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE songs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE fingerprints (
+            hash INTEGER NOT NULL,
+            song_id INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            FOREIGN KEY(song_id) REFERENCES songs(id)
+        )
+    ''')
+    c.executemany('INSERT INTO songs (id, name) VALUES (?, ?)',
+                  ((song_id, f'song {song_id}') for song_id in range(1, num_songs + 1)))
+
+    hashes = rng.integers(0, HASH_SPACE, size=(num_songs, fingerprints_per_song))
+    offsets = np.sort(rng.integers(0, 240000, size=(num_songs, fingerprints_per_song)), axis=1)
+    song_ids = np.repeat(np.arange(1, num_songs + 1), fingerprints_per_song)
+    c.executemany('INSERT INTO fingerprints (hash, song_id, offset) VALUES (?, ?, ?)',
+                  zip(hashes.ravel().tolist(), song_ids.tolist(), offsets.ravel().tolist()))
+    conn.commit()
+    conn.close()
+    return hashes, offsets
+
+
+def make_query(rng, hashes, offsets, query_size):
+    """Excerpt of a random song, shifted in time and mixed with unrelated hashes."""
+    song = int(rng.integers(len(hashes)))
+    picked = np.sort(rng.choice(hashes.shape[1], size=min(query_size, hashes.shape[1]), replace=False))
+    shift = int(rng.integers(0, 10000))
+    noise = rng.integers(0, HASH_SPACE, size=query_size // 4)
+    query_hashes = np.concatenate([hashes[song, picked], noise]).tolist()
+    query_offsets = np.concatenate([offsets[song, picked] + shift,
+                                    rng.integers(0, 10000, size=len(noise))]).tolist()
+    return song + 1, query_hashes, query_offsets
+
+
+def match_per_hash(conn, query_hashes, query_offsets):
+    """The original /match loop: one SELECT per hash and nested-dict voting."""
+    c = conn.cursor()
+    matches = {}
+    for hash_value, sample_offset in zip(query_hashes, query_offsets):
+        c.execute('''
+            SELECT f.song_id, f.offset, s.name
+            FROM fingerprints f
+            JOIN songs s ON f.song_id = s.id
+            WHERE f.hash = ?
+        ''', (hash_value,))
+        for song_id, db_offset, _ in c.fetchall():
+            matches.setdefault(song_id, []).append(sample_offset - db_offset)
+    best, highest = None, 0
+    for song_id, deltas in matches.items():
+        histogram = {}
+        for delta in deltas:
+            histogram[delta] = histogram.get(delta, 0) + 1
+        score = max(histogram.values())
+        if score > highest:
+            best, highest = song_id, score
+    return best
+
+
+def match_batched(conn, query_hashes, query_offsets):
+    result = find_best_match(*lookup_fingerprints(conn, query_hashes, query_offsets))
+    return result[0] if result else None
+
+
+def memory_matcher(path):
+    conn = connect(path)
+    index = MemoryIndex.from_database(conn)
+    conn.close()
+
+    def match_memory(conn, query_hashes, query_offsets):
+        result = find_best_match(*index.lookup(query_hashes, query_offsets))
+        return result[0] if result else None
+    return match_memory
+
+
+def run(path, queries, match, rng, hashes, offsets, query_size):
+    conn = connect(path)
+    latencies = []
+    correct = 0
+    for _ in range(queries):
+        expected, query_hashes, query_offsets = make_query(rng, hashes, offsets, query_size)
+        start = time.perf_counter()
+        found = match(conn, query_hashes, query_offsets)
+        latencies.append(time.perf_counter() - start)
+        correct += found == expected
+    conn.close()
+    latencies = np.array(latencies) * 1000
+    return np.percentile(latencies, 50), np.percentile(latencies, 99), correct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Catalog sizes (number of songs)')
+    parser.add_argument('--fingerprints-per-song', type=int, default=100)
+    parser.add_argument('--query-size', type=int, default=60, help='Song hashes per query')
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--legacy-max-songs', type=int, default=1000,
+                        help='Skip the per-hash lookup above this catalog size')
+    args = parser.parse_args()
+
+    print(f'{"songs":>8}{"schema":>10}{"method":>10}{"p50":>12}{"p99":>12}{"correct":>10}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f'catalog_{size}.db')
+            hashes, offsets = build_catalog(path, size, args.fingerprints_per_song)
+            methods = [('original', 'batched', match_batched), ('current', 'batched', match_batched),
+                       ('current', 'memory', None)]
+            if size <= args.legacy_max_songs:
+                methods.insert(0, ('original', 'per-hash', match_per_hash))
+            for schema, name, match in methods:
+                if schema == 'current':
+                    init_db(path)
+                if match is None:
+                    match = memory_matcher(path)
+                rng = np.random.default_rng(size)
+                p50, p99, correct = run(path, args.queries, match, rng, hashes, offsets, args.query_size)
+                print(f'{size:>8}{schema:>10}{name:>10}{p50:>10.1f}ms{p99:>10.1f}ms{correct:>7}/{args.queries}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Throughput and latency of concurrent /match lookups with and without micro-batching.
+
+Builds a synthetic fingerprint database, then runs the lookup and scoring of
+/match from several client threads at once: first with every thread doing its
+own lookup, then with the lookups going through a `LookupBatcher`. Checks that
+both return the same ranked candidates for every query.
+
+Usage:
+    python -m benchmarks.micro_batching [--songs 10000] [--clients 1 8 32]
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from batching import LookupBatcher
+from benchmarks.match_lookup import build_catalog, make_query
+from database import connect, init_db
+from matching import lookup_fingerprints, rank_candidates
+from metrics import MATCH_BATCH_REQUESTS
+
+
+def run_clients(path, queries, lookup, clients):
+    """Every client thread matches its share of the queries; returns latencies and results."""
+    latencies = [None] * len(queries)
+    results = [None] * len(queries)
+    
+    def client(first):
+        conn = connect(path)
+        for i in range(first, len(queries), clients):
+            _, query_hashes, query_offsets = queries[i]
+            start = time.perf_counter()
+            hits = lookup(conn, query_hashes, query_offsets)
+            results[i] = rank_candidates(*hits)
+            latencies[i] = time.perf_counter() - start
+        conn.close()
+    
+    threads = [threading.Thread(target=client, args=(first,)) for first in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, np.array(latencies) * 1000, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--fingerprints-per-song', type=int, default=100)
+    parser.add_argument('--query-size', type=int, default=60, help='Song hashes per query')
+    parser.add_argument('--queries', type=int, default=400)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batch-wait-ms', type=float, default=2)
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'catalog.db')
+        hashes, offsets = build_catalog(path, args.songs, args.fingerprints_per_song)
+        init_db(path)
+        rng = np.random.default_rng(1)
+        queries = [make_query(rng, hashes, offsets, args.query_size) for _ in range(args.queries)]
+        
+        print(f'{"clients":>8}{"method":>10}{"req/s":>10}{"p50":>12}{"p99":>12}{"fill":>8}{"same":>10}')
+        for clients in args.clients:
+            _, _, expected = run_clients(path, queries, lookup_fingerprints, 1)
+            batcher = LookupBatcher(lookup_fingerprints, lambda: connect(path),
+                                    args.batch_size, args.batch_wait_ms / 1000)
+            methods = [('direct', lookup_fingerprints),
+                       ('batched', lambda conn, h, o: batcher.submit(h, o))]
+            for name, lookup in methods:
+                MATCH_BATCH_REQUESTS._values.clear()
+                elapsed, latencies, results = run_clients(path, queries, lookup, clients)
+                series = MATCH_BATCH_REQUESTS._values.get(())
+                fill = f'{series["sum"] / series["count"]:.1f}' if series else '-'
+                same = sum(result == want for result, want in zip(results, expected))
+                print(f'{clients:>8}{name:>10}{len(queries) / elapsed:>10.0f}'
+                      f'{np.percentile(latencies, 50):>10.1f}ms{np.percentile(latencies, 99):>10.1f}ms'
+                      f'{fill:>8}{same:>6}/{len(queries)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Bytes per fingerprint and lookup latency of the posting list layouts.
+
+Builds synthetic catalogs and stores the same postings three ways: the
+SQLite fingerprints table with its covering hash index, the CSR arrays of the
+in-memory index, and the delta-varint posting lists of `CompressedIndex`.
+Reports the bytes each layout takes per fingerprint and the p50/p99 latency
+of looking up batches of query hashes, and fails if the compressed lookup
+returns different hits.
+
+Usage:
+    python -m benchmarks.posting_compression [--sizes 1000 10000 100000] [--batch 1 32]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.match_lookup import build_catalog, make_query
+from compressed_index import CompressedIndex
+from database import connect, init_db
+from matching import lookup_fingerprints
+from memory_index import MemoryIndex
+
+
+def sqlite_bytes(conn) -> int:
+    """Bytes of the fingerprints table and its hash index."""
+    try:
+        return conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name IN ('fingerprints', 'idx_fingerprints_hash')"
+                            ).fetchone()[0]
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table: count the whole file
+        return conn.execute('PRAGMA page_count').fetchone()[0] * conn.execute('PRAGMA page_size').fetchone()[0]
+
+
+def canonical(hits) -> np.ndarray:
+    rows = np.stack([np.asarray(column, dtype=np.int64) for column in hits], axis=1)
+    return rows[np.lexsort(rows.T[::-1])]
+
+
+def time_lookups(lookup, batches):
+    latencies = []
+    for query_hashes, query_offsets in batches:
+        start = time.perf_counter()
+        lookup(query_hashes, query_offsets)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='Songs per catalog')
+    parser.add_argument('--fingerprints-per-song', type=int, default=100)
+    parser.add_argument('--query-size', type=int, default=200, help='Song hashes per query')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 32], help='Queries looked up together')
+    parser.add_argument('--repeats', type=int, default=100)
+    args = parser.parse_args()
+    mismatches = 0
+    
+    print(f'{"songs":>8}{"layout":>12}{"bytes/fp":>10}' + ''.join(
+        f'{f"p50 x{batch}":>12}{f"p99 x{batch}":>12}' for batch in args.batch) + '  (ms)')
+    for num_songs in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'catalog.db')
+            hashes, offsets = build_catalog(path, num_songs, args.fingerprints_per_song)
+            init_db(path)
+            conn = connect(path)
+            conn.execute('VACUUM')
+            num_postings = hashes.size
+            memory = MemoryIndex.from_database(conn)
+            compressed = CompressedIndex.from_index(memory)
+            
+            rng = np.random.default_rng(2)
+            runs = {}
+            for batch in args.batch:
+                runs[batch] = []
+                for _ in range(args.repeats):
+                    queries = [make_query(rng, hashes, offsets, args.query_size) for _ in range(batch)]
+                    runs[batch].append((np.concatenate([query[1] for query in queries]),
+                                        np.concatenate([query[2] for query in queries])))
+            for query_hashes, query_offsets in runs[args.batch[-1]][:10]:
+                if not np.array_equal(canonical(compressed.lookup(query_hashes, query_offsets)),
+                                      canonical(memory.lookup(query_hashes, query_offsets))):
+                    mismatches += 1
+            
+            layouts = [
+                ('sqlite', sqlite_bytes(conn),
+                 lambda query_hashes, query_offsets: lookup_fingerprints(conn, query_hashes.tolist(),
+                                                                          query_offsets.tolist())),
+                ('csr', sum(getattr(memory, name).nbytes for name in ('keys', 'indptr', 'song_ids', 'offsets')),
+                 memory.lookup),
+                ('varint', compressed.nbytes, compressed.lookup),
+            ]
+            for name, size, lookup in layouts:
+                timings = ''.join(f'{p50:>12.3f}{p99:>12.3f}'
+                                  for p50, p99 in (time_lookups(lookup, runs[batch]) for batch in args.batch))
+                print(f'{num_songs:>8,}{name:>12}{size / num_postings:>10.2f}{timings}')
+            conn.close()
+    
+    if mismatches:
+        print(f'FAILED: {mismatches} compressed lookups differ from the CSR index')
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
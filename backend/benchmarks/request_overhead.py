@@ -0,0 +1,66 @@
+"""Per-request overhead of getting an uploaded clip into memory as samples.
+
+Compares the original path (temporary directory, save to disk, sf.read from
+the file, clean up) with decoding the upload from memory.
+
+Usage:
+    python -m benchmarks.request_overhead [--seconds 2] [--repeat 200]
+"""
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from audio_io import decode_audio
+
+
+def decode_via_temp_file(data):
+    temp_dir = tempfile.mkdtemp()
+    filepath = os.path.join(temp_dir, 'clip.wav')
+    try:
+        with open(filepath, 'wb') as out:
+            out.write(data)
+        samples, sample_rate = sf.read(filepath)
+        if len(samples.shape) > 1:
+            samples = samples.mean(axis=1)
+        return samples.astype(np.float64), sample_rate
+    finally:
+        os.remove(filepath)
+        os.rmdir(temp_dir)
+
+
+def make_clip(seconds, sample_rate=44100, channels=2):
+    rng = np.random.default_rng(0)
+    audio = 0.1 * rng.standard_normal((int(seconds * sample_rate), channels))
+    buffer = io.BytesIO()
+    sf.write(buffer, audio, sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
+
+
+def time_per_call(func, data, repeat):
+    func(data)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(data)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2.0, help='Length of the stereo test clip')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    data = make_clip(args.seconds)
+    print(f'{args.seconds:.1f}s stereo WAV clip, {len(data) / 1024:.0f} KiB')
+    print(f'{"path":<20}{"per request":>14}')
+    for name, func in [('temp file', decode_via_temp_file), ('in memory', decode_audio)]:
+        print(f'{name:<20}{time_per_call(func, data, args.repeat):>12.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
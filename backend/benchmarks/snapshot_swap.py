@@ -0,0 +1,158 @@
+"""Load time and hot swap of immutable index snapshots.
+
+Builds two synthetic catalogs and a snapshot of each, then compares opening a
+snapshot with building the in-memory index from SQLite and checks that
+snapshot lookups rank the same songs as the SQLite lookup. Client threads then
+run lookups against a `LiveSnapshot` while the served file is replaced back
+and forth; the script reports their latency during the swaps and fails if a
+lookup errors, or a corrupted snapshot is swapped in.
+
+Usage:
+    python -m benchmarks.snapshot_swap [--songs 10000] [--swaps 10]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.match_lookup import build_catalog, make_query
+from database import connect, init_db
+from matching import find_best_match, lookup_fingerprints
+from memory_index import MemoryIndex
+from snapshot import LiveSnapshot, Snapshot, SnapshotError, build_sections, write_snapshot
+
+FINGERPRINT_VERSION = 2
+
+
+def build(tmp, name, songs, fingerprints_per_song, seed):
+    path = os.path.join(tmp, f'{name}.db')
+    hashes, offsets = build_catalog(path, songs, fingerprints_per_song, seed)
+    init_db(path)
+    conn = connect(path)
+    try:
+        start = time.perf_counter()
+        index = MemoryIndex.from_database(conn)
+        from_database = time.perf_counter() - start
+        snapshot_path = os.path.join(tmp, f'{name}.snap')
+        sections, manifest = build_sections(conn)
+        write_snapshot(snapshot_path, sections, fingerprint_version=FINGERPRINT_VERSION, **manifest)
+    finally:
+        conn.close()
+    return path, snapshot_path, hashes, offsets, from_database, len(index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=10000)
+    parser.add_argument('--fingerprints-per-song', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--swaps', type=int, default=10)
+    args = parser.parse_args()
+    failures = []
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path, old_path, hashes, offsets, from_database, postings = build(
+            tmp, 'old', args.songs, args.fingerprints_per_song, 1)
+        _, new_path, _, _, _, _ = build(tmp, 'new', args.songs + 100, args.fingerprints_per_song, 2)
+        
+        start = time.perf_counter()
+        snapshot = Snapshot(old_path, verify=False)
+        mapped = time.perf_counter() - start
+        start = time.perf_counter()
+        snapshot.verify()
+        verified = time.perf_counter() - start
+        print(f'{postings:,} postings, snapshot {os.path.getsize(old_path) / 2**20:,.1f} MiB')
+        print(f'Open: {from_database * 1000:>9.1f} ms MemoryIndex.from_database '
+              f'{mapped * 1000:>9.2f} ms snapshot mmap {verified * 1000:>9.1f} ms checksums')
+        
+        rng = np.random.default_rng(3)
+        queries = [make_query(rng, hashes, offsets, 20) for _ in range(args.queries)]
+        conn = connect(db_path, read_only=True)
+        try:
+            agree = sum(
+                find_best_match(*snapshot.lookup(query_hashes, query_offsets))
+                == find_best_match(*lookup_fingerprints(conn, query_hashes, query_offsets))
+                for _, query_hashes, query_offsets in queries
+            )
+        finally:
+            conn.close()
+        print(f'Parity: {agree} of {len(queries)} queries rank the same best song as SQLite')
+        if agree != len(queries):
+            failures.append('parity')
+        
+        served = os.path.join(tmp, 'current.snap')
+        shutil.copy(old_path, served)
+        live = LiveSnapshot(served, FINGERPRINT_VERSION, check_interval=0)
+        latencies = []
+        errors = []
+        stop = threading.Event()
+        
+        def client(seed):
+            client_rng = np.random.default_rng(seed)
+            while not stop.is_set():
+                _, query_hashes, query_offsets = queries[int(client_rng.integers(len(queries)))]
+                start = time.perf_counter()
+                try:
+                    find_best_match(*live.current().lookup(query_hashes, query_offsets))
+                except Exception as e:
+                    errors.append(e)
+                latencies.append(time.perf_counter() - start)
+        
+        threads = [threading.Thread(target=client, args=(seed,)) for seed in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        before = len(latencies)
+        swap_seconds = []
+        for swap in range(args.swaps):
+            source = new_path if swap % 2 == 0 else old_path
+            shutil.copy(source, served + '.tmp')
+            os.replace(served + '.tmp', served)
+            start = time.perf_counter()
+            live.reload()
+            swap_seconds.append(time.perf_counter() - start)
+            expected = args.songs + (100 if swap % 2 == 0 else 0)
+            if live.current().num_songs != expected:
+                failures.append(f'swap {swap} serves {live.current().num_songs} songs, expected {expected}')
+            time.sleep(0.1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        
+        during = np.array(latencies[before:]) * 1000
+        print(f'Swaps: {args.swaps}, {np.mean(swap_seconds) * 1000:.1f} ms each to map and verify; '
+              f'{len(during):,} lookups meanwhile, p50 {np.percentile(during, 50):.2f} ms, '
+              f'p99 {np.percentile(during, 99):.2f} ms, max {during.max():.2f} ms, {len(errors)} errors')
+        if errors:
+            failures.append(f'{len(errors)} lookups failed: {errors[0]!r}')
+        
+        corrupt = os.path.join(tmp, 'corrupt.snap')
+        shutil.copy(new_path, corrupt)
+        with open(corrupt, 'r+b') as corrupt_file:
+            # Flip one byte in the middle of the file
+            corrupt_file.seek(os.path.getsize(corrupt) // 2)
+            byte = corrupt_file.read(1)
+            corrupt_file.seek(-1, os.SEEK_CUR)
+            corrupt_file.write(bytes([byte[0] ^ 0xFF]))
+        serving = live.current().id
+        try:
+            live.reload(corrupt)
+            failures.append('corrupted snapshot was swapped in')
+        except SnapshotError as e:
+            print(f'Corrupted snapshot refused: {e}')
+        if live.current().id != serving:
+            failures.append('serving snapshot changed after a refused swap')
+    
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
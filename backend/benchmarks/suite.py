@@ -0,0 +1,195 @@
+"""Reproducible end-to-end benchmark on a synthetic catalog, with JSON output.
+
+Generates a deterministic catalog (see ``benchmarks.synthetic``) and measures:
+- per-stage throughput of the fingerprinting functions,
+- ingest rate through the ``/add`` code path,
+- latency percentiles and accuracy through the ``/match`` code path,
+all offline through Flask's test client against a scratch database. Results
+are printed and, with ``--output``, written as JSON; ``--compare`` prints the
+change against an earlier result file.
+
+Usage:
+    python -m benchmarks.suite [--songs 50] [--queries 100] [--seed 0]
+                               [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.synthetic import SAMPLE_RATE, make_excerpt, synthetic_catalog, to_wav
+
+# Metrics compared by --compare, with True where higher is better
+COMPARED = {
+    ('ingest', 'songs_per_second'): True,
+    ('ingest', 'fingerprints_per_second'): True,
+    ('match', 'p50_ms'): False,
+    ('match', 'p99_ms'): False,
+    ('match', 'accuracy'): True,
+}
+
+
+def percentiles(values_ms):
+    values = np.asarray(values_ms)
+    return {
+        'mean_ms': float(values.mean()),
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_stages(songs):
+    """Seconds per fingerprinting stage over the whole catalog."""
+    from fingerprint_pool import timed_fingerprint
+    
+    totals = {}
+    audio_seconds = 0.0
+    for _, samples in songs:
+        _, timings = timed_fingerprint(samples, SAMPLE_RATE)
+        audio_seconds += len(samples) / SAMPLE_RATE
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+    return {
+        stage: {'seconds': seconds, 'audio_seconds_per_second': audio_seconds / seconds if seconds else None}
+        for stage, seconds in totals.items()
+    }
+
+
+def bench_ingest(client, songs):
+    latencies = []
+    fingerprints = 0
+    song_ids = {}
+    start = time.perf_counter()
+    for name, samples in songs:
+        data = to_wav(samples)
+        request_start = time.perf_counter()
+        response = client.post('/add', data={'name': name, 'file': (io.BytesIO(data), 'song.wav')},
+                               content_type='multipart/form-data')
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f'/add failed for {name}: {response.get_data(as_text=True)}')
+        fingerprints += response.json['stats']['num_fingerprints']
+        song_ids[name] = response.json['song_id']
+    elapsed = time.perf_counter() - start
+    return song_ids, {
+        'songs': len(songs),
+        'fingerprints': fingerprints,
+        'seconds': elapsed,
+        'songs_per_second': len(songs) / elapsed,
+        'fingerprints_per_second': fingerprints / elapsed,
+        **percentiles(latencies),
+    }
+
+
+def bench_match(client, songs, song_ids, num_queries, query_seconds, snr_db, gain_db, seed):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(num_queries):
+        name, samples = songs[int(rng.integers(len(songs)))]
+        queries.append((song_ids[name], to_wav(make_excerpt(samples, rng, query_seconds, snr_db, gain_db))))
+    
+    latencies = []
+    correct = 0
+    start = time.perf_counter()
+    for expected, data in queries:
+        request_start = time.perf_counter()
+        response = client.post('/match', data={'file': (io.BytesIO(data), 'query.wav')},
+                               content_type='multipart/form-data')
+        latencies.append((time.perf_counter() - request_start) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f'/match failed: {response.get_data(as_text=True)}')
+        correct += response.json['matched'] and response.json['song_id'] == expected
+    elapsed = time.perf_counter() - start
+    return {
+        'queries': num_queries,
+        'accuracy': correct / num_queries,
+        'queries_per_second': num_queries / elapsed,
+        **percentiles(latencies),
+    }
+
+
+def compare(result, baseline):
+    print(f'\nChange against {baseline["meta"].get("commit")} ({baseline["meta"].get("timestamp")}):')
+    for (section, key), higher_is_better in COMPARED.items():
+        old = baseline.get(section, {}).get(key)
+        new = result.get(section, {}).get(key)
+        if old is None or new is None:
+            continue
+        change = f'{(new - old) / old * 100:>+9.1f}%' if old else ' ' * 10
+        better = new > old if higher_is_better else new < old
+        verdict = 'same' if new == old else 'better' if better else 'worse'
+        print(f'  {section}.{key:<24}{old:>12.3f}{new:>12.3f}{change} {verdict}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=50)
+    parser.add_argument('--song-seconds', type=float, default=30.0)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--query-seconds', type=float, default=10.0)
+    parser.add_argument('--snr-db', type=float, default=20.0, help='Noise added to queries')
+    parser.add_argument('--gain-db', type=float, nargs=2, default=[-3.0, 3.0], metavar=('LOW', 'HIGH'),
+                        help='Range of the random gain change applied to queries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=('sqlite', 'memory'), default='sqlite')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Earlier JSON result to compare against')
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        # The app reads its configuration when imported
+        os.environ.update(DATABASE_PATH=os.path.join(tmp, 'songs.db'), INDEX_DIR=os.path.join(tmp, 'index'),
+                          FINGERPRINT_ENGINE=args.engine, MATCH_CACHE_SIZE='0')
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        from app import app
+        client = app.test_client()
+        
+        songs = list(synthetic_catalog(args.songs, args.song_seconds, args.seed))
+        stages = bench_stages(songs)
+        song_ids, ingest = bench_ingest(client, songs)
+        match = bench_match(client, songs, song_ids, args.queries, args.query_seconds, args.snr_db,
+                            tuple(args.gain_db), args.seed)
+    
+    result = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'params': vars(args) | {'sample_rate': SAMPLE_RATE},
+        'stages': stages,
+        'ingest': ingest,
+        'match': match,
+    }
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Deterministic synthetic audio for benchmarks.
+
+Songs are sequences of short notes, each a mix of a few tones and a linear
+chirp over a noise floor, so every song has its own spectral peaks. Queries
+are excerpts of a song with added noise and a gain change. Everything is
+derived from an integer seed, so the same arguments always produce the same
+audio.
+"""
+import io
+from typing import Iterator, Tuple
+
+import numpy as np
+import soundfile as sf
+
+SAMPLE_RATE = 44100
+NOTE_SECONDS = (0.05, 0.2)
+TONES_PER_NOTE = 3
+FREQ_RANGE = (100.0, 4000.0)
+
+# The pipeline analyses the opening 1/31 of each clip (see compute_stft), so
+# excerpts start early in the song, on a whole downsampled STFT hop
+EXCERPT_START_MAX = 0.5  # seconds
+EXCERPT_START_STEP = 128  # samples
+
+
+def synthetic_song(seed: int, seconds: float, sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Mono float32 samples in [-1, 1] for song number `seed`."""
+    rng = np.random.default_rng(seed)
+    total = int(seconds * sample_rate)
+    audio = np.zeros(total)
+    start = 0
+    while start < total:
+        length = min(int(rng.uniform(*NOTE_SECONDS) * sample_rate), total - start)
+        t = np.arange(length) / sample_rate
+        for freq in rng.uniform(*FREQ_RANGE, size=TONES_PER_NOTE):
+            audio[start:start + length] += rng.uniform(0.2, 1.0) * np.sin(2 * np.pi * freq * t + rng.uniform(0, 2 * np.pi))
+        chirp_from, chirp_to = rng.uniform(*FREQ_RANGE, size=2)
+        chirp_rate = (chirp_to - chirp_from) / max(t[-1], 1e-3) if length else 0.0
+        audio[start:start + length] += 0.3 * np.sin(2 * np.pi * (chirp_from + 0.5 * chirp_rate * t) * t)
+        start += length
+    audio += 0.02 * rng.standard_normal(total)
+    return (audio / np.max(np.abs(audio)) * 0.9).astype(np.float32)
+
+
+def synthetic_catalog(num_songs: int, seconds: float, seed: int = 0,
+                      sample_rate: int = SAMPLE_RATE) -> Iterator[Tuple[str, np.ndarray]]:
+    """(name, samples) for `num_songs` songs; song i uses seed ``seed * 1_000_003 + i``."""
+    for i in range(num_songs):
+        yield f'synthetic {seed}-{i:05d}', synthetic_song(seed * 1_000_003 + i, seconds, sample_rate)
+
+
+def make_excerpt(samples: np.ndarray, rng: np.random.Generator, seconds: float,
+                 snr_db: float = 20.0, gain_db: Tuple[float, float] = (-12.0, 6.0),
+                 sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """A noisy, gain-shifted excerpt of `samples`, starting near the beginning."""
+    max_start = min(int(EXCERPT_START_MAX * sample_rate), max(len(samples) - int(seconds * sample_rate), 0))
+    start = int(rng.integers(0, max_start // EXCERPT_START_STEP + 1)) * EXCERPT_START_STEP
+    excerpt = samples[start:start + int(seconds * sample_rate)].astype(np.float64)
+    
+    noise_power = np.mean(excerpt ** 2) / 10 ** (snr_db / 10)
+    excerpt = excerpt + rng.standard_normal(len(excerpt)) * np.sqrt(noise_power)
+    excerpt *= 10 ** (rng.uniform(*gain_db) / 20)
+    return np.clip(excerpt, -1.0, 1.0).astype(np.float32)
+
+
+def to_wav(samples: np.ndarray, sample_rate: int = SAMPLE_RATE) -> bytes:
+    """16-bit PCM WAV file contents, as a client would upload them."""
+    buffer = io.BytesIO()
+    sf.write(buffer, samples, sample_rate, format='WAV', subtype='PCM_16')
+    return buffer.getvalue()
@@ -0,0 +1,169 @@
+"""Compressed posting lists: delta-encoded varints grouped by hash.
+
+The postings of every distinct hash are stored as one byte run, sorted by
+song and offset. Each posting is two LEB128 varints: the song id as the
+difference from the previous posting's song (the first one absolute), and
+the offset as the difference from the previous offset of the same song, or
+absolute when the song changes. Song deltas are small because a hash's
+postings are spread over the catalog, offset deltas because a song repeats a
+hash within seconds, so most postings take three to five bytes instead of
+the 16 of the CSR arrays in `memory_index`.
+
+Per distinct hash only the key and the start of its byte run are kept, as
+uint32 where they fit. A lookup decodes the runs of all distinct query
+hashes at once with NumPy: no Python loop runs per posting or per hash.
+"""
+from typing import Tuple
+
+import numpy as np
+
+from matching import expand_postings
+
+ARRAYS = ('keys', 'byte_ptr', 'data')
+MAX_VARINT_BYTES = 10
+
+
+def varint_lengths(values: np.ndarray) -> np.ndarray:
+    """Bytes of the LEB128 encoding of each non-negative value."""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for k in range(1, MAX_VARINT_BYTES):
+        lengths += values >= np.uint64(1 << (7 * k))
+    return lengths
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """LEB128-encode non-negative integers into one uint8 array."""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        has_byte = lengths > k
+        chunk = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + k] = (chunk | more).astype(np.uint8)
+    return out
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """Decode a uint8 array of complete LEB128 varints into int64 values."""
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = data < 0x80
+    value_starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    lengths = np.diff(np.append(value_starts, len(data)))
+    shifts = 7 * (np.arange(len(data)) - np.repeat(value_starts, lengths))
+    chunks = (data & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(chunks, value_starts).astype(np.int64)
+
+
+def _segmented_cumsum(values: np.ndarray, segment_starts: np.ndarray) -> np.ndarray:
+    """Running sums of `values` that restart at every index in `segment_starts`."""
+    totals = np.cumsum(values)
+    lengths = np.diff(np.append(segment_starts, len(values)))
+    return totals - np.repeat(totals[segment_starts] - values[segment_starts], lengths)
+
+
+class CompressedIndex:
+    """Read-only hash -> (song_id, offset) postings in delta-varint byte runs."""
+    
+    def __init__(self, keys: np.ndarray, byte_ptr: np.ndarray, data: np.ndarray, num_postings: int):
+        self.keys = keys
+        self.byte_ptr = byte_ptr
+        self.data = data
+        self.num_postings = num_postings
+    
+    @classmethod
+    def from_postings(cls, hashes, song_ids, offsets) -> 'CompressedIndex':
+        """Build an index from unsorted parallel posting arrays of non-negative integers."""
+        hashes = np.asarray(hashes, dtype=np.int64)
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(hashes) and min(hashes.min(), song_ids.min(), offsets.min()) < 0:
+            raise ValueError('hashes, song ids and offsets must not be negative')
+        order = np.lexsort((offsets, song_ids, hashes))
+        hashes, song_ids, offsets = hashes[order], song_ids[order], offsets[order]
+        keys, group_starts = np.unique(hashes, return_index=True)
+        
+        # Deltas restart with absolute values at every hash, offsets also at every song
+        first_in_group = np.zeros(len(hashes), dtype=bool)
+        first_in_group[group_starts] = True
+        song_deltas = np.diff(song_ids, prepend=0)
+        song_deltas[first_in_group] = song_ids[first_in_group]
+        offset_deltas = np.diff(offsets, prepend=0)
+        new_run = first_in_group | (song_deltas != 0)
+        offset_deltas[new_run] = offsets[new_run]
+        
+        values = np.empty(2 * len(hashes), dtype=np.int64)
+        values[0::2], values[1::2] = song_deltas, offset_deltas
+        posting_bytes = varint_lengths(values).reshape(-1, 2).sum(axis=1)
+        posting_starts = np.cumsum(posting_bytes) - posting_bytes
+        data = encode_varints(values)
+        byte_ptr = np.append(posting_starts[group_starts], len(data))
+        
+        key_dtype = np.uint32 if not len(keys) or keys[-1] < 1 << 32 else np.int64
+        ptr_dtype = np.uint32 if len(data) < 1 << 32 else np.int64
+        return cls(keys.astype(key_dtype), byte_ptr.astype(ptr_dtype), data, len(hashes))
+    
+    @classmethod
+    def from_index(cls, index) -> 'CompressedIndex':
+        """Compress a `MemoryIndex`."""
+        return cls.from_postings(*index.postings())
+    
+    def __len__(self) -> int:
+        return self.num_postings
+    
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes + self.byte_ptr.nbytes + self.data.nbytes
+    
+    def _find(self, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Key positions of `hashes` and which of them are present."""
+        if len(self.keys) == 0:
+            return np.zeros(len(hashes), dtype=np.int64), np.zeros(len(hashes), dtype=bool)
+        # Search in the keys' own dtype; mixed dtypes would convert every key per call
+        key_info = np.iinfo(self.keys.dtype)
+        in_range = (hashes >= key_info.min) & (hashes <= key_info.max)
+        queries = np.where(in_range, hashes, 0).astype(self.keys.dtype)
+        pos = np.minimum(np.searchsorted(self.keys, queries), len(self.keys) - 1)
+        return pos, in_range & (self.keys[pos] == queries)
+    
+    def decode(self, key_positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Postings of the given keys as ``(song_ids, offsets, key_idx)``, `key_idx` indexing `key_positions`."""
+        starts = self.byte_ptr[key_positions].astype(np.int64)
+        lengths = self.byte_ptr[key_positions + 1].astype(np.int64) - starts
+        run_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        data = self.data[run_starts + np.arange(int(lengths.sum()))]
+        values = decode_varints(data)
+        song_deltas, offset_deltas = values[0::2], values[1::2]
+        
+        # Every varint ends in a byte below 0x80; two varints make a posting
+        value_ends = np.concatenate(([0], np.cumsum(data < 0x80)))
+        counts = np.diff(value_ends[np.cumsum(np.concatenate(([0], lengths)))]) // 2
+        key_idx = np.repeat(np.arange(len(key_positions)), counts)
+        group_starts = np.cumsum(counts) - counts
+        group_starts = group_starts[counts > 0]
+        
+        song_ids = _segmented_cumsum(song_deltas, group_starts)
+        new_run = song_deltas != 0
+        new_run[group_starts] = True
+        offsets = _segmented_cumsum(offset_deltas, np.flatnonzero(new_run))
+        return song_ids, offsets, key_idx
+    
+    def lookup(self, hashes, sample_offsets) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Look up a batch of query hashes.
+        
+        Same contract as `matching.lookup_fingerprints`: returns parallel arrays
+        ``(song_ids, db_offsets, sample_offsets, query_idx)``, one entry per hit.
+        Each distinct hash is decoded once however often the query repeats it.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        sample_offsets = np.asarray(sample_offsets, dtype=np.int64)
+        unique, inverse = np.unique(hashes, return_inverse=True)
+        pos, found = self._find(unique)
+        found = np.flatnonzero(found)
+        song_ids, db_offsets, key_idx = self.decode(pos[found])
+        song_ids, db_offsets, query_idx = expand_postings(inverse.ravel(), song_ids, db_offsets,
+                                                          found[key_idx], len(unique))
+        return song_ids, db_offsets, sample_offsets[query_idx], query_idx
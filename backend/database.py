@@ -0,0 +1,289 @@
+"""SQLite connection settings and versioned schema migrations for songs.db."""
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 8192  # Only applied when a database file is created
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+BUSY_TIMEOUT = 30.0  # seconds
+STATEMENT_CACHE_SIZE = 256  # prepared statements kept per connection
+
+HASH_INDEX_NAME = 'idx_fingerprints_hash'
+CREATE_HASH_INDEX = f'CREATE INDEX IF NOT EXISTS {HASH_INDEX_NAME} ON fingerprints (hash, song_id, offset)'
+
+# Each entry upgrades the schema by one version; the current version is kept in
+# PRAGMA user_version. Never edit an entry that has shipped, append a new one.
+MIGRATIONS = [
+    # 1: original tables (databases created before versioning already have them)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS songs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            hash INTEGER NOT NULL,
+            song_id INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            FOREIGN KEY(song_id) REFERENCES songs(id)
+        )
+        ''',
+    ],
+    # 2: covering index so hash lookups never touch the table itself
+    [
+        CREATE_HASH_INDEX,
+    ],
+    # 3: content hash of the source file, used to skip already-indexed files
+    [
+        'ALTER TABLE songs ADD COLUMN file_hash TEXT',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_file_hash ON songs (file_hash)',
+    ],
+    # 4: catalog generation, bumped whenever songs are added or removed
+    [
+        'CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+        "INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('generation', 0)",
+    ],
+    # 5: fingerprint algorithm version of the stored hashes (existing songs were
+    # fingerprinted with version 1, magnitude-based hashes)
+    [
+        '''
+        INSERT OR IGNORE INTO catalog_meta (key, value)
+        SELECT 'fingerprint_version', CASE WHEN EXISTS (SELECT 1 FROM songs) THEN 1 ELSE 2 END
+        ''',
+    ],
+    # 6: posting-list statistics per hash, kept up to date at ingest
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS hash_stats (
+            hash INTEGER PRIMARY KEY,
+            postings INTEGER NOT NULL,
+            songs INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT OR IGNORE INTO hash_stats (hash, postings, songs)
+        SELECT hash, COUNT(*), COUNT(DISTINCT song_id) FROM fingerprints GROUP BY hash
+        ''',
+    ],
+    # 7: length of each song in seconds (NULL for songs added before)
+    [
+        'ALTER TABLE songs ADD COLUMN duration REAL',
+    ],
+    # 8: catalog epoch, bumped whenever fingerprints are deleted
+    [
+        "INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('epoch', 0)",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def connect(path: str, read_only: bool = False, check_same_thread: bool = True) -> sqlite3.Connection:
+    """Open a connection with the per-connection performance pragmas applied.
+    
+    Read-only connections can still create TEMP tables.
+    """
+    if read_only:
+        conn = sqlite3.connect(f'{Path(path).absolute().as_uri()}?mode=ro', uri=True, timeout=BUSY_TIMEOUT,
+                               check_same_thread=check_same_thread, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+class ConnectionPool:
+    """Per-process pool of warm connections to one database.
+    
+    Readers get read-only connections that are kept open between requests,
+    so their page cache and prepared statements are reused; at most
+    `max_idle` idle ones are kept. All writes of a process go through a
+    single connection, one writer at a time. The pool starts over in a forked
+    child, which must not use its parent's connections.
+    """
+    
+    def __init__(self, path: str, max_idle: int = 8):
+        self.path = path
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pid = None
+        self._idle = []
+        self._writer = None
+    
+    def _check_pid(self) -> None:
+        # Called with self._lock held
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._writer = None
+    
+    @contextmanager
+    def reader(self):
+        """Borrow a read-only connection."""
+        with self._lock:
+            self._check_pid()
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = connect(self.path, read_only=True, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            # Never hand out a connection still holding a read snapshot
+            if conn.in_transaction:
+                conn.commit()
+            with self._lock:
+                keep = self._pid == os.getpid() and len(self._idle) < self.max_idle
+                if keep:
+                    self._idle.append(conn)
+            if not keep:
+                conn.close()
+    
+    @contextmanager
+    def writer(self):
+        """Hold the process's write connection; uncommitted changes are rolled back."""
+        with self._write_lock:
+            with self._lock:
+                self._check_pid()
+                if self._writer is None:
+                    self._writer = connect(self.path, check_same_thread=False)
+                conn = self._writer
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+    
+    def close(self) -> None:
+        """Close the idle connections and the writer."""
+        with self._lock:
+            if self._pid == os.getpid():
+                for conn in self._idle + ([self._writer] if self._writer else []):
+                    conn.close()
+            self._idle = []
+            self._writer = None
+
+
+def init_db(path: str) -> int:
+    """Bring the database at `path` up to the current schema, keeping its data.
+    
+    Returns the schema version the database was at before migrating.
+    """
+    conn = connect(path)
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(
+                f'{path} has schema version {version}, newer than supported version {SCHEMA_VERSION}'
+            )
+        
+        # page_size only takes effect before the first table is created
+        if conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0] == 0:
+            conn.execute(f'PRAGMA page_size = {PAGE_SIZE}')
+        conn.execute('PRAGMA journal_mode = WAL')
+        
+        for target in range(version + 1, SCHEMA_VERSION + 1):
+            logger.info(f'Migrating {path} to schema version {target}')
+            conn.execute('BEGIN')
+            try:
+                for statement in MIGRATIONS[target - 1]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {target}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        
+        # Recreate the hash index if a bulk load was interrupted before rebuilding it
+        conn.execute(CREATE_HASH_INDEX)
+        conn.commit()
+        return version
+    finally:
+        conn.close()
+
+
+def insert_fingerprints(conn: sqlite3.Connection, song_id: int, hashes: np.ndarray, offsets: np.ndarray) -> None:
+    """Insert one song's fingerprints with a single executemany.
+    
+    Runs inside the caller's transaction; nothing is committed here.
+    """
+    rows = np.column_stack((
+        np.asarray(hashes, dtype=np.int64),
+        np.full(len(hashes), song_id, dtype=np.int64),
+        np.asarray(offsets, dtype=np.int64),
+    )).tolist()
+    conn.executemany('INSERT INTO fingerprints (hash, song_id, offset) VALUES (?, ?, ?)', rows)
+
+
+def update_hash_stats(conn: sqlite3.Connection, hashes: np.ndarray) -> None:
+    """Count one song's fingerprints into hash_stats, inside the caller's transaction."""
+    unique, counts = np.unique(np.asarray(hashes, dtype=np.int64), return_counts=True)
+    conn.executemany(
+        'INSERT INTO hash_stats (hash, postings, songs) VALUES (?, ?, 1) '
+        'ON CONFLICT (hash) DO UPDATE SET postings = postings + excluded.postings, songs = songs + 1',
+        np.column_stack((unique, counts)).tolist()
+    )
+
+
+def catalog_generation(conn: sqlite3.Connection) -> int:
+    """Counter that changes whenever the catalog does, shared by all processes."""
+    return conn.execute("SELECT value FROM catalog_meta WHERE key = 'generation'").fetchone()[0]
+
+
+def bump_generation(conn: sqlite3.Connection) -> None:
+    """Mark the catalog as changed, inside the caller's transaction."""
+    conn.execute("UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation'")
+
+
+def catalog_epoch(conn: sqlite3.Connection) -> int:
+    """Counter that changes whenever fingerprints are deleted, so rowids may be reused."""
+    return conn.execute("SELECT value FROM catalog_meta WHERE key = 'epoch'").fetchone()[0]
+
+
+def bump_epoch(conn: sqlite3.Connection) -> None:
+    """Mark fingerprints as deleted, inside the caller's transaction."""
+    conn.execute("UPDATE catalog_meta SET value = value + 1 WHERE key = 'epoch'")
+
+
+def fingerprint_version(conn: sqlite3.Connection) -> int:
+    """Fingerprint algorithm version the stored hashes were made with."""
+    return conn.execute("SELECT value FROM catalog_meta WHERE key = 'fingerprint_version'").fetchone()[0]
+
+
+def set_fingerprint_version(conn: sqlite3.Connection, version: int) -> None:
+    """Record the fingerprint version, inside the caller's transaction."""
+    conn.execute("UPDATE catalog_meta SET value = ? WHERE key = 'fingerprint_version'", (version,))
+
+
+@contextmanager
+def bulk_load(conn: sqlite3.Connection):
+    """Drop the hash index for the duration of a large backfill.
+    
+    Inserting into an unindexed table and building the index once afterwards
+    is much faster than maintaining it row by row. The index is rebuilt even
+    if the load fails, so lookups never run without it for long.
+    """
+    conn.commit()
+    conn.execute(f'DROP INDEX IF EXISTS {HASH_INDEX_NAME}')
+    try:
+        yield conn
+    finally:
+        conn.commit()
+        logger.info('Rebuilding fingerprint hash index')
+        conn.execute(CREATE_HASH_INDEX)
+        conn.commit()
@@ -0,0 +1,63 @@
+"""Compact binary encoding of query fingerprints for POST /match_hashes.
+
+Clients that fingerprint audio themselves upload the fingerprints instead of
+the audio: a packed array of little-endian ``(uint32 hash, uint32 offset_ms)``
+pairs, 8 bytes per fingerprint, sent with the FINGERPRINT_VERSION of the
+algorithm that produced them. `encode_fingerprints` is the reference encoder;
+a client's payload for the same audio should be byte-identical to
+`fingerprint_payload`.
+
+Usage:
+    python fingerprint_codec.py clip.wav clip.bin
+"""
+import sys
+from typing import Tuple
+
+import numpy as np
+
+from shazam_fingerprint import FINGERPRINT_VERSION, fingerprint_samples
+
+PAIR_DTYPE = np.dtype([('hash', '<u4'), ('offset_ms', '<u4')])
+CONTENT_TYPE = 'application/octet-stream'
+
+
+def encode_fingerprints(hashes: np.ndarray, offsets_ms: np.ndarray) -> bytes:
+    """Pack parallel hash and offset arrays into a /match_hashes payload."""
+    if len(hashes) != len(offsets_ms):
+        raise ValueError('hashes and offsets must have the same length')
+    pairs = np.empty(len(hashes), dtype=PAIR_DTYPE)
+    pairs['hash'] = hashes
+    pairs['offset_ms'] = offsets_ms
+    return pairs.tobytes()
+
+
+def decode_fingerprints(payload: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Unpack a /match_hashes payload into native uint32 ``(hashes, offsets_ms)``."""
+    if len(payload) % PAIR_DTYPE.itemsize:
+        raise ValueError(f'payload length {len(payload)} is not a multiple of {PAIR_DTYPE.itemsize} bytes')
+    pairs = np.frombuffer(payload, dtype=PAIR_DTYPE)
+    return pairs['hash'].astype(np.uint32), pairs['offset_ms'].astype(np.uint32)
+
+
+def fingerprint_payload(samples: np.ndarray, sample_rate: int) -> bytes:
+    """Fingerprint mono samples as the server would and encode them."""
+    return encode_fingerprints(*fingerprint_samples(samples, sample_rate))
+
+
+def main():
+    if len(sys.argv) != 3:
+        print(__doc__.strip().splitlines()[-1].strip(), file=sys.stderr)
+        return 2
+    from audio_io import decode_audio
+    with open(sys.argv[1], 'rb') as audio_file:
+        data = audio_file.read()
+    payload = fingerprint_payload(*decode_audio(data))
+    with open(sys.argv[2], 'wb') as payload_file:
+        payload_file.write(payload)
+    print(f'{len(data):,} bytes of audio -> {len(payload):,} bytes '
+          f'({len(payload) // PAIR_DTYPE.itemsize:,} fingerprints, version {FINGERPRINT_VERSION})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
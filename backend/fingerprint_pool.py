@@ -0,0 +1,92 @@
+"""Process pool for the CPU-bound fingerprinting done while serving requests.
+
+Request threads share one GIL, so fingerprinting uploads in the request thread
+stops a threaded worker from serving anything else. With FINGERPRINT_PROCESSES
+set, `fingerprint` hands the work to a pool of that many processes instead.
+The pool is created lazily in each server worker, after the worker has been
+forked, and its processes are started with forkserver so they never inherit
+a threaded parent.
+"""
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from shazam_fingerprint import (
+    DSP_RATIO, MAX_FREQ, compute_stft, downsample, extract_peaks, generate_fingerprints, low_pass_filter
+)
+
+FINGERPRINT_PROCESSES = int(os.environ.get('FINGERPRINT_PROCESSES', '0'))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """This process's fingerprinting pool, or None when fingerprinting runs inline."""
+    global _pool, _pool_pid
+    if FINGERPRINT_PROCESSES <= 0:
+        return None
+    if _pool is None or _pool_pid != os.getpid():
+        # Concurrent first requests must not each start a pool
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                _pool = ProcessPoolExecutor(max_workers=FINGERPRINT_PROCESSES, mp_context=context)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def timed_fingerprint(samples: np.ndarray, sample_rate: int) -> Tuple[Tuple[np.ndarray, np.ndarray], Dict[str, float]]:
+    """Same as `shazam_fingerprint.fingerprint_samples`, also returning seconds per stage."""
+    timings = {}
+    start = time.perf_counter()
+    
+    def lap(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = now - start
+        start = now
+    
+    filtered = low_pass_filter(MAX_FREQ, sample_rate, samples)
+    lap('low_pass_filter')
+    downsampled = downsample(filtered, sample_rate, sample_rate // DSP_RATIO)
+    lap('downsample')
+    spectrogram = compute_stft(downsampled)
+    lap('stft')
+    peaks = extract_peaks(spectrogram, len(samples) / sample_rate)
+    lap('extract_peaks')
+    fingerprints = generate_fingerprints(peaks)
+    lap('generate_fingerprints')
+    return fingerprints, timings
+
+
+def fingerprint(samples: np.ndarray, sample_rate: int,
+                timings: Optional[Dict[str, float]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Fingerprint mono samples, in the pool when one is configured.
+    
+    Returns ``(hashes, anchor_times_ms)``. If `timings` is given it is updated
+    with the seconds spent in each stage.
+    """
+    pool = get_pool()
+    if pool is None:
+        fingerprints, stage_timings = timed_fingerprint(samples, sample_rate)
+    else:
+        fingerprints, stage_timings = pool.submit(timed_fingerprint, samples, sample_rate).result()
+    if timings is not None:
+        timings.update(stage_timings)
+    return fingerprints
+
+
+def shutdown() -> None:
+    """Stop this process's pool, if it has one."""
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
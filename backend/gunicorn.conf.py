@@ -0,0 +1,43 @@
+"""Gunicorn settings for production serving.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is imported once in the master before workers are forked
+(preload_app), so the schema migration runs once and, with
+FINGERPRINT_ENGINE=memory, the memory-mapped fingerprint index is loaded
+once and its pages are shared by every worker. Each worker serves requests
+on a few threads and can hand fingerprinting to its own process pool
+(FINGERPRINT_PROCESSES), so decoding one upload does not hold the GIL for
+the whole worker. With FINGERPRINT_ENGINE=snapshot every worker follows
+replacements of SNAPSHOT_PATH on its own (see snapshot.py).
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5001')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+# More threads than MATCH_CONCURRENCY + MATCH_QUEUE_SIZE, so that under overload
+# /match requests reach admission control and are shed instead of queueing here
+threads = int(os.environ.get('WORKER_THREADS', '32'))
+preload_app = True
+
+# Uploads are fingerprinted within the request, so allow for long clips
+timeout = int(os.environ.get('WORKER_TIMEOUT', '120'))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to bound the growth of long-lived processes
+max_requests = int(os.environ.get('MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+
+def worker_exit(server, worker):
+    import app
+    import fingerprint_pool
+    fingerprint_pool.shutdown()
+    if app.shard_index is not None:
+        app.shard_index.close()
+    app.db_pool.close()
@@ -0,0 +1,160 @@
+"""Posting-list statistics and the stop-list of over-common hashes.
+
+Some hashes (hum, silence, common beats) occur in a large share of all songs.
+Each one pulls a long posting list into every query that contains it while
+telling songs apart hardly at all. `hash_stats` in songs.db counts postings
+and songs per hash as songs are added; hashes found in more than
+`max_share` of the songs, and in more than `min_songs` songs, form the stop-list.
+At query time they are dropped before the lookup, or looked up with a lower
+weight in scoring. They can also be left out when new songs are indexed.
+
+Usage:
+    python hash_stats.py report [--top 20]
+    python hash_stats.py prune [--shard-dir fingerprint_shards]
+"""
+import argparse
+import math
+import os
+import sys
+import threading
+
+import numpy as np
+
+from database import bump_epoch, bump_generation, catalog_generation, connect, init_db
+from shards import ShardedIndex
+
+STOP_MODES = ('off', 'drop', 'weight')
+
+
+class StopList:
+    """Sorted array of stopped hashes, reloaded whenever the catalog changes."""
+    
+    def __init__(self, max_share: float = 0.05, min_songs: int = 50):
+        self.max_share = max_share
+        self.min_songs = min_songs
+        self.hashes = np.empty(0, dtype=np.int64)
+        self.threshold = None
+        self._generation = None
+        self._lock = threading.Lock()
+    
+    def refresh(self, conn, generation: int = None) -> None:
+        """Reload the stop-list from hash_stats if the catalog generation moved."""
+        if generation is None:
+            generation = catalog_generation(conn)
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            total_songs = conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+            threshold = max(self.min_songs, math.ceil(self.max_share * total_songs))
+            rows = conn.execute('SELECT hash FROM hash_stats WHERE songs > ? ORDER BY hash', (threshold,)).fetchall()
+            self.hashes = np.array([row[0] for row in rows], dtype=np.int64)
+            self.threshold = threshold
+            self._generation = generation
+    
+    def refresh_counts(self, generation: int, hashes: np.ndarray, songs: np.ndarray, total_songs: int) -> None:
+        """Reload the stop-list from sorted per-hash song counts, as kept in an index snapshot."""
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            threshold = max(self.min_songs, math.ceil(self.max_share * total_songs))
+            self.hashes = np.asarray(hashes[songs > threshold], dtype=np.int64)
+            self.threshold = threshold
+            self._generation = generation
+    
+    def contains(self, hashes) -> np.ndarray:
+        """Boolean mask of the given hashes that are on the stop-list."""
+        hashes = np.asarray(hashes, dtype=np.int64)
+        stopped = self.hashes
+        if len(stopped) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        pos = np.minimum(np.searchsorted(stopped, hashes), len(stopped) - 1)
+        return stopped[pos] == hashes
+    
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+
+def describe_hash(hash_value: int) -> str:
+    """Anchor bin, target bin and time difference packed into a hash."""
+    return f'{hash_value >> 23:>4} -> {(hash_value >> 14) & 0x1FF:>4} +{hash_value & 0x3FFF}ms'
+
+
+def heaviest_hashes(conn, top: int):
+    """The `top` hashes with the longest posting lists: (hash, postings, songs)."""
+    return conn.execute('SELECT hash, postings, songs FROM hash_stats ORDER BY postings DESC LIMIT ?',
+                        (top,)).fetchall()
+
+
+def report(conn, stop_list: StopList, top: int) -> None:
+    total_songs = conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+    distinct, postings = conn.execute('SELECT COUNT(*), COALESCE(SUM(postings), 0) FROM hash_stats').fetchone()
+    stop_list.refresh(conn)
+    stopped_postings = conn.execute('SELECT COALESCE(SUM(postings), 0) FROM hash_stats WHERE songs > ?',
+                                    (stop_list.threshold,)).fetchone()[0]
+    
+    print(f'{total_songs:,} songs, {distinct:,} distinct hashes, {postings:,} postings')
+    print(f'Stop-list: hashes in more than {stop_list.threshold:,} songs: {len(stop_list):,} hashes, '
+          f'{stopped_postings:,} postings ({stopped_postings / postings * 100 if postings else 0:.1f}%)')
+    print(f'\n{"hash":>12}  {"anchor -> target +delta":<24}{"postings":>10}{"songs":>8}{"share":>8}')
+    for hash_value, hash_postings, songs in heaviest_hashes(conn, top):
+        share = songs / total_songs * 100 if total_songs else 0
+        print(f'{hash_value:>12}  {describe_hash(hash_value):<24}{hash_postings:>10,}{songs:>8,}{share:>7.1f}%')
+
+
+def prune(conn, stop_list: StopList, shard_index=None) -> int:
+    """Delete the postings of stopped hashes from the fingerprints table, or from the shards of `shard_index`.
+    
+    Their statistics stay in hash_stats so they remain on the stop-list.
+    Returns the number of rows removed.
+    """
+    stop_list.refresh(conn)
+    with conn:
+        if shard_index is not None:
+            removed = shard_index.remove_hashes(stop_list.hashes)
+        else:
+            removed = conn.execute(
+                'DELETE FROM fingerprints WHERE hash IN (SELECT hash FROM hash_stats WHERE songs > ?)',
+                (stop_list.threshold,)
+            ).rowcount
+            bump_epoch(conn)
+        bump_generation(conn)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect posting-list statistics and apply the hash stop-list.')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'songs.db'))
+    parser.add_argument('--max-share', type=float, default=float(os.environ.get('HASH_STOP_SHARE', '0.05')),
+                        help='Stop hashes found in more than this share of songs')
+    parser.add_argument('--min-songs', type=int, default=int(os.environ.get('HASH_STOP_MIN_SONGS', '50')),
+                        help='...and in more than this many songs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    report_parser = commands.add_parser('report', help='Show the heaviest hashes and the stop-list size')
+    report_parser.add_argument('--top', type=int, default=20)
+    prune_parser = commands.add_parser('prune', help='Delete postings of stopped hashes to shrink the index')
+    prune_parser.add_argument('--shard-dir', default=(os.environ.get('SHARD_DIR', 'fingerprint_shards')
+                                                      if os.environ.get('FINGERPRINT_ENGINE') == 'sharded' else None),
+                              help='Prune the hash-range shards in this directory instead of the songs database')
+    args = parser.parse_args()
+    
+    init_db(args.database)
+    conn = connect(args.database)
+    stop_list = StopList(args.max_share, args.min_songs)
+    try:
+        if args.command == 'report':
+            report(conn, stop_list, args.top)
+        else:
+            shard_index = ShardedIndex(args.shard_dir) if args.shard_dir else None
+            removed = prune(conn, stop_list, shard_index)
+            print(f'Removed {removed:,} postings of {len(stop_list):,} stopped hashes')
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""Offline batch indexer for large catalogs.
+
+Fingerprints audio files in parallel across all cores and writes the results
+into the songs database from a single writer process, so a catalog does not
+have to be pushed through POST /add one file at a time. Files whose content
+hash is already in the database are skipped, which makes an interrupted run
+safe to restart.
+
+Usage:
+    python index_catalog.py path/to/music/
+    python index_catalog.py --manifest catalog.tsv --workers 8 --bulk
+
+A manifest has one file per line, optionally followed by a tab and the song
+name (defaults to the file name without extension). Lines starting with '#'
+are ignored.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+
+from audio_io import decode_audio, read_audio_blocks
+from database import bulk_load, bump_generation, connect, init_db, insert_fingerprints, update_hash_stats
+from shazam_fingerprint import fingerprint_blocks, fingerprint_samples
+from stage_cache import DEFAULT_MAX_MB, StageCache, cached_fingerprint
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {'wav', 'mp3', 'm4a', 'ogg', 'flac'}
+HASH_CHUNK_BYTES = 1 << 20
+DECODE_BLOCK_FRAMES = 65536
+IN_FLIGHT_PER_WORKER = 4  # files submitted per worker process and not yet stored
+
+# Read-only connection of each worker process, used to skip indexed files early
+_worker_conn = None
+# Intermediate stage cache of each worker process, if enabled
+_worker_cache = None
+
+
+def find_audio_files(directory):
+    """Yield (path, name) for every audio file below `directory`, in sorted order."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            stem, _, extension = filename.rpartition('.')
+            if stem and extension.lower() in AUDIO_EXTENSIONS:
+                yield os.path.join(root, filename), stem
+
+
+def read_manifest(manifest_path):
+    """Yield (path, name) for every entry of a manifest file."""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            path, _, name = line.partition('\t')
+            path = os.path.join(base_dir, path)
+            yield path, name or os.path.splitext(os.path.basename(path))[0]
+
+
+def _init_worker(database_path, cache_dir=None, cache_bytes=None):
+    global _worker_conn, _worker_cache
+    _worker_conn = connect(database_path, read_only=True)
+    if cache_dir is not None:
+        _worker_cache = StageCache(cache_dir, cache_bytes)
+
+
+def fingerprint_file(path):
+    """Decode and fingerprint one file in a worker process.
+    
+    Returns ``(file_hash, duration, hashes, offsets, seconds)``; ``hashes`` is
+    None if the file is already in the database.
+    """
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    with open(path, 'rb') as audio_file:
+        for chunk in iter(lambda: audio_file.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    file_hash = digest.hexdigest()
+    
+    if _worker_conn is not None:
+        if _worker_conn.execute('SELECT 1 FROM songs WHERE file_hash = ?', (file_hash,)).fetchone():
+            return file_hash, 0.0, None, None, time.perf_counter() - start
+    
+    if _worker_cache is not None:
+        hashes, offsets, duration = cached_fingerprint(_worker_cache, path, file_hash)
+        return file_hash, duration, hashes, offsets, time.perf_counter() - start
+    
+    # Long files are decoded block by block when their length is known up front
+    blocks, sample_rate, num_samples = read_audio_blocks(path, DECODE_BLOCK_FRAMES)
+    if num_samples is not None:
+        hashes, offsets = fingerprint_blocks(blocks, sample_rate, num_samples)
+    else:
+        with open(path, 'rb') as audio_file:
+            samples, sample_rate = decode_audio(audio_file.read())
+        num_samples = len(samples)
+        hashes, offsets = fingerprint_samples(samples, sample_rate)
+    return file_hash, num_samples / sample_rate, hashes, offsets, time.perf_counter() - start
+
+
+class CatalogWriter:
+    """Single writer that stores fingerprinted files in batched transactions."""
+    
+    def __init__(self, conn, batch_size):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.pending = []
+        self.songs_added = 0
+        self.fingerprints_added = 0
+    
+    def add(self, name, file_hash, duration, hashes, offsets):
+        self.pending.append((name, file_hash, duration, hashes, offsets))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            c = self.conn.cursor()
+            for name, file_hash, duration, hashes, offsets in self.pending:
+                # The same file may appear twice in one run
+                c.execute('SELECT 1 FROM songs WHERE file_hash = ?', (file_hash,))
+                if c.fetchone():
+                    continue
+                c.execute('INSERT INTO songs (name, file_hash, duration) VALUES (?, ?, ?)',
+                          (name, file_hash, duration))
+                insert_fingerprints(self.conn, c.lastrowid, hashes, offsets)
+                update_hash_stats(self.conn, hashes)
+                self.songs_added += 1
+                self.fingerprints_added += len(hashes)
+            bump_generation(self.conn)
+        self.pending = []
+
+
+def index_catalog(entries, database_path, workers=None, batch_size=50, bulk=False,
+                  cache_dir=None, cache_mb=DEFAULT_MAX_MB):
+    """Fingerprint `entries` of (path, name) in parallel and store them.
+    
+    With `cache_dir`, decoded PCM and peaks are kept in a `StageCache` there
+    so later re-indexes resume from them. Returns a dict of aggregate
+    statistics.
+    """
+    init_db(database_path)
+    conn = connect(database_path)
+    writer = CatalogWriter(conn, batch_size)
+    stats = {'files': 0, 'indexed': 0, 'skipped': 0, 'failed': 0, 'audio_seconds': 0.0, 'fingerprints': 0}
+    start = time.perf_counter()
+    
+    def store(future, path, name):
+        stats['files'] += 1
+        try:
+            file_hash, duration, hashes, offsets, seconds = future.result()
+        except Exception as e:
+            stats['failed'] += 1
+            print(f'FAILED  {path}: {e}', flush=True)
+            return
+        if hashes is None:
+            stats['skipped'] += 1
+            print(f'skipped {path} (already indexed)', flush=True)
+            return
+        writer.add(name, file_hash, duration, hashes, offsets)
+        stats['indexed'] += 1
+        stats['audio_seconds'] += duration
+        stats['fingerprints'] += len(hashes)
+        print(f'indexed {path}: {duration:.1f}s audio, {len(hashes)} fingerprints '
+              f'in {seconds:.2f}s ({duration / seconds:.0f}x realtime)', flush=True)
+    
+    def run():
+        # Only a few files per worker are in flight, and each future is dropped once
+        # stored, so memory does not grow with the size of the catalog
+        pending_entries = iter(entries)
+        in_flight = (workers or os.cpu_count() or 1) * IN_FLIGHT_PER_WORKER
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(os.path.abspath(database_path), cache_dir, cache_mb * 2**20)) as pool:
+            futures = {pool.submit(fingerprint_file, path): (path, name)
+                       for path, name in islice(pending_entries, in_flight)}
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    store(future, *futures.pop(future))
+                for path, name in islice(pending_entries, len(done)):
+                    futures[pool.submit(fingerprint_file, path)] = (path, name)
+            writer.flush()
+    
+    try:
+        if bulk:
+            with bulk_load(conn):
+                run()
+        else:
+            run()
+    finally:
+        writer.flush()
+        conn.close()
+    
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fingerprint a catalog of audio files into the songs database.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('directory', nargs='?', help='Directory to scan recursively for audio files')
+    source.add_argument('--manifest', help='File listing audio paths (and optional tab-separated names)')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'songs.db'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Fingerprinting processes')
+    parser.add_argument('--batch-size', type=int, default=50, help='Songs written per transaction')
+    parser.add_argument('--bulk', action='store_true',
+                        help='Drop the hash index during the load and rebuild it at the end')
+    parser.add_argument('--cache-dir', default=os.environ.get('STAGE_CACHE_DIR'),
+                        help='Cache decoded PCM and peaks here for faster re-indexing')
+    parser.add_argument('--cache-mb', type=int, default=int(os.environ.get('STAGE_CACHE_MB', DEFAULT_MAX_MB)),
+                        help='Size cap of the cache in MiB')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    entries = list(read_manifest(args.manifest) if args.manifest else find_audio_files(args.directory))
+    if not entries:
+        print('No audio files found', file=sys.stderr)
+        return 1
+    
+    stats = index_catalog(entries, args.database, args.workers, args.batch_size, args.bulk,
+                          args.cache_dir, args.cache_mb)
+    seconds = stats['seconds']
+    print(f"\n{stats['files']} files in {seconds:.1f}s: {stats['indexed']} indexed, "
+          f"{stats['skipped']} skipped, {stats['failed']} failed")
+    print(f"{stats['files'] / seconds:.1f} files/s, {stats['audio_seconds'] / seconds:.0f}x realtime, "
+          f"{stats['fingerprints'] / seconds:,.0f} fingerprints/s")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+"""Cache of recent /match results, keyed by the decoded audio.
+
+Clients retry, and several devices often submit the same clip within seconds.
+Decoding is still needed to compute the key, but a hit skips the spectrogram,
+peak extraction and fingerprint lookup. Every entry records the catalog
+generation it was computed against; once /add or /clear_db bumps the
+generation, older entries are never returned again.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+
+def pcm_digest(samples: np.ndarray, sample_rate: int) -> str:
+    """Digest of decoded mono samples and their sample rate."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(sample_rate).encode())
+    digest.update(np.ascontiguousarray(samples, dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+
+class MatchCache:
+    """Thread-safe LRU cache with a per-entry time to live.
+    
+    `max_entries` of 0 disables the cache.
+    """
+    
+    def __init__(self, max_entries: int = 1024, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (generation, expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key: str, generation: int) -> Optional[Any]:
+        """The cached value for `key` if it is fresh and from `generation`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_generation, expires_at, value = entry
+                if entry_generation == generation and expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+    
+    def put(self, key: str, generation: int, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
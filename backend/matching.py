@@ -0,0 +1,218 @@
+"""Bulk fingerprint lookup and offset-histogram scoring used by /match."""
+import itertools
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+def lookup_fingerprints(conn, hashes, sample_offsets,
+                        join_songs: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Look up every query hash with a single join against the fingerprints table.
+    
+    Returns parallel arrays ``(song_ids, db_offsets, sample_offsets, query_idx)``
+    with one entry per hit, where ``query_idx`` is the position of the matching
+    query hash. Hits are limited to songs in the songs table unless
+    `join_songs` is False, as for shard files that only hold fingerprints.
+    """
+    started_transaction = not conn.in_transaction
+    c = conn.cursor()
+    c.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS query_hashes (
+            idx INTEGER PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            sample_offset INTEGER NOT NULL
+        )
+    ''')
+    c.execute('DELETE FROM query_hashes')
+    c.executemany(
+        'INSERT INTO query_hashes (idx, hash, sample_offset) VALUES (?, ?, ?)',
+        zip(itertools.count(), hashes, sample_offsets)
+    )
+    # CROSS JOIN keeps the query hashes as the outer loop so each one is an
+    # index probe rather than a scan of the fingerprints table
+    c.execute(f'''
+        SELECT f.song_id, f.offset, q.sample_offset, q.idx
+        FROM query_hashes q
+        CROSS JOIN fingerprints f ON f.hash = q.hash
+        {'JOIN songs s ON f.song_id = s.id' if join_songs else ''}
+    ''')
+    hits = np.fromiter(itertools.chain.from_iterable(c), dtype=np.int64).reshape(-1, 4)
+    c.execute('DELETE FROM query_hashes')
+    # The temp table writes open a transaction; left open on a long-lived
+    # connection it would pin a stale snapshot of the catalog
+    if started_transaction:
+        conn.commit()
+    return hits[:, 0], hits[:, 1], hits[:, 2], hits[:, 3]
+
+
+# Songs kept for offset alignment after ranking by raw hash hits
+DEFAULT_TOP_K = 50
+
+
+def expand_postings(inverse: np.ndarray, song_ids: np.ndarray, db_offsets: np.ndarray,
+                    unique_idx: np.ndarray, num_unique: int):
+    """Give every query entry the postings found for its distinct hash.
+    
+    `inverse` maps query entries to distinct hashes; the hits are those of the
+    distinct hashes, with `unique_idx` the distinct hash of each hit. Returns
+    ``(song_ids, db_offsets, entry_idx)`` with one row per (entry, posting).
+    """
+    order = np.argsort(unique_idx, kind='stable')
+    song_ids, db_offsets = song_ids[order], db_offsets[order]
+    counts = np.bincount(unique_idx, minlength=num_unique)
+    starts = np.cumsum(counts) - counts
+    
+    lengths = counts[inverse]
+    entry_idx = np.repeat(np.arange(len(inverse)), lengths)
+    run_starts = np.repeat(starts[inverse] - np.cumsum(lengths) + lengths, lengths)
+    postings = run_starts + np.arange(len(entry_idx))
+    return song_ids[postings], db_offsets[postings], entry_idx
+
+
+def align_songs(song_ids: np.ndarray, db_offsets: np.ndarray, sample_offsets: np.ndarray,
+                weights: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find every candidate song's tallest offset-histogram bin.
+    
+    Returns ``(songs, scores, deltas)`` where ``scores[i]`` is the largest
+    number of hits of ``songs[i]`` that share the same sample/database time
+    difference and ``deltas[i]`` is that difference (the smallest one on ties).
+    With per-hit `weights`, scores are the summed weights instead of counts.
+    """
+    if len(song_ids) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    
+    # Encode (song_id, time difference) pairs as single integers and count them
+    deltas = sample_offsets - db_offsets
+    min_delta = deltas.min()
+    span = deltas.max() - min_delta + 1
+    if weights is None:
+        keys, counts = np.unique(song_ids * span + (deltas - min_delta), return_counts=True)
+    else:
+        keys, inverse = np.unique(song_ids * span + (deltas - min_delta), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+    
+    # Keys are sorted by song, so each song's bins are contiguous; a stable sort
+    # by descending count puts each song's tallest bin first in its run
+    key_songs = keys // span
+    songs, starts = np.unique(key_songs, return_index=True)
+    tallest = np.lexsort((-counts, key_songs))[starts]
+    return songs, counts[tallest], keys[tallest] % span + min_delta
+
+
+def score_songs(song_ids: np.ndarray, db_offsets: np.ndarray, sample_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Score every candidate song by its tallest offset-histogram bin; returns ``(songs, scores)``."""
+    songs, scores, _ = align_songs(song_ids, db_offsets, sample_offsets)
+    return songs, scores
+
+
+def prune_candidates(song_ids: np.ndarray, top_k: Optional[int]) -> np.ndarray:
+    """Mask of the hits that belong to the `top_k` songs with the most hits.
+    
+    Counting hits per song is a single group-by, so it bounds the cost of the
+    offset alignment that follows however many songs share a popular hash.
+    """
+    if top_k is None or len(song_ids) == 0:
+        return np.ones(len(song_ids), dtype=bool)
+    songs, hits = np.unique(song_ids, return_counts=True)
+    if len(songs) <= top_k:
+        return np.ones(len(song_ids), dtype=bool)
+    keep = songs[np.argpartition(-hits, top_k - 1)[:top_k]]
+    return np.isin(song_ids, keep)
+
+
+def rank_candidates(song_ids: np.ndarray, db_offsets: np.ndarray, sample_offsets: np.ndarray,
+                    query_idx: np.ndarray, top_k: Optional[int] = DEFAULT_TOP_K,
+                    top_n: int = 5, weights: Optional[np.ndarray] = None) -> List[dict]:
+    """Two-phase ranking: prune to `top_k` songs by hit count, then align offsets.
+    
+    Returns up to `top_n` dicts with ``song_id``, ``score`` (hits in the
+    tallest offset bin, or their summed `weights`), ``hits`` (all hits of the
+    song) and ``offset_ms`` (where the query starts in the song), best first.
+    Ties go to the song that was hit first in query order. ``top_k=None``
+    aligns every candidate.
+    """
+    keep = prune_candidates(song_ids, top_k)
+    song_ids, db_offsets, sample_offsets, query_idx = (
+        song_ids[keep], db_offsets[keep], sample_offsets[keep], query_idx[keep]
+    )
+    if weights is not None:
+        weights = weights[keep]
+    songs, scores, deltas = align_songs(song_ids, db_offsets, sample_offsets, weights)
+    if len(songs) == 0:
+        return []
+    
+    positions = np.searchsorted(songs, song_ids)
+    hits = np.bincount(positions, minlength=len(songs))
+    first_hit = np.full(len(songs), np.iinfo(np.int64).max)
+    np.minimum.at(first_hit, positions, query_idx)
+    
+    order = np.lexsort((first_hit, -scores))[:top_n]
+    score_type = int if weights is None else float
+    return [
+        {'song_id': int(songs[i]), 'score': score_type(scores[i]), 'hits': int(hits[i]), 'offset_ms': int(-deltas[i])}
+        for i in order
+    ]
+
+
+def find_best_match(song_ids: np.ndarray, db_offsets: np.ndarray, sample_offsets: np.ndarray,
+                    query_idx: np.ndarray, top_k: Optional[int] = DEFAULT_TOP_K) -> Optional[Tuple[int, int]]:
+    """Return ``(song_id, score)`` of the highest-scoring song, or None without hits.
+    
+    Ties go to the song that was hit first in query order.
+    """
+    ranked = rank_candidates(song_ids, db_offsets, sample_offsets, query_idx, top_k, top_n=1)
+    if not ranked:
+        return None
+    return ranked[0]['song_id'], ranked[0]['score']
+
+
+class StreamingMatcher:
+    """Offset-histogram voting that is updated as query fingerprints arrive.
+    
+    Time differences are grouped into `offset_bin_ms` wide bins. Streamed
+    offsets use the nominal frame duration while indexed songs use one derived
+    from their length, so aligned hits drift apart by a few milliseconds.
+    """
+    
+    def __init__(self, offset_bin_ms: int = 1):
+        self.offset_bin_ms = offset_bin_ms
+        self.num_fingerprints = 0
+        self._bins = {}    # (song_id, time difference) -> hits
+        self._scores = {}  # song_id -> tallest bin, in first-hit order
+    
+    def update(self, song_ids: np.ndarray, db_offsets: np.ndarray, sample_offsets: np.ndarray,
+               num_fingerprints: int) -> None:
+        """Add the hits of `num_fingerprints` newly looked-up query fingerprints."""
+        self.num_fingerprints += num_fingerprints
+        if len(song_ids) == 0:
+            return
+        
+        deltas = (sample_offsets - db_offsets) // self.offset_bin_ms
+        bins, counts = np.unique(np.stack((song_ids, deltas), axis=1), axis=0, return_counts=True)
+        for (song_id, delta), count in zip(bins.tolist(), counts.tolist()):
+            total = self._bins.get((song_id, delta), 0) + count
+            self._bins[(song_id, delta)] = total
+            if total > self._scores.get(song_id, 0):
+                self._scores[song_id] = total
+    
+    def best(self) -> Optional[Tuple[int, int]]:
+        """Return ``(song_id, score)`` of the current best song, or None without hits."""
+        if not self._scores:
+            return None
+        song_id = max(self._scores, key=self._scores.get)
+        return song_id, self._scores[song_id]
+    
+    def runner_up_score(self) -> int:
+        """Tallest bin of the second-best song, 0 with fewer than two candidates."""
+        if len(self._scores) < 2:
+            return 0
+        return sorted(self._scores.values())[-2]
+    
+    @property
+    def confidence(self) -> float:
+        """Share of query fingerprints in the best song's tallest bin, in percent."""
+        best = self.best()
+        if not best or not self.num_fingerprints:
+            return 0
+        return best[1] / self.num_fingerprints * 100
@@ -0,0 +1,228 @@
+"""In-memory inverted fingerprint index with memory-mapped .npy persistence.
+
+Postings are kept CSR-style: a sorted array of distinct hashes, an `indptr`
+array marking where each hash's postings start, and parallel song_id/offset
+arrays. A whole query is looked up with one `np.searchsorted` call. The
+arrays can be saved as .npy files and loaded with ``mmap_mode='r'`` so that
+worker processes start quickly and share the same pages.
+
+SQLite stays the source of truth for songs and fingerprints; this index is a
+read-optimized copy of the fingerprints table. Each process keeps its copy
+current with `catch_up`, so songs added by another process are picked up.
+"""
+import json
+import logging
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from database import catalog_epoch
+
+logger = logging.getLogger(__name__)
+
+# Current hashes fit in 32 bits; int64 keeps version 1 catalogs (magnitude-based
+# hashes, often wider than 32 bits) loadable
+HASH_DTYPE = np.int64
+ARRAYS = ('keys', 'indptr', 'song_ids', 'offsets')
+MANIFEST_FILE = 'manifest.json'
+MAX_DELTA_POSTINGS = 1_000_000
+
+
+class MemoryIndex:
+    """Sorted, CSR-style hash -> (song_id, offset) postings."""
+    
+    def __init__(self, keys: np.ndarray, indptr: np.ndarray, song_ids: np.ndarray, offsets: np.ndarray):
+        self.keys = keys
+        self.indptr = indptr
+        self.song_ids = song_ids
+        self.offsets = offsets
+        # Songs added since the index was built, merged in once they grow large
+        self._delta: Optional[MemoryIndex] = None
+    
+    @classmethod
+    def from_postings(cls, hashes, song_ids, offsets) -> 'MemoryIndex':
+        """Build an index from unsorted parallel posting arrays."""
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        keys, starts = np.unique(hashes, return_index=True)
+        indptr = np.append(starts, len(hashes)).astype(np.int64)
+        return cls(keys, indptr,
+                   np.asarray(song_ids, dtype=np.int64)[order],
+                   np.asarray(offsets, dtype=np.int64)[order])
+    
+    @classmethod
+    def empty(cls) -> 'MemoryIndex':
+        return cls.from_postings([], [], [])
+    
+    @classmethod
+    def from_database(cls, conn) -> 'MemoryIndex':
+        """Load every fingerprint from SQLite, already in hash order."""
+        c = conn.cursor()
+        c.execute('SELECT COUNT(*) FROM fingerprints')
+        count = c.fetchone()[0]
+        c.execute('SELECT hash, song_id, offset FROM fingerprints ORDER BY hash')
+        rows = np.empty((count, 3), dtype=np.int64)
+        filled = 0
+        while True:
+            batch = c.fetchmany(100_000)
+            if not batch:
+                break
+            rows[filled:filled + len(batch)] = batch
+            filled += len(batch)
+        rows = rows[:filled]
+        return cls.from_postings(rows[:, 0], rows[:, 1], rows[:, 2])
+    
+    def __len__(self) -> int:
+        return len(self.song_ids) + (len(self._delta) if self._delta is not None else 0)
+    
+    def lookup(self, hashes, sample_offsets) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Look up a batch of query hashes.
+        
+        Same contract as `matching.lookup_fingerprints`: returns parallel arrays
+        ``(song_ids, db_offsets, sample_offsets, query_idx)``, one entry per hit.
+        """
+        hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+        sample_offsets = np.asarray(sample_offsets, dtype=np.int64)
+        
+        pos = np.searchsorted(self.keys, hashes)
+        pos[pos == len(self.keys)] = 0
+        found = np.flatnonzero((self.keys[pos] == hashes) if len(self.keys) else np.zeros(len(hashes), bool))
+        starts = self.indptr[pos[found]]
+        lengths = self.indptr[pos[found] + 1] - starts
+        
+        # Expand each matched hash into the positions of its postings
+        query_idx = np.repeat(found, lengths)
+        run_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        postings = run_starts + np.arange(len(query_idx))
+        
+        result = (self.song_ids[postings], self.offsets[postings], sample_offsets[query_idx], query_idx)
+        if self._delta is not None:
+            delta = self._delta.lookup(hashes, sample_offsets)
+            result = tuple(np.concatenate(pair) for pair in zip(result, delta))
+        return result
+    
+    def add(self, song_id: int, hashes, offsets) -> None:
+        """Add one song's fingerprints without rebuilding the main arrays."""
+        self.add_postings(hashes, np.full(len(hashes), song_id), offsets)
+    
+    def add_postings(self, hashes, song_ids, offsets) -> None:
+        """Add postings of any songs without rebuilding the main arrays."""
+        pending = [(hashes, song_ids, offsets)]
+        if self._delta is not None:
+            pending.append(self._delta.postings())
+        self._delta = MemoryIndex.from_postings(*(np.concatenate(column) for column in zip(*pending)))
+        if len(self._delta) > MAX_DELTA_POSTINGS:
+            self.compact()
+    
+    def with_postings(self, hashes, song_ids, offsets) -> 'MemoryIndex':
+        """A copy with postings added; the arrays are shared and this index is left unchanged."""
+        updated = MemoryIndex(self.keys, self.indptr, self.song_ids, self.offsets)
+        updated._delta = self._delta
+        updated.add_postings(hashes, song_ids, offsets)
+        return updated
+    
+    def postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All postings of the main arrays as ``(hashes, song_ids, offsets)``."""
+        return np.repeat(self.keys, np.diff(self.indptr)), self.song_ids, self.offsets
+    
+    def compact(self) -> None:
+        """Merge recently added songs into the main sorted arrays."""
+        if self._delta is None:
+            return
+        merged = MemoryIndex.from_postings(
+            *(np.concatenate(column) for column in zip(self.postings(), self._delta.postings()))
+        )
+        self.keys, self.indptr, self.song_ids, self.offsets = merged.keys, merged.indptr, merged.song_ids, merged.offsets
+        self._delta = None
+    
+    def clear(self) -> None:
+        empty = MemoryIndex.empty()
+        self.keys, self.indptr, self.song_ids, self.offsets = empty.keys, empty.indptr, empty.song_ids, empty.offsets
+        self._delta = None
+    
+    def save(self, directory: str, **manifest) -> None:
+        """Write the arrays as .npy files plus a manifest with extra metadata.
+        
+        Files are replaced atomically, so processes that have the previous
+        version memory-mapped keep reading consistent data.
+        """
+        self.compact()
+        os.makedirs(directory, exist_ok=True)
+        manifest['num_postings'] = len(self)
+        for name in ARRAYS + (MANIFEST_FILE,):
+            path = os.path.join(directory, name if name == MANIFEST_FILE else f'{name}.npy')
+            with open(path + '.tmp', 'wb') as out:
+                if name == MANIFEST_FILE:
+                    out.write(json.dumps(manifest).encode())
+                else:
+                    np.save(out, getattr(self, name))
+            os.replace(path + '.tmp', path)
+    
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> Tuple['MemoryIndex', dict]:
+        """Load a saved index, memory-mapped read-only by default; returns it with its manifest."""
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+        arrays = [np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r' if mmap else None)
+                  for name in ARRAYS]
+        return cls(*arrays), manifest
+
+
+def catalog_state(conn) -> dict:
+    """Summary of the fingerprints table used to tell whether a saved index is stale."""
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*), COALESCE(MAX(song_id), 0) FROM fingerprints')
+    num_postings, max_song_id = c.fetchone()
+    return {'num_postings': num_postings, 'max_song_id': max_song_id}
+
+
+def last_rowid(conn) -> int:
+    """Rowid of the newest fingerprints row, or 0."""
+    return conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM fingerprints').fetchone()[0]
+
+
+def catch_up(index: MemoryIndex, conn, rowid: int, epoch: int) -> Tuple[MemoryIndex, int, int]:
+    """Bring `index`, which holds the fingerprints rows up to `rowid`, in line with the table.
+    
+    `epoch` is the `catalog_epoch` the index was built in. Rows inserted
+    since are added to a copy of `index`. If rows were deleted (the catalog
+    was cleared or pruned, which bumps the epoch; SQLite then reuses their
+    rowids), the index is rebuilt from SQLite instead. Returns the new index,
+    the rowid of its last row and the epoch it reflects.
+    """
+    # One read transaction, so the epoch, the new rows and the row count agree
+    started_transaction = not conn.in_transaction
+    if started_transaction:
+        conn.execute('BEGIN')
+    try:
+        current_epoch = catalog_epoch(conn)
+        rows = np.array(conn.execute('SELECT hash, song_id, offset, rowid FROM fingerprints WHERE rowid > ?',
+                                     (rowid,)).fetchall(), dtype=np.int64).reshape(-1, 4)
+        total = conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        if current_epoch != epoch or len(index) + len(rows) != total:
+            logger.info('Fingerprints were removed from the database, rebuilding the index')
+            return MemoryIndex.from_database(conn), last_rowid(conn), current_epoch
+        if len(rows) == 0:
+            return index, rowid, epoch
+        return index.with_postings(rows[:, 0], rows[:, 1], rows[:, 2]), int(rows[:, 3].max()), epoch
+    finally:
+        if started_transaction:
+            conn.commit()
+
+
+def load_or_build(conn, directory: str) -> MemoryIndex:
+    """Load the index saved in `directory`, rebuilding it from SQLite if it is stale."""
+    state = catalog_state(conn)
+    if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        index, manifest = MemoryIndex.load(directory)
+        if all(manifest.get(key) == value for key, value in state.items()):
+            logger.info(f'Loaded fingerprint index from {directory} ({len(index)} postings)')
+            return index
+        logger.info(f'Fingerprint index in {directory} is stale, rebuilding')
+    
+    index = MemoryIndex.from_database(conn)
+    index.save(directory, max_song_id=state['max_song_id'])
+    logger.info(f'Built fingerprint index in {directory} ({len(index)} postings)')
+    return index
@@ -0,0 +1,191 @@
+"""Prometheus metrics for the matching service, in the text exposition format.
+
+Metrics are kept per process. Under gunicorn each worker reports its own
+series, so scrape every worker (or sum them on the Prometheus side).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Sequence, Tuple
+
+# Seconds, for stage and request latencies
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Item counts, for fingerprints, posting hits and candidates
+COUNT_BUCKETS = (1, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+_registry: List['_Metric'] = []
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type_name = ''
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+    
+    def _key(self, labels: dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_series(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    type_name = 'counter'
+    
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def _render_series(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}']
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    type_name = 'gauge'
+    
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+    
+    def _render_series(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}']
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed cumulative buckets."""
+    type_name = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent in the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def _render_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['counts']):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+        inf = 'le="+Inf"'
+        lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, inf)} {series["count"]}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {series["sum"]}')
+        lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {series["count"]}')
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Matching service metrics
+MATCH_STAGE_SECONDS = Histogram(
+    'match_stage_seconds', 'Time spent in each stage of a /match request.', ('stage',)
+)
+MATCH_FINGERPRINTS = Histogram(
+    'match_fingerprints', 'Fingerprints generated from a /match query.', buckets=COUNT_BUCKETS
+)
+MATCH_POSTING_HITS = Histogram(
+    'match_posting_hits', 'Catalog postings found for the fingerprints of a /match query.', buckets=COUNT_BUCKETS
+)
+MATCH_CANDIDATE_SONGS = Histogram(
+    'match_candidate_songs', 'Distinct songs sharing at least one fingerprint with a /match query.',
+    buckets=COUNT_BUCKETS
+)
+MATCH_STOPPED_FINGERPRINTS = Histogram(
+    'match_stopped_fingerprints', 'Query fingerprints whose hash is on the stop-list.', buckets=COUNT_BUCKETS
+)
+MATCH_REQUESTS = Counter(
+    'match_requests_total', 'Completed /match requests by outcome.', ('result',)
+)
+MATCH_BATCH_REQUESTS = Histogram(
+    'match_batch_requests', 'Requests served by one micro-batched lookup (batch fill).',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+MATCH_BATCH_FINGERPRINTS = Histogram(
+    'match_batch_fingerprints', 'Query fingerprints and distinct hashes in one micro-batched lookup.', ('kind',),
+    buckets=COUNT_BUCKETS
+)
+MATCH_BATCH_QUEUE_SECONDS = Histogram(
+    'match_batch_queue_seconds', 'Time a /match lookup waited for its micro-batch to start.'
+)
+MATCH_HASHES_REQUESTS = Counter(
+    'match_hashes_requests_total', 'Completed /match_hashes requests by outcome.', ('result',)
+)
+SNAPSHOT_SWAPS = Counter(
+    'snapshot_swaps_total', 'Index snapshot reloads by outcome.', ('result',)
+)
+SNAPSHOT_POSTINGS = Gauge(
+    'snapshot_postings', 'Fingerprint postings in the index snapshot being served.'
+)
+MATCH_QUEUE_DEPTH = Gauge(
+    'match_queue_depth', 'Match requests receiving their upload or waiting for a pipeline slot.'
+)
+MATCH_IN_FLIGHT = Gauge(
+    'match_in_flight', 'Match requests running the pipeline.'
+)
+MATCH_SHED = Counter(
+    'match_shed_total', 'Match requests rejected with 503 by admission control, by reason.', ('reason',)
+)
+MATCH_DEADLINE_MISSES = Counter(
+    'match_deadline_misses_total', 'Match requests cancelled because their deadline passed, by the stage skipped.',
+    ('stage',)
+)
@@ -0,0 +1,226 @@
+"""Scan long recordings for every catalog song that plays in them.
+
+A broadcast recording is read block by block and fingerprinted in a single
+streaming pass. Fingerprints are looked up as they are produced, and only the
+hits of the last `window` seconds are kept. Every `hop` seconds the window is
+scored like a /match query. Consecutive windows that agree on the song and its
+alignment are merged into one timeline segment. Only the opening of a song
+produces hits (see `compute_stft`), so a segment whose song length is in the
+catalog is extended to where the song ends, or to where the next song or the
+recording starts or ends. Memory use depends on the window length, not on the
+length of the recording.
+
+Usage:
+    python scan.py recording.wav [--window 10 --hop 5] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from shazam_fingerprint import FREQ_BIN_SIZE, HOP_SIZE, StreamingFingerprinter
+
+SCAN_WINDOW_SECONDS = 10.0
+SCAN_HOP_SECONDS = 5.0
+SCAN_MIN_SCORE = 20  # fingerprints at the same time offset
+SCAN_MIN_MARGIN = 3.0  # best score over the runner-up's
+SCAN_OFFSET_BIN_MS = 50
+SCAN_BLOCK_FRAMES = 65536
+
+# Fingerprint times advance FREQ_BIN_SIZE - HOP_SIZE downsampled samples per
+# STFT frame while frames are HOP_SIZE apart; this turns them into recording time
+TIME_SCALE = HOP_SIZE / (FREQ_BIN_SIZE - HOP_SIZE)
+
+
+class TimelineScanner:
+    """Windowed matching over a stream of fingerprints.
+    
+    `lookup(hashes, offsets)` returns ``(song_ids, db_offsets, sample_offsets)``
+    of the catalog postings for the query fingerprints, and `duration(song_id)`
+    the song's length in seconds, or None if it is not known. Feed
+    fingerprints in time order with `add`, call `advance` with the recording
+    time processed so far, and `finish` at the end; both return the segments
+    they closed.
+    """
+    
+    def __init__(self, lookup: Callable, window: float = SCAN_WINDOW_SECONDS, hop: float = SCAN_HOP_SECONDS,
+                 min_score: int = SCAN_MIN_SCORE, min_margin: float = SCAN_MIN_MARGIN,
+                 offset_bin_ms: int = SCAN_OFFSET_BIN_MS, duration: Callable[[int], Optional[float]] = None):
+        if hop <= 0 or window < hop:
+            raise ValueError('hop must be positive and no longer than window')
+        self.lookup = lookup
+        self.duration = duration or (lambda song_id: None)
+        self.window_ms = window * 1000 / TIME_SCALE
+        self.hop_ms = hop * 1000 / TIME_SCALE
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.offset_bin_ms = offset_bin_ms
+        self._window_end = self.window_ms
+        self._scored_until = 0.0
+        self._times = np.empty(0, dtype=np.int64)    # anchor time of every fingerprint
+        self._hits = np.empty((0, 3), dtype=np.int64)  # (song_id, offset bin, anchor time)
+        self._segment = None
+    
+    def add(self, hashes: np.ndarray, offsets: np.ndarray) -> None:
+        """Look up newly produced fingerprints and keep their hits."""
+        if len(hashes) == 0:
+            return
+        song_ids, db_offsets, sample_offsets = self.lookup(hashes, offsets)[:3]
+        self._times = np.concatenate((self._times, np.asarray(offsets, dtype=np.int64)))
+        deltas = (np.asarray(sample_offsets, dtype=np.int64) - db_offsets) // self.offset_bin_ms
+        hits = np.stack((song_ids, deltas, sample_offsets), axis=1).astype(np.int64)
+        self._hits = np.concatenate((self._hits, hits))
+    
+    def advance(self, processed_seconds: float) -> List[Dict]:
+        """Score every window that ends before `processed_seconds`."""
+        closed = []
+        while self._window_end <= processed_seconds * 1000 / TIME_SCALE:
+            closed.extend(self._score_window(self._window_end))
+            self._window_end += self.hop_ms
+        return closed
+    
+    def finish(self, processed_seconds: float) -> List[Dict]:
+        """Score the last, possibly partial window and close the open segment."""
+        closed = self.advance(processed_seconds)
+        end_ms = processed_seconds * 1000 / TIME_SCALE
+        if end_ms > self._scored_until:
+            closed.extend(self._score_window(end_ms))
+        if self._segment is not None:
+            closed.append(self._close_segment(end_ms))
+        return closed
+    
+    def _score_window(self, end_ms: float) -> List[Dict]:
+        start_ms = end_ms - self.window_ms
+        self._scored_until = end_ms
+        in_window = self._hits[(self._hits[:, 2] >= start_ms) & (self._hits[:, 2] < end_ms)]
+        num_fingerprints = np.count_nonzero((self._times >= start_ms) & (self._times < end_ms))
+        
+        # Only what the next window still needs is kept
+        next_start_ms = start_ms + self.hop_ms
+        self._hits = self._hits[self._hits[:, 2] >= next_start_ms]
+        self._times = self._times[self._times >= next_start_ms]
+        
+        detection = None
+        if len(in_window):
+            bins, counts = np.unique(in_window[:, :2], axis=0, return_counts=True)
+            order = np.argsort(-counts, kind='stable')
+            best = order[0]
+            runner_up = next((counts[i] for i in order[1:] if bins[i, 0] != bins[best, 0]), 0)
+            if counts[best] >= self.min_score and counts[best] >= self.min_margin * runner_up:
+                # Hits drift across neighbouring offset bins over the length of a song
+                aligned = ((in_window[:, 0] == bins[best, 0]) & (np.abs(in_window[:, 1] - bins[best, 1]) <= 1))
+                times = in_window[aligned, 2]
+                song_id = int(bins[best, 0])
+                duration = self.duration(song_id)
+                detection = {
+                    'song_id': song_id,
+                    'offset_bin': int(bins[best, 1]),
+                    'start_ms': int(times.min()),
+                    'end_ms': int(times.max()),
+                    # Where the song ends in the recording: its start there plus its length
+                    'song_end_ms': (None if duration is None
+                                    else float(bins[best, 1] * self.offset_bin_ms + duration * 1000 / TIME_SCALE)),
+                    'score': int(counts[best]),
+                    'confidence': float(counts[best] / max(num_fingerprints, 1) * 100),
+                }
+        
+        segment = self._segment
+        if detection is None:
+            if segment is None:
+                return []
+            if segment['song_end_ms'] is not None and end_ms < segment['song_end_ms']:
+                return []  # the song is still playing past its indexed opening
+            return [self._close_segment()]
+        if (segment is not None and segment['song_id'] == detection['song_id']
+                and abs(segment['offset_bin'] - detection['offset_bin']) <= 1):
+            segment['end_ms'] = max(segment['end_ms'], detection['end_ms'])
+            segment['score'] = max(segment['score'], detection['score'])
+            segment['confidence'] = max(segment['confidence'], detection['confidence'])
+            return []
+        if (segment is not None and segment['song_id'] == detection['song_id']
+                and segment['song_end_ms'] is not None and detection['start_ms'] < segment['song_end_ms']):
+            return []  # later passages of the song resembling its opening at another alignment
+        closed = [self._close_segment(detection['start_ms'])] if segment is not None else []
+        self._segment = detection
+        return closed
+    
+    def _close_segment(self, until_ms: float = None) -> Dict:
+        """Close the open segment, ending it no later than `until_ms` if given."""
+        segment, self._segment = self._segment, None
+        end_ms = segment['end_ms']
+        if segment['song_end_ms'] is not None:
+            song_end_ms = segment['song_end_ms'] if until_ms is None else min(segment['song_end_ms'], until_ms)
+            end_ms = max(end_ms, song_end_ms)
+        return {
+            'song_id': segment['song_id'],
+            'start': round(segment['start_ms'] * TIME_SCALE / 1000, 3),
+            'end': round(end_ms * TIME_SCALE / 1000, 3),
+            'score': segment['score'],
+            'confidence': round(segment['confidence'], 2),
+        }
+
+
+def scan_blocks(blocks: Iterable[np.ndarray], sample_rate: int, lookup: Callable,
+                **options) -> Iterator[Dict]:
+    """Yield timeline segments ``{song_id, start, end, score, confidence}`` of a recording.
+    
+    `blocks` are consecutive mono sample blocks; `start` and `end` are seconds
+    into the recording, and `confidence` is the highest share of a window's
+    fingerprints aligned with the song, in percent. `end` is where the song
+    stops playing if the `duration` option gives its length, otherwise the
+    last matched fingerprint. Segments are yielded as
+    soon as they end.
+    """
+    fingerprinter = StreamingFingerprinter(sample_rate)
+    scanner = TimelineScanner(lookup, **options)
+    for block in blocks:
+        scanner.add(*fingerprinter.feed(block))
+        yield from scanner.advance(fingerprinter.samples_seen / sample_rate)
+    yield from scanner.finish(fingerprinter.samples_seen / sample_rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find every catalog song played in a long recording.')
+    parser.add_argument('recording')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'songs.db'))
+    parser.add_argument('--window', type=float, default=SCAN_WINDOW_SECONDS, help='Window length in seconds')
+    parser.add_argument('--hop', type=float, default=SCAN_HOP_SECONDS, help='Seconds between windows')
+    parser.add_argument('--min-score', type=int, default=SCAN_MIN_SCORE)
+    parser.add_argument('--json', action='store_true', help='Print one JSON object per segment')
+    args = parser.parse_args()
+    
+    from audio_io import AudioDecodeError, read_audio_blocks
+    from database import connect, init_db
+    from matching import lookup_fingerprints
+    
+    init_db(args.database)
+    conn = connect(args.database)
+    try:
+        names, durations = {}, {}
+        for song_id, name, duration in conn.execute('SELECT id, name, duration FROM songs'):
+            names[song_id], durations[song_id] = name, duration
+        blocks, sample_rate, _ = read_audio_blocks(args.recording, SCAN_BLOCK_FRAMES)
+        segments = scan_blocks(blocks, sample_rate,
+                               lambda hashes, offsets: lookup_fingerprints(conn, hashes.tolist(), offsets.tolist()),
+                               window=args.window, hop=args.hop, min_score=args.min_score,
+                               duration=durations.get)
+        for segment in segments:
+            segment['name'] = names.get(segment['song_id'])
+            if args.json:
+                print(json.dumps(segment), flush=True)
+            else:
+                print(f"{segment['start']:>10.1f}s {segment['end']:>10.1f}s  {segment['confidence']:>6.2f}%  "
+                      f"{segment['song_id']:>6}  {segment['name']}", flush=True)
+    except AudioDecodeError as e:
+        print(f'Could not decode {args.recording}: {e}', file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
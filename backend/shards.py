@@ -0,0 +1,386 @@
+"""Fingerprint store partitioned by hash range across several SQLite files.
+
+Each shard file holds the fingerprints whose hash falls in its range
+``[start, next shard's start)``; song metadata stays in songs.db. The layout
+is described by ``shards.json`` in the shard directory. When serving, every
+shard gets its own lookup process with a long-lived connection: a query is
+split by hash range, sent to all shards at once and the hits are merged back
+into the single-table lookup contract, so scoring is unchanged.
+
+Usage:
+    python shards.py init --count 4 [--database songs.db] [--directory DIR]
+    python shards.py split SHARD [--at HASH] [--directory DIR]
+    python shards.py stats [--directory DIR]
+
+``init`` copies the fingerprints already in songs.db into the shards, with
+ranges chosen so the shards start out evenly filled. ``split`` divides one
+shard in two at its median hash (or at ``--at``) by copying rows between the
+shard files, so no audio is fingerprinted again. Restart the server after a
+split to pick up the new layout.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from typing import List, Tuple
+
+import numpy as np
+
+from database import CREATE_HASH_INDEX, MIGRATIONS, connect, insert_fingerprints
+from matching import lookup_fingerprints
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = 'shards.json'
+CREATE_FINGERPRINTS = MIGRATIONS[0][1]
+# Ranges for shards created before any fingerprints exist
+DEFAULT_HASH_SPAN = 1 << 32
+
+
+def read_manifest(directory: str) -> List[dict]:
+    """Shards of `directory` as dicts with ``file`` and ``start``, in hash order."""
+    with open(os.path.join(directory, MANIFEST_FILE)) as f:
+        return json.load(f)['shards']
+
+
+def write_manifest(directory: str, shards: List[dict]) -> None:
+    """Replace the manifest atomically."""
+    path = os.path.join(directory, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'shards': sorted(shards, key=lambda shard: shard['start'])}, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def init_shard(path: str) -> None:
+    """Create an empty shard file with the fingerprints table and hash index."""
+    conn = connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(CREATE_FINGERPRINTS)
+        conn.execute(CREATE_HASH_INDEX)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _serve_shard(path: str, pipe) -> None:
+    """Lookup loop of one shard process: receives query batches, returns hits."""
+    conn = connect(path)
+    try:
+        while True:
+            try:
+                request = pipe.recv()
+            except EOFError:
+                return
+            if request is None:
+                return
+            hashes, sample_offsets = request
+            try:
+                pipe.send(lookup_fingerprints(conn, hashes.tolist(), sample_offsets.tolist(), join_songs=False))
+            except Exception as e:
+                pipe.send(e)
+    finally:
+        conn.close()
+
+
+class ShardedIndex:
+    """Scatter-gather lookups over the shards described in `directory`."""
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        shards = read_manifest(directory)
+        self.paths = [os.path.join(directory, shard['file']) for shard in shards]
+        self.starts = np.array([shard['start'] for shard in shards], dtype=np.int64)
+        self._workers = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+    
+    def __len__(self) -> int:
+        return len(self.paths)
+    
+    def shard_of(self, hashes: np.ndarray) -> np.ndarray:
+        """Index of the shard responsible for each hash."""
+        return np.maximum(np.searchsorted(self.starts, hashes, side='right') - 1, 0)
+    
+    def _ensure_workers(self):
+        # Lookup processes belong to the process that started them; a forked
+        # server worker starts its own
+        with self._start_lock:
+            if self._workers is None or self._pid != os.getpid():
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._workers = []
+                for path in self.paths:
+                    parent, child = context.Pipe()
+                    process = context.Process(target=_serve_shard, args=(path, child), daemon=True)
+                    process.start()
+                    child.close()
+                    self._workers.append((process, parent, threading.Lock()))
+                self._pid = os.getpid()
+        return self._workers
+    
+    def lookup(self, hashes, sample_offsets) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Look up a batch of query hashes on all shards in parallel.
+        
+        Same contract as `matching.lookup_fingerprints`.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        sample_offsets = np.asarray(sample_offsets, dtype=np.int64)
+        workers = self._ensure_workers()
+        shard = self.shard_of(hashes)
+        
+        # Send to every shard before waiting on any; locks are always taken in
+        # shard order so concurrent requests cannot deadlock
+        pending = []
+        error = None
+        for i, (_, pipe, lock) in enumerate(workers):
+            members = np.flatnonzero(shard == i)
+            if len(members) == 0:
+                continue
+            lock.acquire()
+            pending.append((i, members))
+            try:
+                pipe.send((hashes[members], sample_offsets[members]))
+            except OSError as e:
+                error = e
+                break
+        
+        results = []
+        for i, members in pending:
+            _, pipe, lock = workers[i]
+            try:
+                reply = pipe.recv() if error is None else None
+            except (EOFError, OSError) as e:
+                error = reply = e
+            finally:
+                lock.release()
+            if isinstance(reply, Exception):
+                error = reply
+            elif reply is not None:
+                song_ids, db_offsets, offsets, local_idx = reply
+                results.append((song_ids, db_offsets, offsets, members[local_idx]))
+        if isinstance(error, (EOFError, OSError)):
+            # A lookup process died; start a fresh set on the next query
+            logger.error(f'Shard lookup process failed: {error!r}')
+            self._restart()
+        if error is not None:
+            raise error
+        if not results:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        return tuple(np.concatenate(column) for column in zip(*results))
+    
+    def add(self, song_id: int, hashes, offsets) -> None:
+        """Write one song's fingerprints to the shards that own them.
+        
+        Each shard commits separately; if one fails, the song's rows are
+        removed from all shards again before the error is raised.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        shard = self.shard_of(hashes)
+        try:
+            for i, path in enumerate(self.paths):
+                members = shard == i
+                if not members.any():
+                    continue
+                conn = connect(path)
+                try:
+                    with conn:
+                        insert_fingerprints(conn, song_id, hashes[members], offsets[members])
+                finally:
+                    conn.close()
+        except Exception:
+            self.remove_song(song_id)
+            raise
+    
+    def remove_hashes(self, hashes) -> int:
+        """Delete every posting of `hashes` from the shards that own them; returns the rows removed."""
+        hashes = np.unique(np.asarray(hashes, dtype=np.int64))
+        shard = self.shard_of(hashes)
+        removed = 0
+        for i, path in enumerate(self.paths):
+            members = hashes[shard == i]
+            if not len(members):
+                continue
+            conn = connect(path)
+            try:
+                with conn:
+                    before = conn.total_changes
+                    conn.executemany('DELETE FROM fingerprints WHERE hash = ?', ((int(h),) for h in members))
+                    removed += conn.total_changes - before
+            finally:
+                conn.close()
+        return removed
+    
+    def remove_song(self, song_id: int) -> None:
+        self._execute_all('DELETE FROM fingerprints WHERE song_id = ?', (song_id,))
+    
+    def clear(self) -> None:
+        self._execute_all('DELETE FROM fingerprints')
+    
+    def _execute_all(self, sql, params=()):
+        for path in self.paths:
+            conn = connect(path)
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            finally:
+                conn.close()
+    
+    def _restart(self) -> None:
+        with self._start_lock:
+            for process, pipe, _ in self._workers or ():
+                process.terminate()
+                pipe.close()
+            self._workers = None
+    
+    def close(self) -> None:
+        """Stop this process's lookup processes."""
+        if self._workers is None or self._pid != os.getpid():
+            return
+        for process, pipe, _ in self._workers:
+            try:
+                pipe.send(None)
+            except OSError:
+                pass
+            process.join(timeout=5)
+        self._workers = None
+
+
+def create_shards(directory: str, count: int, database_path: str) -> List[dict]:
+    """Create `count` shards, filled from the fingerprints in `database_path`.
+    
+    Shard ranges start at quantiles of the existing hashes so the shards are
+    evenly filled, or split ``[0, 2**32)`` evenly for an empty catalog.
+    """
+    if os.path.exists(os.path.join(directory, MANIFEST_FILE)):
+        raise FileExistsError(f'{directory} already contains shards')
+    os.makedirs(directory, exist_ok=True)
+    
+    source = connect(database_path)
+    try:
+        total = source.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        if total:
+            starts = [0]
+            for k in range(1, count):
+                starts.append(source.execute('SELECT hash FROM fingerprints ORDER BY hash LIMIT 1 OFFSET ?',
+                                             (total * k // count,)).fetchone()[0])
+        else:
+            starts = [DEFAULT_HASH_SPAN * k // count for k in range(count)]
+    finally:
+        source.close()
+    
+    # Duplicate starts come from very common hashes; keep each range once
+    starts = sorted(set(starts))
+    shards = [{'file': f'shard-{k:03d}.db', 'start': start} for k, start in enumerate(starts)]
+    ends = starts[1:] + [None]
+    for shard, end in zip(shards, ends):
+        path = os.path.join(directory, shard['file'])
+        init_shard(path)
+        conn = connect(path)
+        try:
+            conn.execute('ATTACH DATABASE ? AS source', (database_path,))
+            with conn:
+                conn.execute(
+                    'INSERT INTO fingerprints (hash, song_id, offset) '
+                    'SELECT hash, song_id, offset FROM source.fingerprints WHERE hash >= ? AND (? IS NULL OR hash < ?)',
+                    (shard['start'], end, end)
+                )
+            conn.execute('DETACH DATABASE source')
+        finally:
+            conn.close()
+    write_manifest(directory, shards)
+    return shards
+
+
+def split_shard(directory: str, index: int, at: int = None) -> List[dict]:
+    """Split shard `index` in two at hash `at`, by default its median hash.
+    
+    Rows from `at` upwards are copied to a new shard file and the manifest is
+    updated before they are deleted from the old one, so an interrupted split
+    never loses fingerprints.
+    """
+    shards = read_manifest(directory)
+    shard = shards[index]
+    end = shards[index + 1]['start'] if index + 1 < len(shards) else None
+    path = os.path.join(directory, shard['file'])
+    
+    conn = connect(path)
+    try:
+        if at is None:
+            count = conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+            if count < 2:
+                raise ValueError(f"Shard {shard['file']} has too few fingerprints to split")
+            at = conn.execute('SELECT hash FROM fingerprints ORDER BY hash LIMIT 1 OFFSET ?',
+                              (count // 2,)).fetchone()[0]
+        if at <= shard['start'] or (end is not None and at >= end):
+            raise ValueError(f"Split point {at} is outside shard {shard['file']}")
+        
+        existing = {s['file'] for s in shards}
+        new_file = next(f'shard-{k:03d}.db' for k in range(len(shards) + 1) if f'shard-{k:03d}.db' not in existing)
+        new_path = os.path.join(directory, new_file)
+        init_shard(new_path)
+        conn.execute('ATTACH DATABASE ? AS target', (new_path,))
+        with conn:
+            conn.execute('INSERT INTO target.fingerprints (hash, song_id, offset) '
+                         'SELECT hash, song_id, offset FROM fingerprints WHERE hash >= ? AND (? IS NULL OR hash < ?)',
+                         (at, end, end))
+        conn.execute('DETACH DATABASE target')
+        
+        shards.append({'file': new_file, 'start': at})
+        write_manifest(directory, shards)
+        
+        with conn:
+            conn.execute('DELETE FROM fingerprints WHERE hash >= ?', (at,))
+    finally:
+        conn.close()
+    return read_manifest(directory)
+
+
+def shard_stats(directory: str) -> List[dict]:
+    """Per-shard range and row count."""
+    shards = read_manifest(directory)
+    stats = []
+    for k, shard in enumerate(shards):
+        conn = connect(os.path.join(directory, shard['file']))
+        try:
+            rows = conn.execute('SELECT COUNT(*) FROM fingerprints').fetchone()[0]
+        finally:
+            conn.close()
+        end = shards[k + 1]['start'] if k + 1 < len(shards) else None
+        stats.append({'file': shard['file'], 'start': shard['start'], 'end': end, 'fingerprints': rows})
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the hash-range sharded fingerprint store.')
+    parser.add_argument('--directory', default=os.environ.get('SHARD_DIR', 'fingerprint_shards'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    init = commands.add_parser('init', help='Create shards from the fingerprints in the songs database')
+    init.add_argument('--count', type=int, default=int(os.environ.get('SHARD_COUNT', '4')))
+    init.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'songs.db'))
+    split = commands.add_parser('split', help='Split one shard in two without re-fingerprinting')
+    split.add_argument('shard', type=int, help='Position of the shard in hash order (see stats)')
+    split.add_argument('--at', type=int, help='First hash of the new shard (default: median)')
+    commands.add_parser('stats', help='Show shard ranges and sizes')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'init':
+        create_shards(args.directory, args.count, args.database)
+    elif args.command == 'split':
+        split_shard(args.directory, args.shard, args.at)
+    
+    print(f'{"shard":>6}  {"file":<16}{"start":>16}{"end":>16}{"fingerprints":>14}')
+    for k, shard in enumerate(shard_stats(args.directory)):
+        end = '' if shard['end'] is None else shard['end']
+        print(f"{k:>6}  {shard['file']:<16}{shard['start']:>16}{end:>16}{shard['fingerprints']:>14,}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
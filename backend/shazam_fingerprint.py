@@ -1,6 +1,7 @@
 import numpy as np
 from scipy import signal
-from typing import List, Tuple, Dict
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Iterable, Tuple
 
 # Constants matching SeekTune's implementation
 DSP_RATIO = 4
@@ -9,28 +10,26 @@ MAX_FREQ = 5000.0  # 5kHz
 HOP_SIZE = FREQ_BIN_SIZE // 32
 TARGET_ZONE_SIZE = 5  # Number of points to look ahead for fingerprinting
 
-class Peak:
-    def __init__(self, time: float, freq: complex):
-        self.time = time
-        self.freq = freq
+# Frequency bands (FFT bin ranges) searched for peaks, as in the Go implementation
+BANDS = [(0, 10), (10, 20), (20, 40), (40, 80), (80, 160), (160, 512)]
+
+# Bumped whenever the hashes produced for the same audio change; catalogs
+# fingerprinted with another version have to be re-indexed
+FINGERPRINT_VERSION = 2
+
+# One record per spectrogram peak
+PEAK_DTYPE = np.dtype([('time_ms', np.uint32), ('freq_bin', np.uint16), ('magnitude', np.float32)])
 
 def low_pass_filter(cutoff_frequency: float, sample_rate: float, input_signal: np.ndarray) -> np.ndarray:
     """First-order low-pass filter that attenuates high frequencies."""
+    return signal.lfilter(*_low_pass_coefficients(cutoff_frequency, sample_rate), input_signal)
+
+def _low_pass_coefficients(cutoff_frequency: float, sample_rate: float) -> Tuple[list, list]:
+    """lfilter coefficients of ``y[n] = alpha * x[n] + (1 - alpha) * y[n-1]``."""
     rc = 1.0 / (2 * np.pi * cutoff_frequency)
     dt = 1.0 / sample_rate
     alpha = dt / (rc + dt)
-    
-    filtered_signal = np.zeros_like(input_signal)
-    prev_output = 0.0
-    
-    for i, x in enumerate(input_signal):
-        if i == 0:
-            filtered_signal[i] = x * alpha
-        else:
-            filtered_signal[i] = alpha * x + (1 - alpha) * prev_output
-        prev_output = filtered_signal[i]
-    
-    return filtered_signal
+    return [alpha], [1.0, alpha - 1.0]
 
 def downsample(input_signal: np.ndarray, original_sample_rate: int, target_sample_rate: int) -> np.ndarray:
     """Downsample the input audio."""
@@ -43,131 +42,256 @@ def downsample(input_signal: np.ndarray, original_sample_rate: int, target_sampl
     if ratio <= 0:
         raise ValueError("Invalid ratio calculated from sample rates")
     
-    # Use numpy's array operations for efficient downsampling
-    resampled = np.array([np.mean(input_signal[i:i+ratio]) 
-                         for i in range(0, len(input_signal), ratio)])
+    # Average each group of `ratio` samples; a trailing partial group is averaged on its own
+    full_length = len(input_signal) - len(input_signal) % ratio
+    resampled = input_signal[:full_length].reshape(-1, ratio).mean(axis=1)
+    if full_length < len(input_signal):
+        resampled = np.append(resampled, np.mean(input_signal[full_length:]))
     return resampled
 
 def create_spectrogram(samples: np.ndarray, sample_rate: int) -> np.ndarray:
-    """Create a spectrogram from audio samples using the Go implementation's approach."""
+    """Create a spectrogram from audio samples using the Go implementation's approach.
+    
+    Each row holds the non-negative frequency half (``FREQ_BIN_SIZE // 2 + 1``
+    bins) of one Hamming-windowed frame.
+    """
     # Apply low-pass filter
     filtered_samples = low_pass_filter(MAX_FREQ, sample_rate, samples)
     
     # Downsample
     downsampled_samples = downsample(filtered_samples, sample_rate, sample_rate // DSP_RATIO)
     
+    return compute_stft(downsampled_samples)
+
+def compute_stft(downsampled_samples: np.ndarray, num_windows: int = None) -> np.ndarray:
+    """Hamming-windowed FFT of every frame of the downsampled signal.
+    
+    `num_windows` defaults to the number create_spectrogram derives from the
+    signal length; pass it when only the frames' samples are given.
+    """
     # Calculate number of windows
-    num_windows = len(downsampled_samples) // (FREQ_BIN_SIZE - HOP_SIZE)
-    
-    # Create Hamming window
-    window = np.hamming(FREQ_BIN_SIZE)
-    
-    # Perform STFT
-    spectrogram = []
-    for i in range(num_windows):
-        start = i * HOP_SIZE
-        end = start + FREQ_BIN_SIZE
-        if end > len(downsampled_samples):
-            end = len(downsampled_samples)
-        
-        # Get the window of samples
-        bin_samples = np.zeros(FREQ_BIN_SIZE)
-        bin_samples[:end-start] = downsampled_samples[start:end]
-        
-        # Apply window
-        windowed = bin_samples * window
-        
-        # Perform FFT
-        spectrum = np.fft.fft(windowed)
-        spectrogram.append(spectrum)
+    if num_windows is None:
+        num_windows = len(downsampled_samples) // (FREQ_BIN_SIZE - HOP_SIZE)
+    if num_windows == 0:
+        return np.empty((0, FREQ_BIN_SIZE // 2 + 1), dtype=np.complex128)
+    
+    # Zero-pad so the last window is always complete
+    padded_length = (num_windows - 1) * HOP_SIZE + FREQ_BIN_SIZE
+    if len(downsampled_samples) < padded_length:
+        downsampled_samples = np.pad(downsampled_samples, (0, padded_length - len(downsampled_samples)))
+    
+    # Strided view of all frames, windowed and transformed in one batch
+    frames = sliding_window_view(downsampled_samples, FREQ_BIN_SIZE)[::HOP_SIZE][:num_windows]
+    return np.fft.rfft(frames * np.hamming(FREQ_BIN_SIZE), axis=1)
+
+def _band_peaks(spectrogram: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Frame and bin indices of the band maxima that exceed their frame's average."""
+    magnitudes = np.abs(spectrogram)
+    
+    # Strongest bin of every band, for all frames at once
+    band_idx = np.stack(
+        [band_min + np.argmax(magnitudes[:, band_min:band_max], axis=1) for band_min, band_max in BANDS],
+        axis=1
+    )
+    band_mags = np.take_along_axis(magnitudes, band_idx, axis=1)
     
-    return np.array(spectrogram)
+    # Keep band maxima that exceed the frame's average band maximum
+    frame_idx, band = np.nonzero(band_mags > band_mags.mean(axis=1, keepdims=True))
+    return frame_idx, band_idx[frame_idx, band]
 
-def extract_peaks(spectrogram: np.ndarray, audio_duration: float) -> List[Peak]:
-    """Extract peaks from the spectrogram using the Go implementation's approach."""
+def extract_peaks(spectrogram: np.ndarray, audio_duration: float) -> np.ndarray:
+    """Extract peaks from the spectrogram using the Go implementation's approach.
+    
+    Returns a PEAK_DTYPE array in frame order, and in band order within a frame.
+    """
     if len(spectrogram) < 1:
-        return []
+        return np.empty(0, dtype=PEAK_DTYPE)
     
-    # Define frequency bands as in Go implementation
-    bands = [(0, 10), (10, 20), (20, 40), (40, 80), (80, 160), (160, 512)]
-    peaks = []
     bin_duration = audio_duration / len(spectrogram)
+    frame_idx, freq_idx = _band_peaks(spectrogram)
     
-    for bin_idx, bin_data in enumerate(spectrogram):
-        bin_band_maxies = []
+    peaks = np.empty(len(frame_idx), dtype=PEAK_DTYPE)
+    peaks['time_ms'] = (frame_idx * bin_duration + freq_idx * bin_duration / FREQ_BIN_SIZE) * 1000
+    peaks['freq_bin'] = freq_idx
+    peaks['magnitude'] = np.abs(spectrogram[frame_idx, freq_idx])
+    return peaks
+
+def generate_fingerprints(peaks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash every peak with the TARGET_ZONE_SIZE peaks that follow it.
+    
+    Returns parallel uint32 arrays ``(hashes, anchor_times_ms)``, anchor-major.
+    A hash that occurs several times in a track is kept every time.
+    """
+    return _pair_hashes(peaks['time_ms'], peaks['freq_bin'])
+
+def _pair_hashes(times_ms: np.ndarray, freq_bins: np.ndarray, first_target: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash every anchor with the peaks in its target zone, anchor-major.
+    
+    Only pairs whose target index is at least `first_target` are produced.
+    Each hash packs the anchor bin, the target bin and the time difference in
+    milliseconds as ``anchor << 23 | target << 14 | delta & 0x3FFF``; bins are
+    below 512, so hashes fit in 32 bits. Returns ``(hashes, anchor_times_ms)``.
+    """
+    anchors = np.arange(len(times_ms))[:, None]
+    targets = anchors + np.arange(1, TARGET_ZONE_SIZE + 1)
+    valid = (targets < len(times_ms)) & (targets >= first_target)
+    anchors = np.broadcast_to(anchors, targets.shape)[valid]
+    targets = targets[valid]
+    
+    times_ms = times_ms.astype(np.int64)
+    freq_bins = freq_bins.astype(np.uint32)
+    delta_times = ((times_ms[targets] - times_ms[anchors]) & 0x3FFF).astype(np.uint32)
+    hashes = (freq_bins[anchors] << 23) | (freq_bins[targets] << 14) | delta_times
+    return hashes, times_ms[anchors].astype(np.uint32)
+
+class StreamingFingerprinter:
+    """Incremental version of create_spectrogram, extract_peaks and generate_fingerprints.
+    
+    Carries the low-pass filter state, the partial downsampling group, the
+    overlap between STFT frames and the last TARGET_ZONE_SIZE peaks from one
+    call of `feed` to the next, so audio can be fingerprinted as it arrives.
+    While streaming the total duration is unknown, so peak times use the
+    nominal frame duration rather than ``audio_duration / num_windows``.
+    When the length is known up front, pass that `bin_duration` and the
+    `max_frames` the batch pipeline would compute to reproduce its hashes.
+    """
+    
+    def __init__(self, sample_rate: int, bin_duration: float = None, max_frames: int = None):
+        self.sample_rate = sample_rate
+        self.ratio = sample_rate // (sample_rate // DSP_RATIO)
+        self.bin_duration = bin_duration or (FREQ_BIN_SIZE - HOP_SIZE) * self.ratio / sample_rate
+        self.max_frames = max_frames
+        self.samples_seen = 0
         
-        # Find maximum magnitude in each frequency band
-        for band_min, band_max in bands:
-            max_mag = 0.0
-            max_freq = 0j
-            max_freq_idx = band_min
-            
-            for idx, freq in enumerate(bin_data[band_min:band_max], start=band_min):
-                magnitude = abs(freq)
-                if magnitude > max_mag:
-                    max_mag = magnitude
-                    max_freq = freq
-                    max_freq_idx = idx
-            
-            bin_band_maxies.append((max_mag, max_freq, max_freq_idx))
+        self._filter = _low_pass_coefficients(MAX_FREQ, sample_rate)
+        self._filter_state = np.zeros(1)
+        self._remainder = np.empty(0)
+        self._overlap = np.empty(0, dtype=np.float32)
+        self._window = np.hamming(FREQ_BIN_SIZE).astype(np.float32)
+        self._frames_done = 0
+        self._tail_times = np.empty(0, dtype=np.uint32)
+        self._tail_bins = np.empty(0, dtype=np.uint16)
+    
+    @property
+    def done(self) -> bool:
+        """Whether all `max_frames` frames have been fingerprinted."""
+        return self.max_frames is not None and self._frames_done >= self.max_frames
+    
+    def feed(self, samples: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Consume the next block of mono samples.
         
-        # Calculate average magnitude
-        max_mags = [x[0] for x in bin_band_maxies]
-        avg = np.mean(max_mags)
+        Returns ``(hashes, anchor_times_ms)`` of the fingerprints completed by
+        this block; duplicate hashes are kept.
+        """
+        self.samples_seen += len(samples)
+        if self.done:
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+        filtered, self._filter_state = signal.lfilter(*self._filter, samples, zi=self._filter_state)
         
-        # Add peaks that exceed average magnitude
-        for max_mag, max_freq, freq_idx in bin_band_maxies:
-            if max_mag > avg:
-                peak_time_in_bin = freq_idx * bin_duration / len(bin_data)
-                peak_time = bin_idx * bin_duration + peak_time_in_bin
-                peaks.append(Peak(peak_time, max_freq))
+        # Downsample whole groups only, keeping the rest for the next block
+        filtered = np.concatenate((self._remainder, filtered))
+        usable = len(filtered) - len(filtered) % self.ratio
+        self._remainder = filtered[usable:]
+        return self._fingerprint_frames(filtered[:usable].reshape(-1, self.ratio).mean(axis=1))
     
-    return peaks
+    def finish(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Flush the partial downsampling group at the end of the audio.
+        
+        With `max_frames` set, the signal is zero-padded so the last frames
+        are complete, as in compute_stft.
+        """
+        downsampled = np.mean(self._remainder, keepdims=True) if len(self._remainder) else np.empty(0)
+        self._remainder = np.empty(0)
+        if self.max_frames is not None and not self.done:
+            missing = (self.max_frames - self._frames_done - 1) * HOP_SIZE + FREQ_BIN_SIZE
+            missing -= len(self._overlap) + len(downsampled)
+            downsampled = np.pad(downsampled, (0, max(missing, 0)))
+        return self._fingerprint_frames(downsampled)
+    
+    def _fingerprint_frames(self, downsampled: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # The filter runs in float64; frames and spectra only need float32/complex64
+        downsampled = np.concatenate((self._overlap, downsampled.astype(np.float32)))
+        num_frames = (len(downsampled) - FREQ_BIN_SIZE) // HOP_SIZE + 1 if len(downsampled) >= FREQ_BIN_SIZE else 0
+        if self.max_frames is not None:
+            num_frames = min(num_frames, self.max_frames - self._frames_done)
+        if num_frames <= 0:
+            self._overlap = downsampled
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+        
+        frames = sliding_window_view(downsampled, FREQ_BIN_SIZE)[::HOP_SIZE][:num_frames]
+        spectrogram = np.fft.rfft(frames * self._window, axis=1)
+        self._overlap = downsampled[num_frames * HOP_SIZE:]
+        
+        frame_idx, freq_idx = _band_peaks(spectrogram)
+        frame_idx = frame_idx + self._frames_done
+        self._frames_done += num_frames
+        times = frame_idx * self.bin_duration + freq_idx * self.bin_duration / FREQ_BIN_SIZE
+        
+        # Pair new peaks with the tail of the previous block as targets arrive
+        times_ms = np.concatenate((self._tail_times, (times * 1000).astype(np.uint32)))
+        freq_bins = np.concatenate((self._tail_bins, freq_idx.astype(np.uint16)))
+        hashes, anchor_times = _pair_hashes(times_ms, freq_bins, first_target=len(self._tail_times))
+        self._tail_times = times_ms[-TARGET_ZONE_SIZE:]
+        self._tail_bins = freq_bins[-TARGET_ZONE_SIZE:]
+        return hashes, anchor_times
+
+def fingerprint_samples(samples: np.ndarray, sample_rate: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Run the whole pipeline on mono samples; returns ``(hashes, anchor_times_ms)``."""
+    spectrogram = create_spectrogram(samples, sample_rate)
+    peaks = extract_peaks(spectrogram, len(samples) / sample_rate)
+    return generate_fingerprints(peaks)
+
+def downsample_blocks(blocks: Iterable[np.ndarray], sample_rate: int, num_samples: int) -> Tuple[np.ndarray, int]:
+    """Low-pass filter and downsample a track of known length block by block.
+    
+    Returns ``(downsampled, num_windows)``: the part of the downsampled signal
+    that the `num_windows` frames of create_spectrogram read, as float32. Blocks
+    past that part are not consumed.
+    """
+    ratio = sample_rate // (sample_rate // DSP_RATIO)
+    num_windows = -(-num_samples // ratio) // (FREQ_BIN_SIZE - HOP_SIZE)
+    needed = (num_windows - 1) * HOP_SIZE + FREQ_BIN_SIZE if num_windows else 0
+    
+    coefficients = _low_pass_coefficients(MAX_FREQ, sample_rate)
+    filter_state = np.zeros(1)
+    remainder = np.empty(0)
+    parts = []
+    available = 0
+    for block in blocks:
+        filtered, filter_state = signal.lfilter(*coefficients, block, zi=filter_state)
+        filtered = np.concatenate((remainder, filtered))
+        usable = len(filtered) - len(filtered) % ratio
+        remainder = filtered[usable:]
+        parts.append(filtered[:usable].reshape(-1, ratio).mean(axis=1).astype(np.float32))
+        available += len(parts[-1])
+        if available >= needed:
+            break
+    else:
+        # The end of the track: a trailing partial group is averaged on its own
+        if len(remainder):
+            parts.append(np.mean(remainder, keepdims=True).astype(np.float32))
+    
+    downsampled = np.concatenate(parts) if parts else np.empty(0, dtype=np.float32)
+    return downsampled[:needed], num_windows
 
-def generate_fingerprints(peaks: List[Peak], song_id: int) -> Dict[int, Tuple[int, int]]:
-    """Generate fingerprints from peaks using the Go implementation's approach."""
-    fingerprints = {}
-    
-    for i, anchor in enumerate(peaks):
-        for j in range(i + 1, min(len(peaks), i + TARGET_ZONE_SIZE + 1)):
-            target = peaks[j]
-            
-            # Create address (hash) as in Go implementation
-            anchor_freq = int(abs(anchor.freq))
-            target_freq = int(abs(target.freq))
-            delta_ms = int((target.time - anchor.time) * 1000)
-            
-            # Combine components into 32-bit address
-            address = (anchor_freq << 23) | (target_freq << 14) | delta_ms
-            anchor_time_ms = int(anchor.time * 1000)
-            
-            fingerprints[address] = (anchor_time_ms, song_id)
-    
-    return fingerprints
-
-def create_fingerprint_hash(anchor, target):
-    """Create a unique hash from a pair of peaks."""
-    # Convert complex frequency to real number (using magnitude)
-    anchor_freq = int(np.abs(anchor.freq))
-    target_freq = int(np.abs(target.freq))
-    delta_time = int((target.time - anchor.time) * 1000)  # Convert to milliseconds
-    
-    # Combine into 32-bit hash (matching SeekTune's implementation)
-    fingerprint_hash = (anchor_freq << 23) | (target_freq << 14) | (delta_time & 0x3FFF)
-    return fingerprint_hash
-
-def generate_fingerprints(peaks, song_id):
-    """Generate fingerprints from peaks."""
-    fingerprints = {}
-    
-    for i, anchor in enumerate(peaks):
-        # Look ahead in target zone
-        for j in range(i + 1, min(i + TARGET_ZONE_SIZE + 1, len(peaks))):
-            target = peaks[j]
-            
-            hash_value = create_fingerprint_hash(anchor, target)
-            anchor_time = int(anchor.time * 1000)  # Convert to milliseconds
-            
-            fingerprints[hash_value] = (anchor_time, song_id)
-    
-    return fingerprints
+def fingerprint_blocks(blocks: Iterable[np.ndarray], sample_rate: int, num_samples: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Fingerprint a track of known length from consecutive blocks of mono samples.
+    
+    Produces the same ``(hashes, anchor_times_ms)`` pairs as
+    `fingerprint_samples`, though not in the same order, while holding only
+    one block and a few frames at a time. Blocks past the last analysed frame
+    are not consumed.
+    """
+    ratio = sample_rate // (sample_rate // DSP_RATIO)
+    num_windows = -(-num_samples // ratio) // (FREQ_BIN_SIZE - HOP_SIZE)
+    if num_windows == 0:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+    
+    fingerprinter = StreamingFingerprinter(sample_rate, num_samples / sample_rate / num_windows, num_windows)
+    parts = []
+    for block in blocks:
+        parts.append(fingerprinter.feed(block))
+        if fingerprinter.done:
+            break
+    parts.append(fingerprinter.finish())
+    return np.concatenate([hashes for hashes, _ in parts]), np.concatenate([offsets for _, offsets in parts])
@@ -0,0 +1,392 @@
+"""Immutable, versioned index snapshots for read replicas.
+
+A snapshot is a single file holding everything a serving node needs to answer
+queries: the fingerprint postings, as the delta-varint posting lists of
+`compressed_index` (default) or the CSR arrays of `memory_index`, the song
+names and lengths, the per-hash song counts behind the stop-list, and a manifest with a
+checksum of every section. It is built offline from a songs database and
+never modified afterwards, so read replicas are scaled out by copying one file.
+
+Layout: the 8-byte magic, the manifest length as a little-endian uint64, the
+JSON manifest, then each section's raw array, aligned to 64 bytes. Serving
+processes memory-map the file, so loading it does not copy the postings and
+all workers share the same pages.
+
+With FINGERPRINT_ENGINE=snapshot the server serves the snapshot at
+SNAPSHOT_PATH. To publish a new one, write it next to the old one and rename
+it over SNAPSHOT_PATH (or repoint a symlink). Workers notice within
+SNAPSHOT_CHECK_SECONDS, on SIGHUP or on POST /admin/snapshot, verify it in the
+background and swap it in with one reference assignment. Requests already
+running finish on the snapshot they started with.
+
+Usage:
+    python snapshot.py build snapshots/catalog.snap [--database songs.db] [--layout varint|csr]
+    python snapshot.py verify snapshots/catalog.snap
+    python snapshot.py info snapshots/catalog.snap
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from compressed_index import CompressedIndex
+from memory_index import MemoryIndex
+from metrics import SNAPSHOT_POSTINGS, SNAPSHOT_SWAPS
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AFPSNAP\x00'
+SNAPSHOT_FORMAT = 1
+ALIGNMENT = 64
+POSTING_LAYOUTS = {
+    'varint': ('keys', 'byte_ptr', 'data'),
+    'csr': ('keys', 'indptr', 'song_ids', 'offsets'),
+}
+
+
+class SnapshotError(Exception):
+    """The file is not a valid snapshot, or does not match its manifest."""
+
+
+def build_sections(conn, layout: str = 'varint') -> Tuple[Dict[str, np.ndarray], dict]:
+    """Arrays of a snapshot of the songs database behind `conn`, and their manifest fields."""
+    index = MemoryIndex.from_database(conn)
+    if layout == 'varint':
+        index = CompressedIndex.from_index(index)
+    rows = conn.execute('SELECT id, name, duration FROM songs ORDER BY id').fetchall()
+    names = [name.encode() for _, name, _ in rows]
+    stats = np.array(conn.execute('SELECT hash, songs FROM hash_stats ORDER BY hash').fetchall(),
+                     dtype=np.int64).reshape(-1, 2)
+    sections = {name: getattr(index, name) for name in POSTING_LAYOUTS[layout]}
+    return sections | {
+        'catalog_ids': np.array([song_id for song_id, _, _ in rows], dtype=np.int64),
+        'name_indptr': np.concatenate(([0], np.cumsum([len(name) for name in names]))).astype(np.int64),
+        'names': np.frombuffer(b''.join(names), dtype=np.uint8),
+        'durations': np.array([np.nan if duration is None else duration for _, _, duration in rows],
+                              dtype=np.float64),
+        'stats_hashes': stats[:, 0].copy(),
+        'stats_songs': stats[:, 1].copy(),
+    }, {'posting_layout': layout, 'num_postings': len(index)}
+
+
+def write_snapshot(path: str, sections: Dict[str, np.ndarray], **manifest) -> dict:
+    """Write `sections` and `manifest` to a new snapshot file at `path`.
+    
+    The file is written under a temporary name and renamed into place, so
+    readers never see a partial snapshot. Returns the full manifest.
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in sections.items()}
+    layout = {}
+    position = 0
+    for name, array in arrays.items():
+        layout[name] = {
+            'offset': position,
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'sha256': hashlib.sha256(memoryview(array).cast('B')).hexdigest(),
+        }
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    snapshot_id = hashlib.sha256(json.dumps(
+        [manifest.get('fingerprint_version'), [(name, section['sha256']) for name, section in layout.items()]]
+    ).encode()).hexdigest()[:16]
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'snapshot_id': snapshot_id,
+        'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'num_songs': len(arrays['catalog_ids']),
+        **manifest,
+        'sections': layout,
+    }
+    
+    header = json.dumps(manifest).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'wb') as out:
+            out.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+            for name, array in arrays.items():
+                out.seek(data_start + layout[name]['offset'])
+                out.write(memoryview(array).cast('B'))
+            out.truncate(data_start + position)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    return manifest
+
+
+def _read_manifest(snapshot_file) -> Tuple[dict, int]:
+    if snapshot_file.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError(f'{snapshot_file.name} is not an index snapshot')
+    length = int.from_bytes(snapshot_file.read(8), 'little')
+    try:
+        manifest = json.loads(snapshot_file.read(length))
+    except ValueError as e:
+        raise SnapshotError(f'{snapshot_file.name} has a damaged manifest: {e}')
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"{snapshot_file.name} has snapshot format {manifest.get('format')}, "
+                            f'this server reads format {SNAPSHOT_FORMAT}')
+    return manifest, -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+
+class Snapshot:
+    """A memory-mapped snapshot file; `verify` checks every section's checksum."""
+    
+    def __init__(self, path: str, verify: bool = True):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self.manifest, data_start = _read_manifest(snapshot_file)
+            self.file_id = _file_id(os.fstat(snapshot_file.fileno()))
+            size = os.fstat(snapshot_file.fileno()).st_size
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        self.sections = {}
+        for name, section in self.manifest['sections'].items():
+            dtype = np.dtype(section['dtype'])
+            count = int(np.prod(section['shape']))
+            start = data_start + section['offset']
+            if start + count * dtype.itemsize > size:
+                raise SnapshotError(f'{path} is truncated in section {name}')
+            self.sections[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=start).reshape(
+                section['shape'])
+        if verify:
+            self.verify()
+        
+        self.id = self.manifest['snapshot_id']
+        self.generation = int(self.id, 16)
+        self.fingerprint_version = self.manifest.get('fingerprint_version')
+        layout = self.manifest.get('posting_layout', 'csr')
+        if layout not in POSTING_LAYOUTS:
+            raise SnapshotError(f'{path} has unknown posting layout {layout}')
+        postings = [self.sections[name] for name in POSTING_LAYOUTS[layout]]
+        self.index = (CompressedIndex(*postings, self.manifest['num_postings']) if layout == 'varint'
+                      else MemoryIndex(*postings))
+        self.catalog_ids = self.sections['catalog_ids']
+        self.stats_hashes = self.sections['stats_hashes']
+        self.stats_songs = self.sections['stats_songs']
+    
+    def verify(self) -> None:
+        """Raise SnapshotError if any section differs from its manifest checksum."""
+        for name, array in self.sections.items():
+            if hashlib.sha256(memoryview(array).cast('B')).hexdigest() != self.manifest['sections'][name]['sha256']:
+                raise SnapshotError(f'{self.path}: checksum mismatch in section {name}')
+    
+    @property
+    def num_songs(self) -> int:
+        return len(self.catalog_ids)
+    
+    def __len__(self) -> int:
+        return len(self.index)
+    
+    def lookup(self, hashes, sample_offsets) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Same contract as `matching.lookup_fingerprints`."""
+        return self.index.lookup(hashes, sample_offsets)
+    
+    def song_names(self, song_ids: Iterable[int]) -> Dict[int, str]:
+        """Names of the given songs that are in the snapshot."""
+        song_ids = np.asarray(list(song_ids), dtype=np.int64)
+        if len(self.catalog_ids) == 0 or len(song_ids) == 0:
+            return {}
+        pos = np.minimum(np.searchsorted(self.catalog_ids, song_ids), len(self.catalog_ids) - 1)
+        names, name_indptr = self.sections['names'], self.sections['name_indptr']
+        return {int(song_id): names[name_indptr[i]:name_indptr[i + 1]].tobytes().decode()
+                for song_id, i in zip(song_ids, pos) if self.catalog_ids[i] == song_id}
+    
+    def song_durations(self, song_ids: Iterable[int]) -> Dict[int, float]:
+        """Lengths in seconds of the given songs whose length the snapshot records."""
+        song_ids = np.asarray(list(song_ids), dtype=np.int64)
+        durations = self.sections.get('durations')
+        if durations is None or len(self.catalog_ids) == 0 or len(song_ids) == 0:
+            return {}
+        pos = np.minimum(np.searchsorted(self.catalog_ids, song_ids), len(self.catalog_ids) - 1)
+        return {int(song_id): float(durations[i]) for song_id, i in zip(song_ids, pos)
+                if self.catalog_ids[i] == song_id and not np.isnan(durations[i])}
+
+
+def _file_id(stat: os.stat_result) -> Tuple:
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class LiveSnapshot:
+    """The snapshot currently served from `path`, swapped atomically when it changes.
+    
+    `current()` never blocks on loading: new snapshots are mapped and verified
+    in a background thread, and the old one keeps serving until the swap.
+    Snapshots of another fingerprint version than `fingerprint_version` are
+    refused.
+    """
+    
+    def __init__(self, path: str, fingerprint_version: int, verify: bool = True, check_interval: float = 1.0):
+        self.path = path
+        self.fingerprint_version = fingerprint_version
+        self.verify = verify
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._loading = False
+        self._next_check = time.monotonic() + check_interval
+        self._snapshot = self._open(path)
+        SNAPSHOT_POSTINGS.set(len(self._snapshot))
+        logger.info(f'Serving snapshot {self._snapshot.id} from {path} '
+                    f'({self._snapshot.num_songs} songs, {len(self._snapshot)} postings)')
+    
+    def _open(self, path: str) -> Snapshot:
+        snapshot = Snapshot(path, self.verify)
+        if snapshot.fingerprint_version != self.fingerprint_version:
+            raise SnapshotError(f'{path} holds fingerprint version {snapshot.fingerprint_version}, '
+                                f'this server computes version {self.fingerprint_version}')
+        return snapshot
+    
+    def current(self) -> Snapshot:
+        """The snapshot to serve; starts a background reload if `path` was replaced."""
+        if self.check_interval > 0 and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + self.check_interval
+            try:
+                changed = _file_id(os.stat(self.path)) != self._snapshot.file_id
+            except OSError:
+                changed = False
+            if changed:
+                self.reload_in_background()
+        return self._snapshot
+    
+    def reload(self, path: Optional[str] = None) -> Snapshot:
+        """Load and verify the snapshot at `path` (default: the served path), then swap it in.
+        
+        Raises SnapshotError, leaving the served snapshot in place, if it is invalid.
+        """
+        try:
+            snapshot = self._open(path or self.path)
+        except (OSError, SnapshotError):
+            SNAPSHOT_SWAPS.inc(result='error')
+            raise
+        with self._lock:
+            previous, self._snapshot = self._snapshot, snapshot
+        SNAPSHOT_SWAPS.inc(result='swapped' if snapshot.id != previous.id else 'unchanged')
+        SNAPSHOT_POSTINGS.set(len(snapshot))
+        logger.info(f'Swapped snapshot {previous.id} for {snapshot.id} '
+                    f'({snapshot.num_songs} songs, {len(snapshot)} postings)')
+        return snapshot
+    
+    def reload_in_background(self) -> None:
+        """Reload in a separate thread unless a reload is already running."""
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+        
+        def run():
+            try:
+                self.reload()
+            except (OSError, SnapshotError) as e:
+                logger.error(f'Keeping snapshot {self._snapshot.id}: {e}')
+            finally:
+                self._loading = False
+        
+        threading.Thread(target=run, name='snapshot-reload', daemon=True).start()
+    
+    def publish(self, path: str) -> Snapshot:
+        """Serve the snapshot at `path` and point the served path at it.
+        
+        `path` must lie in the directory of the served path. Other processes
+        serving the same path follow on their next check. The served path
+        becomes a symlink to `path`; if it was a regular file, that file is
+        kept next to it as ``<name>.<snapshot_id><ext>``.
+        """
+        directory = os.path.realpath(os.path.dirname(os.path.abspath(self.path)))
+        target = os.path.realpath(path)
+        if os.path.commonpath([directory, target]) != directory:
+            raise SnapshotError(f'{path} is not in the snapshot directory {directory}')
+        if target == os.path.realpath(self.path):
+            return self.reload()
+        snapshot = self.reload(target)
+        if os.path.isfile(self.path) and not os.path.islink(self.path):
+            self._keep_previous()
+        link = f'{self.path}.{os.getpid()}.link'
+        os.symlink(target, link)
+        os.replace(link, self.path)
+        return snapshot
+    
+    def _keep_previous(self) -> None:
+        """Hard-link the regular file at the served path under its snapshot id."""
+        with open(self.path, 'rb') as snapshot_file:
+            snapshot_id = _read_manifest(snapshot_file)[0]['snapshot_id']
+        root, ext = os.path.splitext(self.path)
+        try:
+            os.link(self.path, f'{root}.{snapshot_id}{ext}')
+        except FileExistsError:
+            # Same id, same contents
+            pass
+    
+    def install_signal_handler(self, signum: int = getattr(signal, 'SIGHUP', None)) -> bool:
+        """Reload on `signum`; only possible from the main thread. Returns whether it was installed."""
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+        signal.signal(signum, lambda *_: self.reload_in_background())
+        return True
+
+
+def snapshot_summary(snapshot: Snapshot) -> dict:
+    """Manifest fields worth showing, without the section table."""
+    return {key: value for key, value in snapshot.manifest.items() if key != 'sections'} | {'path': snapshot.path}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and check immutable index snapshots.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help='Snapshot the songs database')
+    build_parser.add_argument('output')
+    build_parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'songs.db'))
+    build_parser.add_argument('--layout', choices=tuple(POSTING_LAYOUTS), default='varint',
+                              help='Posting list encoding (default: delta-varint compressed)')
+    commands.add_parser('verify', help='Check every section checksum').add_argument('snapshot')
+    commands.add_parser('info', help='Show the manifest').add_argument('snapshot')
+    args = parser.parse_args()
+    
+    if args.command == 'build':
+        from database import catalog_generation, connect, fingerprint_version, init_db
+        init_db(args.database)
+        conn = connect(args.database, read_only=True)
+        try:
+            # One read transaction, so songs, postings and statistics agree
+            conn.execute('BEGIN')
+            start = time.perf_counter()
+            sections, posting_manifest = build_sections(conn, args.layout)
+            manifest = write_snapshot(args.output, sections, **posting_manifest,
+                                      fingerprint_version=fingerprint_version(conn),
+                                      generation=catalog_generation(conn),
+                                      source=os.path.abspath(args.database))
+        finally:
+            conn.close()
+        print(f"Wrote snapshot {manifest['snapshot_id']} to {args.output}: {manifest['num_songs']:,} songs, "
+              f"{manifest['num_postings']:,} postings, {os.path.getsize(args.output) / 2**20:,.1f} MiB "
+              f'in {time.perf_counter() - start:.1f}s')
+        return 0
+    
+    try:
+        snapshot = Snapshot(args.snapshot, verify=args.command == 'verify')
+    except (OSError, SnapshotError) as e:
+        print(f'{args.snapshot}: {e}', file=sys.stderr)
+        return 1
+    if args.command == 'verify':
+        print(f'{args.snapshot}: snapshot {snapshot.id}, all {len(snapshot.sections)} sections intact')
+    else:
+        print(json.dumps(snapshot_summary(snapshot), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""Content-addressed on-disk cache of intermediate fingerprinting stages.
+
+Re-indexing a catalog after a fingerprint parameter changes would otherwise
+decode every file and run the whole DSP chain again. The cache keeps two
+stages per file, keyed by the file's content hash and a digest of the
+parameters the stage depends on:
+
+- ``pcm``: the low-pass filtered, downsampled samples the STFT reads (float32)
+- ``peaks``: the PEAK_DTYPE peak array
+
+A re-index resumes from the deepest valid stage. Changing TARGET_ZONE_SIZE or
+the hash layout only regenerates hashes from cached peaks; changing BANDS
+recomputes peaks from cached PCM; changing AUDIO_DECODER or the decoder's
+output rate decodes the files again. Entries are uncompressed ``.npz`` files,
+tracked in an SQLite index and evicted least recently used first once the
+cache grows past its size cap. Bump STAGE_FORMAT when the code of a stage
+changes without its parameters.
+
+Usage:
+    python stage_cache.py stats [--cache-dir stage_cache]
+    python stage_cache.py clear
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from audio_io import DECODER, DECODER_SAMPLE_RATE, decode_audio, read_audio_blocks
+from shazam_fingerprint import (BANDS, DSP_RATIO, FREQ_BIN_SIZE, HOP_SIZE, MAX_FREQ, compute_stft,
+                                downsample_blocks, extract_peaks, generate_fingerprints)
+
+STAGE_FORMAT = 1
+# Files libsndfile cannot read are decoded by DECODER at DECODER_SAMPLE_RATE,
+# so both are part of the PCM parameters
+STAGE_PARAMS = {
+    'pcm': (STAGE_FORMAT, DECODER, DECODER_SAMPLE_RATE, MAX_FREQ, DSP_RATIO, FREQ_BIN_SIZE, HOP_SIZE),
+    'peaks': (STAGE_FORMAT, DECODER, DECODER_SAMPLE_RATE, MAX_FREQ, DSP_RATIO, FREQ_BIN_SIZE, HOP_SIZE,
+              tuple(BANDS)),
+}
+DEFAULT_MAX_MB = 2048
+DECODE_BLOCK_FRAMES = 65536
+
+
+def stage_key(stage: str, content_hash: str) -> str:
+    """Cache key of `stage` for the file with `content_hash` under the current parameters."""
+    params = hashlib.sha256(repr(STAGE_PARAMS[stage]).encode()).hexdigest()[:16]
+    return f'{stage}-{content_hash}-{params}'
+
+
+class StageCache:
+    """Size-capped LRU store of stage arrays in `directory`.
+    
+    Several processes may share one cache directory; entries are written to a
+    temporary file and renamed into place, and the index is an SQLite database.
+    """
+    
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_MB * 2**20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=30.0)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    stage TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_entries_last_used ON entries (last_used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key.split('-')[1][:2], f'{key}.npz')
+    
+    def _count(self, name: str) -> None:
+        self.conn.execute('INSERT INTO counters (name, value) VALUES (?, 1) '
+                          'ON CONFLICT(name) DO UPDATE SET value = value + 1', (name,))
+    
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """Arrays stored under `key`, or None; a hit marks the entry as recently used."""
+        stage = key.split('-')[0]
+        try:
+            with np.load(self._path(key)) as stored:
+                arrays = {name: stored[name] for name in stored.files}
+        except (OSError, ValueError):
+            with self.conn:
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self._count(f'{stage}_misses')
+            return None
+        with self.conn:
+            self.conn.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+            self._count(f'{stage}_hits')
+        return arrays
+    
+    def put(self, key: str, **arrays: np.ndarray) -> None:
+        """Store `arrays` under `key`, then evict old entries beyond the size cap."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                np.savez(temp_file, **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO entries (key, stage, size, last_used) VALUES (?, ?, ?, ?)',
+                              (key, key.split('-')[0], os.path.getsize(path), time.time()))
+            self._evict()
+    
+    def _evict(self) -> None:
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute('SELECT key, size FROM entries ORDER BY last_used').fetchall():
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+            self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self._count('evictions')
+            total -= size
+            if total <= self.max_bytes:
+                break
+    
+    def stats(self) -> dict:
+        """Entries and bytes per stage, hit/miss counters and the size cap."""
+        stages = {stage: {'entries': entries, 'bytes': size} for stage, entries, size in self.conn.execute(
+            'SELECT stage, COUNT(*), SUM(size) FROM entries GROUP BY stage ORDER BY stage')}
+        return {
+            'directory': self.directory,
+            'max_bytes': self.max_bytes,
+            'bytes': sum(stage['bytes'] for stage in stages.values()),
+            'stages': stages,
+            'counters': dict(self.conn.execute('SELECT name, value FROM counters ORDER BY name')),
+        }
+    
+    def clear(self) -> None:
+        """Delete every entry and reset the counters."""
+        with self.conn:
+            for (key,) in self.conn.execute('SELECT key FROM entries').fetchall():
+                try:
+                    os.unlink(self._path(key))
+                except FileNotFoundError:
+                    pass
+            self.conn.execute('DELETE FROM entries')
+            self.conn.execute('DELETE FROM counters')
+    
+    def close(self) -> None:
+        self.conn.close()
+
+
+def cached_fingerprint(cache: StageCache, path: str, content_hash: str) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Fingerprint the file at `path`, resuming from its deepest cached stage.
+    
+    Returns ``(hashes, anchor_times_ms, duration)``, the same fingerprints as
+    `fingerprint_samples` on the decoded file.
+    """
+    peaks_key = stage_key('peaks', content_hash)
+    stored = cache.get(peaks_key)
+    if stored is None:
+        pcm_key = stage_key('pcm', content_hash)
+        pcm = cache.get(pcm_key)
+        if pcm is None:
+            blocks, sample_rate, num_samples = read_audio_blocks(path, DECODE_BLOCK_FRAMES)
+            if num_samples is None:
+                with open(path, 'rb') as audio_file:
+                    samples, sample_rate = decode_audio(audio_file.read())
+                blocks, num_samples = [samples], len(samples)
+            downsampled, num_windows = downsample_blocks(blocks, sample_rate, num_samples)
+            pcm = {'samples': downsampled, 'num_windows': np.int64(num_windows),
+                   'duration': np.float64(num_samples / sample_rate)}
+            cache.put(pcm_key, **pcm)
+        spectrogram = compute_stft(pcm['samples'], int(pcm['num_windows']))
+        stored = {'peaks': extract_peaks(spectrogram, float(pcm['duration'])), 'duration': pcm['duration']}
+        cache.put(peaks_key, **stored)
+    hashes, offsets = generate_fingerprints(stored['peaks'])
+    return hashes, offsets, float(stored['duration'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or clear the intermediate fingerprinting cache.')
+    parser.add_argument('--cache-dir', default=os.environ.get('STAGE_CACHE_DIR', 'stage_cache'))
+    parser.add_argument('--cache-mb', type=int, default=int(os.environ.get('STAGE_CACHE_MB', DEFAULT_MAX_MB)),
+                        help='Size cap in MiB')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('stats', help='Show entries, size and hit counters')
+    commands.add_parser('clear', help='Delete every cached entry')
+    args = parser.parse_args()
+    
+    cache = StageCache(args.cache_dir, args.cache_mb * 2**20)
+    try:
+        if args.command == 'clear':
+            cache.clear()
+            print(f'Cleared {args.cache_dir}')
+            return 0
+        stats = cache.stats()
+        print(f"{stats['directory']}: {stats['bytes'] / 2**20:,.1f} of {stats['max_bytes'] / 2**20:,.0f} MiB in "
+              f"{sum(stage['entries'] for stage in stats['stages'].values()):,} entries")
+        for stage, values in stats['stages'].items():
+            print(f"  {stage:<8}{values['entries']:>10,} entries {values['bytes'] / 2**20:>12,.1f} MiB")
+        counters = stats['counters']
+        for stage in STAGE_PARAMS:
+            hits, misses = counters.get(f'{stage}_hits', 0), counters.get(f'{stage}_misses', 0)
+            print(f'  {stage:<8}{hits:>10,} hits {misses:>10,} misses')
+        print(f"  {counters.get('evictions', 0):,} evictions")
+    finally:
+        cache.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
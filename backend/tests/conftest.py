@@ -0,0 +1,49 @@
+"""Shared fixtures: the Flask app on a scratch database, and synthetic songs."""
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# app reads its settings when it is imported
+_scratch = tempfile.mkdtemp(prefix='fingerprint-tests-')
+os.environ['DATABASE_PATH'] = os.path.join(_scratch, 'songs.db')
+os.environ.setdefault('FINGERPRINT_ENGINE', 'sqlite')
+
+from benchmarks.synthetic import SAMPLE_RATE, synthetic_song, to_wav  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    """Test client of an app whose catalog starts out empty."""
+    client = app_module.app.test_client()
+    assert client.post('/clear_db').status_code == 200
+    return client
+
+
+@pytest.fixture(scope='session')
+def songs():
+    """Three distinct 20-second synthetic songs."""
+    return [synthetic_song(seed, 20.0) for seed in range(3)]
+
+
+def add_song(client, name: str, samples: np.ndarray) -> int:
+    response = client.post('/add', data={'name': name, 'file': (io.BytesIO(to_wav(samples)), f'{name}.wav')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['song_id']
+
+
+def silence(seconds: float) -> np.ndarray:
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
@@ -0,0 +1,68 @@
+"""The array-based fingerprinting pipeline against the original loop-based one."""
+import numpy as np
+import pytest
+
+import shazam_fingerprint as sfp
+from benchmarks.fingerprint_stages import (
+    reference_downsample, reference_extract_peaks, reference_generate_fingerprints, reference_low_pass_filter,
+    reference_stft, synthetic_track
+)
+from benchmarks.synthetic import synthetic_song
+
+# (samples, sample_rate): a tone and chirp mix, synthetic notes at two rates,
+# a length that is not a whole number of downsampling groups, and silence
+INPUTS = {
+    'chirp': synthetic_track(3.0, 44100, seed=1),
+    'notes-44100': (synthetic_song(7, 3.0, 44100).astype(np.float64), 44100),
+    'notes-48000': (synthetic_song(8, 3.0, 48000).astype(np.float64), 48000),
+    'odd-length': (synthetic_song(9, 2.0, 44100)[:88201].astype(np.float64), 44100),
+    'silence': (np.zeros(44100), 44100),
+}
+
+
+def reference_fingerprints(samples, sample_rate):
+    """Stages of the reference pipeline: ``(filtered, downsampled, spectrogram, peaks, fingerprints)``."""
+    filtered = reference_low_pass_filter(sfp.MAX_FREQ, sample_rate, samples)
+    downsampled = reference_downsample(filtered, sample_rate, sample_rate // sfp.DSP_RATIO)
+    spectrogram = reference_stft(downsampled)
+    peaks = reference_extract_peaks(spectrogram, len(samples) / sample_rate)
+    return filtered, downsampled, spectrogram, peaks, reference_generate_fingerprints(peaks)
+
+
+@pytest.fixture(scope='module', params=sorted(INPUTS))
+def case(request):
+    samples, sample_rate = INPUTS[request.param]
+    return samples, sample_rate, reference_fingerprints(samples, sample_rate)
+
+
+def test_stages_match_reference(case):
+    samples, sample_rate, (ref_filtered, ref_down, ref_spec, ref_peaks, _) = case
+    
+    filtered = sfp.low_pass_filter(sfp.MAX_FREQ, sample_rate, samples)
+    np.testing.assert_allclose(filtered, ref_filtered, rtol=1e-9, atol=1e-12)
+    downsampled = sfp.downsample(filtered, sample_rate, sample_rate // sfp.DSP_RATIO)
+    np.testing.assert_allclose(downsampled, ref_down, rtol=1e-9, atol=1e-12)
+    spectrogram = sfp.compute_stft(downsampled)
+    assert spectrogram.shape == (len(ref_spec), sfp.FREQ_BIN_SIZE // 2 + 1)
+    np.testing.assert_allclose(spectrogram, ref_spec[:, :sfp.FREQ_BIN_SIZE // 2 + 1], rtol=1e-6, atol=1e-6)
+    
+    peaks = sfp.extract_peaks(spectrogram, len(samples) / sample_rate)
+    assert list(zip(peaks['time_ms'].tolist(), peaks['freq_bin'].tolist())) == [
+        (int(time * 1000), freq_bin) for time, freq_bin, _ in ref_peaks
+    ]
+
+
+def test_generate_fingerprints_matches_reference(case):
+    samples, sample_rate, (*_, ref_fingerprints) = case
+    
+    hashes, offsets = sfp.fingerprint_samples(samples, sample_rate)
+    assert hashes.dtype == np.uint32 and offsets.dtype == np.uint32
+    assert list(zip(hashes.tolist(), offsets.tolist())) == ref_fingerprints
+
+
+def test_fingerprint_blocks_matches_reference(case):
+    samples, sample_rate, (*_, ref_fingerprints) = case
+    
+    blocks = (samples[start:start + 10000] for start in range(0, len(samples), 10000))
+    hashes, offsets = sfp.fingerprint_blocks(blocks, sample_rate, len(samples))
+    assert sorted(zip(hashes.tolist(), offsets.tolist())) == sorted(ref_fingerprints)
@@ -0,0 +1,69 @@
+import io
+import struct
+
+import numpy as np
+import pytest
+
+from audio_io import decode_audio
+from benchmarks.synthetic import SAMPLE_RATE, make_excerpt, to_wav
+from conftest import add_song
+from fingerprint_codec import (
+    CONTENT_TYPE, PAIR_DTYPE, decode_fingerprints, encode_fingerprints, fingerprint_payload
+)
+from shazam_fingerprint import FINGERPRINT_VERSION, fingerprint_samples
+
+
+def match_hashes(client, payload, version=FINGERPRINT_VERSION):
+    return client.post(f'/match_hashes?version={version}', data=payload, content_type=CONTENT_TYPE)
+
+
+def test_payload_is_the_servers_fingerprints(songs):
+    hashes, offsets = fingerprint_samples(songs[0][:5 * SAMPLE_RATE], SAMPLE_RATE)
+    payload = fingerprint_payload(songs[0][:5 * SAMPLE_RATE], SAMPLE_RATE)
+    
+    assert len(payload) == len(hashes) * PAIR_DTYPE.itemsize
+    assert payload[:8] == struct.pack('<II', hashes[0], offsets[0])
+    decoded_hashes, decoded_offsets = decode_fingerprints(payload)
+    np.testing.assert_array_equal(decoded_hashes, hashes)
+    np.testing.assert_array_equal(decoded_offsets, offsets)
+
+
+def test_codec_rejects_malformed_input():
+    with pytest.raises(ValueError):
+        encode_fingerprints(np.zeros(3, dtype=np.uint32), np.zeros(2, dtype=np.uint32))
+    with pytest.raises(ValueError):
+        decode_fingerprints(b'\x00' * 12)
+
+
+def test_match_hashes_agrees_with_match(client, songs):
+    song_ids = [add_song(client, f'song {i}', samples) for i, samples in enumerate(songs)]
+    rng = np.random.default_rng(0)
+    
+    for song_id, samples in zip(song_ids, songs):
+        wav = to_wav(make_excerpt(samples, rng, 5.0))
+        by_audio = client.post('/match', data={'file': (io.BytesIO(wav), 'query.wav')},
+                               content_type='multipart/form-data')
+        by_hashes = match_hashes(client, fingerprint_payload(*decode_audio(wav)))
+        
+        assert by_audio.status_code == by_hashes.status_code == 200
+        assert by_hashes.get_json()['song_id'] == song_id
+        assert by_hashes.get_json()['candidates'] == by_audio.get_json()['candidates']
+
+
+def test_other_version_is_rejected(client, songs):
+    response = match_hashes(client, fingerprint_payload(songs[0][:SAMPLE_RATE], SAMPLE_RATE),
+                            version=FINGERPRINT_VERSION - 1)
+    assert response.status_code == 409
+    assert response.get_json()['fingerprint_version'] == FINGERPRINT_VERSION
+
+
+def test_truncated_payload_is_rejected(client, songs):
+    payload = fingerprint_payload(songs[0][:SAMPLE_RATE], SAMPLE_RATE)
+    assert match_hashes(client, payload[:-3]).status_code == 400
+
+
+def test_oversize_payload_is_rejected(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'MATCH_HASHES_MAX', 10)
+    payload = encode_fingerprints(np.arange(11, dtype=np.uint32), np.arange(11, dtype=np.uint32))
+    assert match_hashes(client, payload).status_code == 413
+    assert match_hashes(client, payload[:10 * PAIR_DTYPE.itemsize]).status_code == 200
@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import make_excerpt, to_wav
+from conftest import add_song
+from database import catalog_epoch, catalog_generation, connect
+from memory_index import MemoryIndex, last_rowid
+
+
+@pytest.fixture
+def memory_client(client, app_module, monkeypatch):
+    """Test client of the app serving the memory engine, as every worker does after forking."""
+    conn = connect(app_module.DATABASE_PATH)
+    try:
+        monkeypatch.setattr(app_module, 'memory_index', MemoryIndex.from_database(conn))
+        monkeypatch.setattr(app_module, 'memory_generation', catalog_generation(conn))
+        monkeypatch.setattr(app_module, 'memory_rowid', last_rowid(conn))
+        monkeypatch.setattr(app_module, 'memory_epoch', catalog_epoch(conn))
+    finally:
+        conn.close()
+    return client
+
+
+def matched_song(client, samples, rng):
+    response = client.post('/match', data={'file': (io.BytesIO(to_wav(make_excerpt(samples, rng, 5.0))), 'q.wav')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['song_id']
+
+
+def test_added_songs_are_matched(memory_client, songs):
+    rng = np.random.default_rng(0)
+    song_ids = [add_song(memory_client, f'song {i}', samples) for i, samples in enumerate(songs)]
+    
+    assert [matched_song(memory_client, samples, rng) for samples in songs] == song_ids
+
+
+def test_clear_and_re_add_serves_the_new_songs(memory_client, songs):
+    rng = np.random.default_rng(0)
+    old_ids = [add_song(memory_client, f'song {i}', samples) for i, samples in enumerate(songs)]
+    assert [matched_song(memory_client, samples, rng) for samples in songs] == old_ids
+    
+    # The same audio again: as many fingerprints, at the rowids of the deleted ones
+    assert memory_client.post('/clear_db').status_code == 200
+    new_ids = [add_song(memory_client, f'song {i}', samples) for i, samples in enumerate(songs)]
+    assert not set(new_ids) & set(old_ids)
+    assert [matched_song(memory_client, samples, rng) for samples in songs] == new_ids
@@ -0,0 +1,39 @@
+import io
+
+import numpy as np
+
+from benchmarks.synthetic import to_wav
+from conftest import add_song, silence
+
+
+def scan(client, recording):
+    response = client.post('/scan', data={'file': (io.BytesIO(to_wav(recording)), 'recording.wav')},
+                           content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()['segments']
+
+
+def test_segments_cover_the_whole_play(client, songs):
+    first = add_song(client, 'first', songs[0])
+    second = add_song(client, 'second', songs[1])
+    add_song(client, 'not played', songs[2])
+    
+    # 3s silence, first song 3-23s, 2s silence, second song 25-45s, 2s silence
+    recording = np.concatenate((silence(3), songs[0], silence(2), songs[1], silence(2)))
+    segments = scan(client, recording)
+    
+    assert [segment['song_id'] for segment in segments] == [first, second]
+    for segment, (start, end) in zip(segments, ((3.0, 23.0), (25.0, 45.0))):
+        assert abs(segment['start'] - start) < 0.1
+        assert abs(segment['end'] - end) < 0.1
+
+
+def test_segment_ends_with_the_recording(client, songs):
+    song_id = add_song(client, 'cut off', songs[0])
+    
+    recording = np.concatenate((silence(1), songs[0][:len(songs[0]) // 2]))
+    segments = scan(client, recording)
+    
+    assert [segment['song_id'] for segment in segments] == [song_id]
+    assert abs(segments[0]['start'] - 1.0) < 0.1
+    assert segments[0]['end'] == 11.0